@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""Benchmark genomeGraphs on synthetic inputs and compare against a baseline.
+
+Each benchmark runs genomeGraphs end-to-end with --profile on synthetic
+inputs (see synthetic.py) and records the wall time of the run and the time of
+each stage from the profile report. Starting from a default configuration, one
+parameter at a time is varied over the given values: number of regions, region
+width, --nwinds and number of bam samples.
+
+Results are written as JSON to --output. Use --compare to check the results
+against a previous output file, e.g. the baseline of the master branch; the
+exit code is 1 if any run or stage is slower than the baseline by more than
+--tolerance.
+
+EXAMPLES
+
+    ## Save a baseline
+    benchmark.py --output baseline.json
+
+    ## After changes, compare
+    benchmark.py --output new.json --compare baseline.json
+
+    ## Bigger inputs, bam only, python renderer
+    benchmark.py --chrom_size 10000000 --depth 100 --tracks bam --args '--engine native --renderer python'
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import argparse
+import platform
+import resource
+import subprocess
+import collections
+
+import synthetic
+
+## Factors varied one at a time, in this order
+FACTORS= ['nregions', 'width', 'nwinds', 'nsamples']
+
+parser= argparse.ArgumentParser(description= __doc__, formatter_class= argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('--output', '-o', default= 'benchmark.json', help='''Output JSON file of results. Default benchmark.json''')
+parser.add_argument('--compare', '-c', default= None, help='''Baseline JSON file from a previous run to compare against''')
+parser.add_argument('--tolerance', type= float, default= 0.2, help='''Report as regression a slowdown over the baseline larger than this fraction. Default 0.2''')
+parser.add_argument('--min_seconds', type= float, default= 0.1, help='''Ignore differences from the baseline smaller than this many seconds. Default 0.1''')
+parser.add_argument('--workdir', '-w', default= 'benchmark_data', help='''Directory for the synthetic inputs, reused across runs, and output files. Default benchmark_data''')
+
+parser.add_argument('--nregions', type= int, nargs= '+', default= [1, 10, 50], help='''Number of regions to plot. Default 1 10 50''')
+parser.add_argument('--width', type= int, nargs= '+', default= [1000, 10000, 100000], help='''Width of the regions in bp. Default 1000 10000 100000''')
+parser.add_argument('--nwinds', type= int, nargs= '+', default= [100, 1000, 5000], help='''Values of --nwinds. Default 100 1000 5000''')
+parser.add_argument('--nsamples', type= int, nargs= '+', default= [1, 4, 8], help='''Number of bam files. Default 1 4 8''')
+
+parser.add_argument('--nchroms', type= int, default= 2, help='''Number of chromosomes of the synthetic genome. Default 2''')
+parser.add_argument('--chrom_size', type= int, default= 1000000, help='''Length of each chromosome. Default 1000000''')
+parser.add_argument('--depth', type= int, default= 30, help='''Mean coverage of the bam files. Default 30''')
+parser.add_argument('--read_length', type= int, default= 100, help='''Read length of the bam files. Default 100''')
+parser.add_argument('--tracks', nargs= '+', default= ['bam', 'bedgraph', 'gtf'], choices= ['bam', 'bedgraph', 'gtf'], help='''Input files to plot. Default all of bam bedgraph gtf''')
+
+parser.add_argument('--repeat', '-r', type= int, default= 3, help='''Run each configuration this many times and keep the fastest. Default 3''')
+parser.add_argument('--genomeGraphs', default= 'genomeGraphs', help='''Command to run genomeGraphs. Default genomeGraphs, i.e. on PATH''')
+parser.add_argument('--args', default= '', help='''Additional arguments for genomeGraphs, as one string. E.g. '--engine native --renderer python --jobs 4'. The region cache is always disabled''')
+
+def configurations(args):
+    """Return the list of configurations (dicts) to run: the default, i.e. the
+    middle value of each factor, and each factor varied over its values
+    """
+    default= collections.OrderedDict([(f, getattr(args, f)[len(getattr(args, f)) / 2]) for f in FACTORS])
+    configs= [default]
+    for f in FACTORS:
+        for x in getattr(args, f):
+            config= collections.OrderedDict(default)
+            config[f]= x
+            if config not in configs:
+                configs.append(config)
+    return(configs)
+
+def config_key(config):
+    return(' '.join(['%s=%s' %(f, config[f]) for f in FACTORS]))
+
+def stage_times(profile):
+    """Wall time of each stage summed across regions, from the --profile report
+    """
+    stages= collections.OrderedDict()
+    for line in open(profile):
+        if line.strip() != '':
+            r= json.loads(line)
+            stages[r['stage']]= round(stages.get(r['stage'], 0) + r['wall'], 6)
+    return(stages)
+
+def run_config(args, config, genome):
+    """Run genomeGraphs args.repeat times on config. Return dict of results of
+    the fastest run
+    """
+    fasta, inputs= synthetic.input_files(os.path.join(args.workdir, 'inputs'), genome,
+        nsamples= config['nsamples'], depth= args.depth, read_length= args.read_length, tracks= args.tracks)
+    rundir= os.path.join(args.workdir, 'run')
+    bed= synthetic.write_regions(os.path.join(args.workdir, 'regions.bed'), genome,
+        config['nregions'], config['width'])
+    best= None
+    walls= []
+    for i in range(args.repeat):
+        if os.path.exists(rundir):
+            shutil.rmtree(rundir)
+        os.makedirs(rundir)
+        profile= os.path.join(rundir, 'profile.jsonl')
+        cmd= args.genomeGraphs.split() + ['-i'] + inputs + ['-b', bed, '-f', fasta,
+            '--nwinds', str(config['nwinds']), '--profile', profile,
+            '--outdir', os.path.join(rundir, 'pdf'), '--tmpdir', os.path.join(rundir, 'tmp'),
+            '--cache_dir', os.path.join(rundir, 'cache'), '--cache_size', '0'] + args.args.split()
+        ru_start= resource.getrusage(resource.RUSAGE_CHILDREN)
+        t0= time.time()
+        p= subprocess.Popen(cmd, stdout= subprocess.PIPE, stderr= subprocess.PIPE)
+        stdout, stderr= p.communicate()
+        wall= time.time() - t0
+        ru_end= resource.getrusage(resource.RUSAGE_CHILDREN)
+        if p.returncode != 0:
+            sys.exit('Command failed:\n%s\n%s' %(' '.join(cmd), stderr))
+        cpu= ru_end.ru_utime + ru_end.ru_stime - ru_start.ru_utime - ru_start.ru_stime
+        if best is None or wall < best['wall']:
+            best= collections.OrderedDict([
+                ('config', config),
+                ('wall', round(wall, 6)),
+                ('cpu', round(cpu, 6)),
+                ('maxrss_mb', round(ru_end.ru_maxrss / 1024.0, 3)),
+                ('stages', stage_times(profile))])
+        walls.append(round(wall, 6))
+    best['walls']= walls
+    shutil.rmtree(rundir)
+    return(best)
+
+def metadata(args):
+    return(collections.OrderedDict([
+        ('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+        ('host', socket.gethostname()),
+        ('platform', platform.platform()),
+        ('python', platform.python_version()),
+        ('cpus', os.sysconf('SC_NPROCESSORS_ONLN')),
+        ('genome', [args.nchroms, args.chrom_size]),
+        ('depth', args.depth),
+        ('read_length', args.read_length),
+        ('tracks', args.tracks),
+        ('repeat', args.repeat),
+        ('genomeGraphs', args.genomeGraphs),
+        ('args', args.args)]))
+
+def compare(results, baseline, tolerance, min_seconds):
+    """Compare results to baseline (both as written to --output) matching runs
+    by configuration.
+    Return:
+        Tuple (<list of report lines>, <number of regressions>)
+    """
+    base= dict([(config_key(r['config']), r) for r in baseline['results']])
+    lines= []
+    nregress= 0
+    for r in results['results']:
+        key= config_key(r['config'])
+        if key not in base:
+            lines.append('%s: not in baseline' %(key))
+            continue
+        b= base[key]
+        pairs= [('total', b['wall'], r['wall'])] + [(s, b['stages'][s], r['stages'][s]) for s in r['stages'] if s in b['stages']]
+        for name, old, new in pairs:
+            flag= ''
+            if new - old > min_seconds and new > old * (1 + tolerance):
+                flag= 'REGRESSION'
+                nregress += 1
+            elif old - new > min_seconds and old > new * (1 + tolerance):
+                flag= 'improved'
+            ratio= '%.2f' %(new / old) if old > 0 else 'NA'
+            lines.append('\t'.join([key, name, '%.3f' %(old), '%.3f' %(new), ratio, flag]))
+    return((lines, nregress))
+
+def main():
+    args= parser.parse_args()
+    genome= synthetic.make_genome(args.nchroms, args.chrom_size)
+    results= collections.OrderedDict([('meta', metadata(args)), ('results', [])])
+    for config in configurations(args):
+        r= run_config(args, config, genome)
+        results['results'].append(r)
+        sys.stderr.write('%s\t%.3f s\n' %(config_key(config), r['wall']))
+    fout= open(args.output, 'w')
+    json.dump(results, fout, indent= 1)
+    fout.close()
+    if args.compare is not None:
+        baseline= json.load(open(args.compare))
+        lines, nregress= compare(results, baseline, args.tolerance, args.min_seconds)
+        print('\t'.join(['config', 'stage', 'baseline_s', 'new_s', 'ratio', 'flag']))
+        print('\n'.join(lines))
+        if nregress > 0:
+            sys.exit('%s regressions over baseline %s' %(nregress, args.compare))
+
+if __name__ == '__main__':
+    main()
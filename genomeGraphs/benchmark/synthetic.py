@@ -0,0 +1,219 @@
+"""Generators of synthetic input files for the benchmarks: reference fasta,
+bam files of given depth, genome-wide bedGraphs, dense gtf annotation and bed
+files of regions to plot.
+
+All generators take a seed so the same arguments give the same file. Genomes
+are described as a list of (<chrom>, <length>) tuples, see make_genome().
+
+Writing bam files requires pysam.
+"""
+
+import os
+import gzip
+import numpy
+
+BASES= numpy.array(list('ACGT'))
+
+def make_genome(nchroms, chrom_size):
+    """Return the list of (<chrom>, <length>) of a genome with nchroms of
+    length chrom_size each
+    """
+    return([('chr%s' %(i + 1), chrom_size) for i in range(nchroms)])
+
+def _random_sequence(rs, length):
+    return(''.join(BASES[rs.randint(0, 4, size= length)]))
+
+def write_fasta(filename, genome, seed= 1, linewidth= 60):
+    """Write a fasta file with random sequence for each chromosome of genome
+    and its .fai index
+    """
+    rs= numpy.random.RandomState(seed)
+    fa= open(filename, 'w')
+    fai= open(filename + '.fai', 'w')
+    for chrom, length in genome:
+        fa.write('>%s\n' %(chrom))
+        offset= fa.tell()
+        seq= _random_sequence(rs, length)
+        for i in range(0, length, linewidth):
+            fa.write(seq[i:i + linewidth] + '\n')
+        fai.write('\t'.join([chrom, str(length), str(offset), str(linewidth), str(linewidth + 1)]) + '\n')
+    fa.close()
+    fai.close()
+    return(filename)
+
+def read_fasta(filename):
+    """Return dict {<chrom>: <sequence>} of fasta file filename
+    """
+    seqs= {}
+    chrom= None
+    for line in open(filename):
+        line= line.strip()
+        if line.startswith('>'):
+            chrom= line[1:].split()[0]
+            seqs[chrom]= []
+        elif chrom is not None:
+            seqs[chrom].append(line)
+    return(dict([(k, ''.join(v)) for k, v in seqs.items()]))
+
+def write_bam(filename, fasta, depth, read_length= 100, error_rate= 0.01, seed= 1):
+    """Write a sorted and indexed bam file of single-end reads sampled uniformly
+    from the reference fasta (see write_fasta) so that the mean coverage is
+    depth. Reads are on either strand and have random mismatches at
+    error_rate. Return filename.
+    """
+    import pysam
+    rs= numpy.random.RandomState(seed)
+    seqs= read_fasta(fasta)
+    genome= [(chrom, len(seqs[chrom])) for chrom in sorted(seqs)]
+    header= {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+             'SQ': [{'SN': chrom, 'LN': length} for chrom, length in genome]}
+    quals= pysam.qualitystring_to_array('I' * read_length)
+    bam= pysam.AlignmentFile(filename, 'wb', header= header)
+    n= 0
+    for tid, (chrom, length) in enumerate(genome):
+        if length < read_length:
+            continue
+        seq= numpy.array(list(seqs[chrom]))
+        nreads= rs.poisson(float(depth) * length / read_length)
+        starts= numpy.sort(rs.randint(0, length - read_length + 1, size= nreads))
+        reverse= rs.random_sample(nreads) < 0.5
+        for i in range(nreads):
+            start= starts[i]
+            read= seq[start:start + read_length].copy()
+            errors= numpy.nonzero(rs.random_sample(read_length) < error_rate)[0]
+            if len(errors) > 0:
+                read[errors]= BASES[rs.randint(0, 4, size= len(errors))]
+            a= pysam.AlignedSegment()
+            a.query_name= 'r%s' %(n)
+            a.query_sequence= ''.join(read)
+            a.flag= 16 if reverse[i] else 0
+            a.reference_id= tid
+            a.reference_start= int(start)
+            a.mapping_quality= 60
+            a.cigartuples= [(0, read_length)]
+            a.query_qualities= quals
+            bam.write(a)
+            n += 1
+    bam.close()
+    pysam.index(filename)
+    return(filename)
+
+def write_bedgraph(filename, genome, min_width= 1, max_width= 50, seed= 1):
+    """Write a bedGraph covering the whole genome with contiguous intervals of
+    random width between min_width and max_width and random scores. The file is
+    gzip'd if filename ends in .gz. Return filename.
+    """
+    rs= numpy.random.RandomState(seed)
+    if filename.endswith('.gz'):
+        fout= gzip.open(filename, 'wb')
+    else:
+        fout= open(filename, 'w')
+    for chrom, length in genome:
+        ## Draw more widths than needed, then cut at the chromosome end
+        widths= rs.randint(min_width, max_width + 1, size= 2 * length / (min_width + max_width) + 10)
+        ends= numpy.cumsum(widths)
+        while ends[-1] < length:
+            ends= numpy.concatenate([ends, ends[-1] + numpy.cumsum(rs.randint(min_width, max_width + 1, size= len(ends)))])
+        ends= ends[ends < length].tolist() + [length]
+        scores= rs.gamma(2.0, 5.0, size= len(ends))
+        start= 0
+        lines= []
+        for end, score in zip(ends, scores):
+            lines.append('%s\t%s\t%s\t%.3f\n' %(chrom, start, end, score))
+            start= end
+        fout.write(''.join(lines))
+    fout.close()
+    return(filename)
+
+def write_gtf(filename, genome, gene_spacing= 5000, max_transcripts= 3, max_exons= 10, seed= 1):
+    """Write a gtf file with one gene every gene_spacing bp on average, each
+    gene with 1 to max_transcripts transcripts of 1 to max_exons exons. Exons of
+    coding transcripts also have CDS lines. Genes on the same chromosome
+    overlap, as in dense annotations. The file is gzip'd if filename ends in
+    .gz. Return filename.
+    """
+    rs= numpy.random.RandomState(seed)
+    if filename.endswith('.gz'):
+        fout= gzip.open(filename, 'wb')
+    else:
+        fout= open(filename, 'w')
+    ngene= 0
+    for chrom, length in genome:
+        lines= []
+        starts= numpy.sort(rs.randint(0, length, size= max(1, length / gene_spacing)))
+        for gstart in starts:
+            ngene += 1
+            gene_id= 'GENE%06d' %(ngene)
+            strand= '+' if rs.random_sample() < 0.5 else '-'
+            glen= rs.randint(1000, 4 * gene_spacing + 1)
+            gend= min(length, gstart + glen)
+            for t in range(rs.randint(1, max_transcripts + 1)):
+                tx_id= '%s.%s' %(gene_id, t + 1)
+                nexons= rs.randint(1, max_exons + 1)
+                ## Exon boundaries: sorted distinct positions within the gene
+                bounds= numpy.unique(rs.randint(gstart, gend, size= 2 * nexons))
+                if len(bounds) < 2:
+                    bounds= numpy.array([gstart, gend])
+                if len(bounds) % 2 == 1:
+                    bounds= bounds[:-1]
+                coding= rs.random_sample() < 0.7
+                attr= 'gene_id "%s"; transcript_id "%s"; gene_name "%s";' %(gene_id, tx_id, gene_id)
+                lines.append((gstart, '\t'.join([chrom, 'synthetic', 'transcript', str(bounds[0] + 1), str(bounds[-1]), '.', strand, '.', attr]) + '\n'))
+                for i in range(0, len(bounds), 2):
+                    xs, xe= bounds[i] + 1, bounds[i + 1]
+                    lines.append((xs, '\t'.join([chrom, 'synthetic', 'exon', str(xs), str(xe), '.', strand, '.', attr]) + '\n'))
+                    if coding:
+                        lines.append((xs, '\t'.join([chrom, 'synthetic', 'CDS', str(xs), str(xe), '.', strand, '0', attr]) + '\n'))
+        lines.sort(key= lambda x: x[0])
+        fout.write(''.join([x[1] for x in lines]))
+    fout.close()
+    return(filename)
+
+def write_regions(filename, genome, nregions, width, seed= 1):
+    """Write a bed file of nregions regions of width bp at random positions of
+    the genome, named region_1, region_2, ... Return filename.
+    """
+    rs= numpy.random.RandomState(seed)
+    chroms= [x for x in genome if x[1] > width]
+    if chroms == []:
+        raise ValueError('No chromosome longer than region width %s' %(width))
+    fout= open(filename, 'w')
+    for i in range(nregions):
+        chrom, length= chroms[rs.randint(0, len(chroms))]
+        start= rs.randint(0, length - width + 1)
+        fout.write('\t'.join([chrom, str(start), str(start + width), 'region_%s' %(i + 1)]) + '\n')
+    fout.close()
+    return(filename)
+
+def input_files(datadir, genome, nsamples, depth, read_length= 100, tracks= ('bam', 'bedgraph', 'gtf'), seed= 1):
+    """Generate in datadir the reference fasta and the input files of one
+    benchmark: nsamples bam files of depth, a bedGraph and a gtf as selected by
+    tracks. Files already in datadir are reused since their names encode the
+    arguments.
+    Return:
+        Tuple (<fasta>, <list of input files>)
+    """
+    if not os.path.exists(datadir):
+        os.makedirs(datadir)
+    gname= '%sx%s' %(len(genome), genome[0][1])
+    fasta= os.path.join(datadir, 'genome_%s.fa' %(gname))
+    if not os.path.exists(fasta + '.fai'):
+        write_fasta(fasta, genome, seed= seed)
+    inputs= []
+    if 'bam' in tracks:
+        for i in range(nsamples):
+            bam= os.path.join(datadir, 'sample%s_%s_d%s_r%s.bam' %(i + 1, gname, depth, read_length))
+            if not os.path.exists(bam + '.bai'):
+                write_bam(bam, fasta, depth, read_length= read_length, seed= seed + i)
+            inputs.append(bam)
+    if 'bedgraph' in tracks:
+        bdg= os.path.join(datadir, 'signal_%s.bedGraph.gz' %(gname))
+        if not os.path.exists(bdg):
+            write_bedgraph(bdg, genome, seed= seed)
+        inputs.append(bdg)
+    if 'gtf' in tracks:
+        gtf= os.path.join(datadir, 'genes_%s.gtf.gz' %(gname))
+        if not os.path.exists(gtf):
+            write_gtf(gtf, genome, seed= seed)
+        inputs.append(gtf)
+    return((fasta, inputs))
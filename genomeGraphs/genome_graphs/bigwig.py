@@ -0,0 +1,232 @@
+"""Read bigWig files in-process, without UCSC bigWigToBedGraph.
+
+Only the data blocks overlapping the requested interval are read, found through
+the R-tree index of the file. See the bigWig format in Kent et al. 2010
+(https://doi.org/10.1093/bioinformatics/btq351) and the UCSC source
+(bbiFile.h, bwgInternal.h).
+"""
+
+import os
+import struct
+import zlib
+import numpy as np
+
+BIGWIG_MAGIC= 0x888FFC26
+CHROM_TREE_MAGIC= 0x78CA8C91
+RTREE_MAGIC= 0x2468ACE0
+
+BIGWIG_EXT= ('.bw', '.bigWig', '.bigwig')
+
+class BigWigError(Exception):
+    pass
+
+def is_bigwig(filename):
+    return(filename.endswith(BIGWIG_EXT))
+
+class BigWigFile(object):
+    """Open bigWig file and read its header, zoom levels and chromosome list.
+    Attributes:
+        chroms: Dict {<chrom name>: <chrom size>}
+    """
+    def __init__(self, filename):
+        self.filename= filename
+        self.fh= open(filename, 'rb')
+        magic= self.fh.read(4)
+        if struct.unpack('<I', magic)[0] == BIGWIG_MAGIC:
+            self.endian= '<'
+        elif struct.unpack('>I', magic)[0] == BIGWIG_MAGIC:
+            self.endian= '>'
+        else:
+            raise BigWigError('%s is not a bigWig file' %(filename))
+        (self.version, nzooms, chrom_tree_offset, self.data_offset, self.index_offset,
+         field_count, defined_field_count, autosql_offset, total_summary_offset,
+         self.uncompress_buf_size)= self._unpack('HHQQQHHQQI', 4)
+        self.fh.read(8) ## Reserved
+        ## Zoom level headers: (reduction level, data offset, index offset)
+        self.zooms= []
+        for i in range(nzooms):
+            reduction, reserved, zoom_data_offset, zoom_index_offset= self._unpack('IIQQ')
+            self.zooms.append((reduction, zoom_data_offset, zoom_index_offset))
+        self.chroms= {}
+        self._chrom_ids= {}
+        self._read_chrom_tree(chrom_tree_offset)
+
+    def close(self):
+        self.fh.close()
+
+    def _unpack(self, fmt, offset= None):
+        fmt= self.endian + fmt
+        if offset is not None:
+            self.fh.seek(offset)
+        return(struct.unpack(fmt, self.fh.read(struct.calcsize(fmt))))
+
+    def _read_chrom_tree(self, offset):
+        magic, block_size, key_size, val_size, item_count= self._unpack('IIIIQ', offset)
+        if magic != CHROM_TREE_MAGIC:
+            raise BigWigError('Invalid chromosome tree in %s' %(self.filename))
+        self.fh.read(8) ## Reserved
+        nodes= [self.fh.tell()]
+        while nodes != []:
+            is_leaf, reserved, count= self._unpack('BBH', nodes.pop())
+            for i in range(count):
+                key= self.fh.read(key_size).rstrip('\x00')
+                if is_leaf:
+                    chrom_id, chrom_size= self._unpack('II')
+                    self.chroms[key]= chrom_size
+                    self._chrom_ids[key]= chrom_id
+                else:
+                    nodes.append(self._unpack('Q')[0])
+
+    def _blocks(self, index_offset, chrom_id, start, end):
+        """Return the list of (offset, size) of the data blocks overlapping
+        chrom_id:start-end, using the R-tree at index_offset
+        """
+        magic= self._unpack('I', index_offset)[0]
+        if magic != RTREE_MAGIC:
+            raise BigWigError('Invalid R-tree index in %s' %(self.filename))
+        blocks= []
+        nodes= [index_offset + 48]
+        while nodes != []:
+            is_leaf, reserved, count= self._unpack('BBH', nodes.pop())
+            if is_leaf:
+                items= self._unpack('IIIIQQ' * count)
+                step= 6
+            else:
+                items= self._unpack('IIIIQ' * count)
+                step= 5
+            for i in range(0, len(items), step):
+                s_chrom, s_base, e_chrom, e_base= items[i:i+4]
+                if (s_chrom, s_base) < (chrom_id, end) and (e_chrom, e_base) > (chrom_id, start):
+                    if is_leaf:
+                        blocks.append((items[i+4], items[i+5]))
+                    else:
+                        nodes.append(items[i+4])
+        return(sorted(blocks))
+
+    def _read_block(self, offset, size):
+        self.fh.seek(offset)
+        data= self.fh.read(size)
+        if self.uncompress_buf_size > 0:
+            data= zlib.decompress(data)
+        return(data)
+
+    def fetch(self, chrom, start, end):
+        """Return the data in chrom:start-end (0-based, half-open) as a tuple of
+        arrays (starts, ends, values). Intervals are clipped to start-end and
+        sorted. If chrom is not in the file, arrays are empty.
+        """
+        starts, ends, values= [], [], []
+        if chrom in self._chrom_ids and start < end:
+            chrom_id= self._chrom_ids[chrom]
+            for offset, size in self._blocks(self.index_offset, chrom_id, start, end):
+                data= self._read_block(offset, size)
+                pos= 0
+                while pos < len(data):
+                    s, e, v, pos= self._parse_section(data, pos, chrom_id)
+                    if s is None:
+                        continue
+                    starts.append(s)
+                    ends.append(e)
+                    values.append(v)
+        return(self._clip(starts, ends, values, start, end))
+
+    def zoom_level(self, window_size):
+        """Return the index in self.zooms of the coarsest zoom level with
+        resolution (reduction level, bases per summary) not larger than
+        window_size. None if there is no such level.
+        """
+        best= None
+        for i, zoom in enumerate(self.zooms):
+            if zoom[0] <= window_size and (best is None or zoom[0] > self.zooms[best][0]):
+                best= i
+        return(best)
+
+    def fetch_zoom(self, zoom, chrom, start, end):
+        """Return the summaries of zoom level zoom (index in self.zooms) in
+        chrom:start-end. Summaries are clipped to start-end.
+        Return:
+            Tuple of arrays (starts, ends, coverage, mins, maxs, means) with
+            coverage the fraction of bases with data in each summary record,
+            before clipping
+        """
+        starts, ends, valid, mins, maxs, sums= [], [], [], [], [], []
+        record_dtype= np.dtype([('chrom', self.endian + 'u4'), ('start', self.endian + 'u4'),
+            ('end', self.endian + 'u4'), ('valid', self.endian + 'u4'), ('min', self.endian + 'f4'),
+            ('max', self.endian + 'f4'), ('sum', self.endian + 'f4'), ('sumsq', self.endian + 'f4')])
+        if chrom in self._chrom_ids and start < end:
+            chrom_id= self._chrom_ids[chrom]
+            for offset, size in self._blocks(self.zooms[zoom][2], chrom_id, start, end):
+                records= np.frombuffer(self._read_block(offset, size), dtype= record_dtype)
+                records= records[(records['chrom'] == chrom_id) & (records['start'] < end) &
+                    (records['end'] > start) & (records['valid'] > 0)]
+                starts.append(records['start'])
+                ends.append(records['end'])
+                valid.append(records['valid'])
+                mins.append(records['min'])
+                maxs.append(records['max'])
+                sums.append(records['sum'])
+        if starts == []:
+            empty= np.zeros(0)
+            return((np.zeros(0, dtype= int), np.zeros(0, dtype= int), empty, empty, empty, empty))
+        starts= np.concatenate(starts).astype(int)
+        ends= np.concatenate(ends).astype(int)
+        valid= np.concatenate(valid).astype(float)
+        coverage= valid / (ends - starts)
+        means= np.concatenate(sums).astype(float) / valid
+        return((np.maximum(starts, start), np.minimum(ends, end), coverage,
+            np.concatenate(mins).astype(float), np.concatenate(maxs).astype(float), means))
+
+    def _parse_section(self, data, pos, chrom_id):
+        """Parse the wig section starting at data[pos]
+        Return:
+            Tuple (starts, ends, values, position of next section). Arrays are
+            None if the section is not on chrom_id
+        """
+        e= self.endian
+        sec_chrom_id, sec_start, sec_end, item_step, item_span, sec_type, reserved, count= struct.unpack(e + 'IIIIIBBH', data[pos:pos+24])
+        pos += 24
+        if sec_type == 1: ## bedGraph
+            item_dtype= np.dtype([('start', e + 'u4'), ('end', e + 'u4'), ('value', e + 'f4')])
+        elif sec_type == 2: ## variableStep
+            item_dtype= np.dtype([('start', e + 'u4'), ('value', e + 'f4')])
+        elif sec_type == 3: ## fixedStep
+            item_dtype= np.dtype([('value', e + 'f4')])
+        else:
+            raise BigWigError('Invalid section type %s in %s' %(sec_type, self.filename))
+        items= np.frombuffer(data, dtype= item_dtype, count= count, offset= pos)
+        pos += count * item_dtype.itemsize
+        if sec_type == 1:
+            starts, ends= items['start'], items['end']
+        elif sec_type == 2:
+            starts= items['start']
+            ends= starts + item_span
+        else:
+            starts= sec_start + item_step * np.arange(count, dtype= np.int64)
+            ends= starts + item_span
+        if sec_chrom_id != chrom_id:
+            return(None, None, None, pos)
+        return(starts, ends, items['value'], pos)
+
+    def _clip(self, starts, ends, values, start, end):
+        if starts == []:
+            return((np.zeros(0, dtype= int), np.zeros(0, dtype= int), np.zeros(0)))
+        starts= np.concatenate(starts).astype(int)
+        ends= np.concatenate(ends).astype(int)
+        values= np.concatenate(values).astype(float)
+        keep= (starts < end) & (ends > start)
+        return((np.maximum(starts[keep], start), np.minimum(ends[keep], end), values[keep]))
+
+## Open bigWig files of this process, see get_bigwig()
+_OPEN= {}
+
+def get_bigwig(filename):
+    """Return the BigWigFile of filename, kept open for the next calls in this
+    process. The file is opened again if it changed in the meantime.
+    """
+    st= os.stat(filename)
+    stamp= (st.st_size, st.st_mtime)
+    if filename in _OPEN and _OPEN[filename][0] != stamp:
+        _OPEN.pop(filename)[1].close()
+    if filename not in _OPEN:
+        _OPEN[filename]= (stamp, BigWigFile(filename))
+    return(_OPEN[filename][1])
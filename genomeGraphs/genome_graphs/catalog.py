@@ -0,0 +1,138 @@
+"""Catalog of bam files with library size, index, sequence names and header hash.
+
+The catalog is a small sqlite database. Each bam is keyed by its absolute path,
+size and modification time so samtools is executed again only for new or
+modified bam files. A run where no bam changed doesn't execute samtools at all.
+"""
+
+import os
+import sqlite3
+import hashlib
+import subprocess
+import multiprocessing
+
+CATALOG_NAME= 'genomeGraphs_catalog.sqlite'
+
+class SampleCatalog(object):
+    """Library sizes and other info for bam files, stored in sqlite db_file.
+    The database is created if it doesn't exist, readable and writable only by
+    the user since the library sizes are trusted for --rpm.
+    """
+    def __init__(self, db_file):
+        self.db_file= db_file
+        self.refreshed= [] ## Bam files refreshed by the last call to refresh()
+        try:
+            os.close(os.open(db_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600))
+        except OSError:
+            ## Already there
+            pass
+        self.con= sqlite3.connect(db_file, timeout= 60)
+        self.con.execute('''CREATE TABLE IF NOT EXISTS samples (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            libsize INTEGER,
+            index_path TEXT,
+            chroms TEXT,
+            header_hash TEXT)''')
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def get(self, bam):
+        """Return the record for bam as a dict or None if bam is not in the
+        catalog or it has changed since it was stored.
+        """
+        path, size, mtime= file_key(bam)
+        cur= self.con.execute('SELECT size, mtime, libsize, index_path, chroms, header_hash FROM samples WHERE path = ?', (path,))
+        row= cur.fetchone()
+        if row is None or row[0] != size or row[1] != mtime:
+            return(None)
+        return({'path': path, 'size': size, 'mtime': mtime, 'libsize': row[2],
+            'index_path': row[3], 'chroms': row[4].split('\t') if row[4] else [],
+            'header_hash': row[5]})
+
+    def put(self, record):
+        self.con.execute('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (record['path'], record['size'], record['mtime'], record['libsize'],
+             record['index_path'], '\t'.join(record['chroms']), record['header_hash']))
+
+    def refresh(self, bams, samtools_path= '', jobs= 1):
+        """Make sure all the bams are in the catalog and up to date. Stale
+        entries are refreshed using up to jobs processes.
+        Return:
+            Dict {<bam>: <record>}
+        """
+        records= {}
+        stale= []
+        for bam in bams:
+            rec= self.get(bam)
+            if rec is None:
+                stale.append(bam)
+            else:
+                records[bam]= rec
+        if len(stale) > 1 and jobs > 1:
+            pool= multiprocessing.Pool(processes= min(jobs, len(stale)))
+            try:
+                new= pool.map(_bam_record_args, [(bam, samtools_path) for bam in stale])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            new= [bam_record(bam, samtools_path) for bam in stale]
+        for bam, rec in zip(stale, new):
+            self.put(rec)
+            records[bam]= rec
+        self.con.commit()
+        self.refreshed= stale
+        return(records)
+
+    def library_sizes(self, bams, samtools_path= '', jobs= 1):
+        """Return dict {<bam>: <library size>} like pympileup.getLibrarySizes
+        """
+        records= self.refresh(bams, samtools_path, jobs)
+        return(dict([(bam, records[bam]['libsize']) for bam in bams]))
+
+def file_key(bam):
+    """Return the tuple (path, size, mtime) identifying the current version of bam
+    """
+    st= os.stat(bam)
+    return((os.path.abspath(bam), st.st_size, st.st_mtime))
+
+def find_bam_index(bam):
+    """Return the path to the index of bam (<bam>.bai, <bam>.csi or
+    <bam without .bam>.bai) or None if not found.
+    """
+    for idx in [bam + '.bai', bam + '.csi', os.path.splitext(bam)[0] + '.bai']:
+        if os.path.isfile(idx):
+            return(os.path.abspath(idx))
+    return(None)
+
+def samtools_output(cmd):
+    proc= subprocess.Popen(cmd, stdout= subprocess.PIPE, stderr= subprocess.PIPE)
+    stdout, stderr= proc.communicate()
+    if proc.returncode != 0:
+        print('\n' + stderr)
+        raise Exception('Failed to execute:\n%s' %(' '.join(cmd)))
+    return(stdout)
+
+def bam_record(bam, samtools_path= ''):
+    """Collect the catalog record for bam running samtools idxstats and
+    samtools view -H. Library size is the number of mapped reads, as in
+    pympileup.getLibrarySizes
+    """
+    samtools= os.path.join(samtools_path, 'samtools')
+    path, size, mtime= file_key(bam)
+    idxstat= samtools_output([samtools, 'idxstats', bam]).strip().split('\n')
+    idxstat= [x.split('\t') for x in idxstat]
+    header= samtools_output([samtools, 'view', '-H', bam])
+    return({'path': path, 'size': size, 'mtime': mtime,
+        'libsize': sum([int(x[2]) for x in idxstat]),
+        'index_path': find_bam_index(bam),
+        'chroms': [x[0] for x in idxstat if x[0] != '*'],
+        'header_hash': hashlib.md5(header).hexdigest()})
+
+def _bam_record_args(args):
+    ## Pool.map passes a single argument
+    return(bam_record(*args))
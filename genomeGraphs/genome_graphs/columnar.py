@@ -0,0 +1,126 @@
+"""Binary table passed from Python to R, read with readBin by read_columns() in
+R_functions.R, much faster than read.table on large tables.
+
+Layout, all numbers little-endian:
+
+    GGCOLS1\\n                    8 bytes magic
+    <nrow> <ncol>                int32
+    For each column:
+        <name>\\0                 NUL-terminated string
+        <type>                   int32, one of INT, DOUBLE, STRING
+        INT:    nrow int32. NA is -2147483648, as NA_integer_ in R
+        DOUBLE: nrow float64. NA is NaN
+        STRING: <nlevels> int32, nlevels NUL-terminated strings, then nrow
+                int32 1-based indexes in the levels. NA is -2147483648
+
+Strings are stored as levels and codes since columns like chrom, file name and
+strand have few distinct values.
+"""
+
+import collections
+import numpy as np
+import spool
+
+MAGIC= 'GGCOLS1\n'
+INT= 1
+DOUBLE= 2
+STRING= 3
+NA_INTEGER= -2147483648
+
+class ColumnarError(Exception):
+    pass
+
+def factor(levels, codes):
+    """String column for write_columns() with values levels[codes]
+    levels:
+        List of strings
+    codes:
+        Array of 0-based indexes in levels, -1 for NA
+    """
+    return((list(levels), np.asarray(codes)))
+
+def constant(value, n):
+    """String column for write_columns() with n times value. value can be None
+    for NA
+    """
+    if value is None:
+        return(factor([], np.zeros(n, dtype= int) - 1))
+    return(factor([value], np.zeros(n, dtype= int)))
+
+def write_columns(filename, columns):
+    """Write the table columns to filename, a file name or a spool.Spool
+    columns:
+        List of tuples (<name>, <values>) with values an array of integers or
+        floats, or a string column from factor() or constant(). All columns
+        have the same length.
+    """
+    nrow= None
+    for name, values in columns:
+        n= len(values[1]) if isinstance(values, tuple) else len(values)
+        if nrow is not None and n != nrow:
+            raise ColumnarError('Column %s has %s rows, expected %s' %(name, n, nrow))
+        nrow= n
+    if nrow is None:
+        nrow= 0
+    fh= spool.open_write(filename, 'wb')
+    fh.write(MAGIC)
+    fh.write(np.array([nrow, len(columns)], dtype= '<i4').tostring())
+    for name, values in columns:
+        fh.write(str(name) + '\0')
+        if isinstance(values, tuple):
+            levels, codes= values
+            fh.write(np.array([STRING, len(levels)], dtype= '<i4').tostring())
+            for x in levels:
+                fh.write(str(x) + '\0')
+            fh.write(np.where(codes < 0, NA_INTEGER, codes + 1).astype('<i4').tostring())
+        elif np.asarray(values).dtype.kind in 'iub':
+            fh.write(np.array([INT], dtype= '<i4').tostring())
+            fh.write(np.asarray(values).astype('<i4').tostring())
+        else:
+            fh.write(np.array([DOUBLE], dtype= '<i4').tostring())
+            fh.write(np.asarray(values).astype('<f8').tostring())
+    fh.close()
+
+def read_columns(filename):
+    """Read a file written by write_columns(). Used by the python renderer and
+    for testing, the reader used by R is in R_functions.R
+    Return:
+        OrderedDict {<name>: <values>} with numeric columns as arrays and
+        string columns as lists with None for NA
+    """
+    fh= spool.open_read(filename, 'rb')
+    data= fh.read()
+    fh.close()
+    if not data.startswith(MAGIC):
+        raise ColumnarError('%s is not a binary columnar file' %(filename))
+    pos= len(MAGIC)
+    nrow, ncol= np.frombuffer(data, dtype= '<i4', count= 2, offset= pos)
+    pos += 8
+    columns= collections.OrderedDict()
+    for i in range(ncol):
+        end= data.index('\0', pos)
+        name= data[pos:end]
+        pos= end + 1
+        coltype= np.frombuffer(data, dtype= '<i4', count= 1, offset= pos)[0]
+        pos += 4
+        if coltype == INT:
+            values= np.frombuffer(data, dtype= '<i4', count= nrow, offset= pos).astype(int)
+            pos += 4 * nrow
+        elif coltype == DOUBLE:
+            values= np.frombuffer(data, dtype= '<f8', count= nrow, offset= pos).copy()
+            pos += 8 * nrow
+        elif coltype == STRING:
+            nlevels= np.frombuffer(data, dtype= '<i4', count= 1, offset= pos)[0]
+            pos += 4
+            levels= []
+            for j in range(nlevels):
+                end= data.index('\0', pos)
+                levels.append(data[pos:end])
+                pos= end + 1
+            codes= np.frombuffer(data, dtype= '<i4', count= nrow, offset= pos)
+            pos += 4 * nrow
+            values= [None if x == NA_INTEGER else levels[x - 1] for x in codes]
+        else:
+            raise ColumnarError('Invalid type %s of column %s in %s' %(coltype, name, filename))
+        columns[name]= values
+    return(columns)
@@ -0,0 +1,122 @@
+"""Read the reference sequence of a region from an indexed FASTA file,
+without bedtools getfasta.
+
+The file is memory-mapped and the bytes of the region are located with the
+offsets in the .fai index (as made by samtools faidx). See
+http://www.htslib.org/doc/faidx.html
+"""
+
+import os
+import mmap
+import numpy as np
+
+class FastaError(Exception):
+    pass
+
+class IndexedFasta(object):
+    """Memory-mapped FASTA file. The index <filename>.fai is read if present,
+    otherwise it is built in memory by scanning the file once.
+    Attributes:
+        index: Dict {<chrom>: (length, offset, line bases, line width)}
+    """
+    def __init__(self, filename):
+        self.filename= filename
+        self.fh= open(filename, 'rb')
+        if os.path.getsize(filename) > 0:
+            self.mm= mmap.mmap(self.fh.fileno(), 0, access= mmap.ACCESS_READ)
+        else:
+            self.mm= ''
+        fai= filename + '.fai'
+        if os.path.isfile(fai):
+            self.index= read_fai(fai)
+        else:
+            self.index= build_fai(self.mm)
+
+    def close(self):
+        if self.mm != '':
+            self.mm.close()
+        self.fh.close()
+
+    def fetch(self, chrom, start, end):
+        """Return the sequence in chrom:start-end (0-based, half-open) as a
+        numpy array of bytes (dtype uint8). The interval is clipped to the
+        length of chrom. If the sequence is on a single line of the file the
+        array is a view on the mapped file, otherwise only the line
+        terminators are dropped from the bytes spanning the interval.
+        Raise:
+            FastaError if chrom is not in the index
+        """
+        if chrom not in self.index:
+            raise FastaError('Sequence "%s" not found in %s' %(chrom, self.filename))
+        length, offset, line_bases, line_width= self.index[chrom]
+        start= max(start, 0)
+        end= min(end, length)
+        if start >= end:
+            return(np.zeros(0, dtype= np.uint8))
+        first= offset + (start // line_bases) * line_width + start % line_bases
+        last= offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases
+        buf= np.frombuffer(self.mm, dtype= np.uint8, count= last - first + 1, offset= first)
+        if start // line_bases == (end - 1) // line_bases:
+            return(buf)
+        ## Position of each byte within its line. Terminators are beyond line_bases
+        inline= (np.arange(len(buf)) + start % line_bases) % line_width
+        return(buf[inline < line_bases])
+
+def read_fai(fai):
+    index= {}
+    for line in open(fai):
+        line= line.rstrip('\n\r').split('\t')
+        if len(line) < 5:
+            continue
+        index[line[0]]= tuple([int(x) for x in line[1:5]])
+    return(index)
+
+def build_fai(mm):
+    """Index the mapped FASTA file mm like samtools faidx. All the lines of a
+    sequence but the last one are assumed to have the same length.
+    Return:
+        Dict as IndexedFasta.index
+    """
+    index= {}
+    pos= 0
+    size= len(mm)
+    while pos < size:
+        eol= mm.find('\n', pos)
+        if eol == -1:
+            eol= size
+        if mm[pos:pos+1] != '>':
+            raise FastaError('Expected a header line starting with ">" at byte %s' %(pos))
+        chrom= mm[pos+1:eol].split()[0]
+        offset= eol + 1
+        length= 0
+        line_bases= 0
+        line_width= 0
+        pos= offset
+        while pos < size and mm[pos:pos+1] != '>':
+            eol= mm.find('\n', pos)
+            if eol == -1:
+                eol= size
+            nbases= len(mm[pos:eol].rstrip('\r'))
+            if line_bases == 0:
+                line_bases= nbases
+                line_width= eol + 1 - pos
+            length += nbases
+            pos= eol + 1
+        index[chrom]= (length, offset, max(line_bases, 1), max(line_width, 1))
+    return(index)
+
+## One open file per FASTA and process, opened at the first use so that each
+## --jobs worker maps its own.
+_OPEN= {}
+
+def get_fasta(filename):
+    """Return the IndexedFasta for filename, opening it if necessary. The file
+    is opened again if it changed in the meantime.
+    """
+    st= os.stat(filename)
+    stamp= (st.st_size, st.st_mtime)
+    if filename in _OPEN and _OPEN[filename][0] != stamp:
+        _OPEN.pop(filename)[1].close()
+    if filename not in _OPEN:
+        _OPEN[filename]= (stamp, IndexedFasta(filename))
+    return(_OPEN[filename][1])
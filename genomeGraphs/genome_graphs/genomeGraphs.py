@@ -10,10 +10,20 @@ import glob
 import time
 import pycoverage
 import pympileup
+import rsession
+import catalog
+import bigwig
+import regioncache
+import pyrender
+import pdfstream
+import profiler
+import spool
 import validate_args
 import pybedtools
 import atexit
 import gzip
+import multiprocessing
+import traceback
 
 #from genomeGraphs.pycoverage import *
 #from genomeGraphs.validate_args import *
@@ -79,8 +89,9 @@ input_args.add_argument('--ibam', '-i',
                    default= [],
                    nargs= '+',
                    help='''List of input files for which coverage or annotation
-should be plotted. Bam files must be sorted and indexed. bedGraph files are
-taken as coverage all the other formats (bed, gtf, generic txt) are "annotation".
+should be plotted. Bam files must be sorted and indexed. bedGraph and bigWig
+(.bw, .bigWig, .bigwig) files are taken as coverage all the other formats (bed,
+gtf, generic txt) are "annotation".
 Input can be gzipped. Metacharacters are expanded by python (`glob`). E.g. to
 match all the bam files use '*.bam'. Use '-' to read the list of files from stdin.
                    ''')
@@ -112,15 +123,30 @@ input_args.add_argument('--samtools',
                     help='''Path to samtools. Default is '' which assumes it is
 on PATH''')
 
+input_args.add_argument('--engine',
+                    default= 'java',
+                    choices= pympileup.ENGINES,
+                    help='''How to count nucleotides in bam files. 'java' (default)
+pipes samtools mpileup to the java parser. 'native' reads the alignments
+in-process with pysam (requires pysam), no samtools or java needed.''')
+
+input_args.add_argument('--tabix',
+                    action= 'store_true',
+                    help='''Build a tabix index for the bedGraph, bed and gtf files
+which don't have one. A sorted and bgzip'd copy of each file is indexed in
+--cache_dir and reused in later runs. The least recently used copies are
+removed when they take more than 2 GB. Files with an index (.tbi or .csi) next
+to them are always accessed via the index, if pysam is available.''')
+
 input_args.add_argument('--parfile', '-pf',
                     default= None,
                     help='''_In prep_: Parameter file to get arguments from.''')
 
 input_args.add_argument('--sorted',
                     action= 'store_true',
-                    help='''Use bedtools' "chromsweep" algorithm to input -i
-sorted by position `sort -k1,1 -k2,2n`. Note that the -b input is always internally (re)sorted
-by bedtools.''')
+                    help='''The non-bam files in -i are sorted by position (e.g.
+`sort -k1,1 -k2,2n`): Filter them against the -b regions in a single
+streaming pass. Note that the -b input is always internally (re)sorted.''')
 
 
 # -----------------------------------------------------------------------------
@@ -137,7 +163,7 @@ output_args.add_argument('--onefile', '-o',
                    required= False,
                    default= None,
                    help='''If given, concatenate all the pdf figures into this
-output file (requires PyPDF2 package). 
+output file. Pages are appended as regions are done.
                    ''')
 
 output_args.add_argument('--tmpdir', '-t',
@@ -156,6 +182,33 @@ resolution while larger values more jagged profile. Default 1000.
 If nwinds < maxseq,  nwinds is reset to maxseq.  
 ''')
 
+output_args.add_argument('--keep_pileup',
+                   action= 'store_true',
+                   help='''Write the per-base counts of the bam files to
+*.mpileup.bed.txt in --tmpdir also for regions divided in windows (see
+--nwinds). By default counts are grouped by window as they are generated and
+the per-base file is written only for regions with up to --nwinds positions.
+''')
+
+output_args.add_argument('--in_memory',
+                   action= 'store_true',
+                   help='''Keep the intermediate files of each region (reference
+sequence, binned counts, non-bam tracks, pages of --onefile) in memory instead
+of --tmpdir, and intersect the pre-filtered non-bam files with the regions in
+memory instead of with bedtools. Only the plots are written. For batches of
+many regions. The region cache (--cache_size) is not used unless --cache_dir
+is given. Requires --renderer python.
+''')
+
+output_args.add_argument('--spill_mb',
+                   type= float,
+                   default= 64,
+                   help='''With --in_memory, intermediate data of a region larger
+than this many MB is moved to a temporary file, and pre-filtered non-bam files
+larger than this are intersected with bedtools as without --in_memory.
+Default 64.
+''')
+
 output_args.add_argument('--replot', 
                    action= 'store_true',
                    help='''Re-draw plots using the output files from a previous
@@ -169,18 +222,78 @@ output_args.add_argument('--rpm',
 sizes. Default is to use raw counts. (Only relevant to bam files).
 ''')
 
+output_args.add_argument('--cache_dir',
+                   default= None,
+                   help='''Directory for the catalog of bam files (library sizes
+for --rpm etc.). The catalog is reused across runs and samtools idxstats is
+executed only for new or modified bam files. Tabix indexes built by --tabix
+and the region cache (see --cache_size) also go here. Default
+~/.cache/genomeGraphs (or genomeGraphs in $XDG_CACHE_HOME), created readable
+only by the user. Do not use a directory other users can write to.
+''')
+
+output_args.add_argument('--cache_size',
+                   type= float,
+                   default= 1000,
+                   help='''Maximum size in MB of the cache of per-region files
+(binned bam counts and reference sequence) in --cache_dir. Entries are keyed by
+the input files, the region after --slop and the options affecting the counts,
+so re-running with different graphical options does not compute the pileup
+again. Least recently used entries are removed first. 0 disables the cache.
+Default 1000.
+''')
+
+output_args.add_argument('--r_session',
+                   action= 'store_true',
+                   help='''Render the plots in a persistent R process (one for each
+of --jobs) instead of starting Rscript for each region. The R helper functions
+are loaded only once. The R process is restarted if it crashes.
+''')
+
+output_args.add_argument('--renderer',
+                   default= 'R',
+                   choices= ['R', 'python'],
+                   help='''Draw the plots with R (default) or with the python
+package matplotlib, for systems without R. The python renderer honours the
+track and layout options except --rcode.
+''')
+
+output_args.add_argument('--format',
+                   default= 'pdf',
+                   choices= ['pdf', 'png', 'svg'],
+                   help='''Format of the figures. png and svg require --renderer
+python and cannot be used with --onefile. Default pdf.
+''')
+
 output_args.add_argument('--verbose', '-v',
                    action= 'store_true',
                    help='''Print verbose output. Currently this option only adds
 the stdout and stderr from R. Only useful for debugging.
 ''')
 
+output_args.add_argument('--profile',
+                   default= None,
+                   metavar= 'FILE',
+                   help='''Write to FILE the wall time, CPU time and peak memory of
+each stage of each region, one JSON record per line, and print a summary table
+at the end. See profiler.py for the fields.
+''')
+
 output_args.add_argument('--group_fun',
                    type= str,
                    default= 'mean',
+                   choices= pympileup.GROUP_FUNS,
                    help='''The function to group-by windows if the bedgraph or bam files
-generate ranges larger than --nwinds. Default 'mean'. See bedtools groupby for
-valid options.
+generate ranges larger than --nwinds. Default 'mean'.
+''')
+
+output_args.add_argument('--jobs', '-j',
+                   type= int,
+                   default= 1,
+                   help='''Number of regions to process in parallel. Each region
+(reference, pileup, intersections, plotting) is sent to a pool of this many
+worker processes. Output order is the same as with --jobs 1. The non-bam files
+are also pre-parsed in parallel, one file per worker. Default 1.
 ''')
 
 # -----------------------------------------------------------------------------
@@ -195,6 +308,30 @@ and to plot each nucleotide in different colour. Default 100 (i.e. regions small
 than 100 bp will be printed with colour coded nucleotides and the sequence will
 be shown).''')
 
+plot_coverage.add_argument('--full_counts',
+                    action= 'store_true',
+                    help='''Always count the individual nucleotides in bam files.
+By default, if the region is too large to show them (see --maxseq and
+--no_col_bases), only the depth on each strand is computed, which is much faster.
+Depth-only requires pysam, without it nucleotides are always counted.''')
+
+plot_coverage.add_argument('--max_depth_sample',
+                    type= int,
+                    default= 0,
+                    help='''Downsample the reads of bam files whose depth in the
+region is more than this, so that the largest depth is about this. Reads are
+selected by a hash of their name seeded with --sample_seed, so mates and
+repeated runs keep the same reads. Counts are scaled back to the full depth and
+downsampled tracks are marked in the plot. Useful for amplicon and viral loci
+with very high coverage. Regions plotted as depth only (see --full_counts) are
+not downsampled. With --engine java the reads are selected by samtools view -s.
+Requires pysam. Default 0, no downsampling.''')
+
+plot_coverage.add_argument('--sample_seed',
+                    type= int,
+                    default= 0,
+                    help='''Seed for --max_depth_sample. Default 0.''')
+
 plot_coverage.add_argument('--col_nuc', nargs= '+', default= [''], help='''Colour for the four
 nucleotides. _in prep_ File to the colour
 code for counts of the ACTGN (counts on + strand) and actgn (counts on - strand).
@@ -233,7 +370,8 @@ to use the same colour as for forward reads (i.e. turn it off)''')
 
 annotation_args.add_argument('--rcode', default= [''], nargs= '+',
     help='''A list of strings, one for each plot and recycled, that will be evaluated as R code at the end of each plot.
-Useful to annotate plots. E.g. "abline(h= 10)". Enclose each string in double-quotes and use single quotes for the R code inside (To be fixed).''')
+Useful to annotate plots. E.g. "abline(h= 10)". Enclose each string in double-quotes and use single quotes for the R code inside (To be fixed).
+Ignored by --renderer python.''')
 
 # -----------------------------------------------------------------------------
 plot_layout= parser.add_argument_group('Plot layout', '''
@@ -367,8 +505,436 @@ between 9 and 12 should suite most cases. Default 10.
 # END ARGPARSE
 # -----------------------------------------------------------------------------
 
-def main():
-    args = parser.parse_args()
+def region_name(region):
+    """Make a name for the output files of this region, stripped of
+    metacharacters. Format is <chrom>_<start>_<end>[_<name>]
+    """
+    regname= '_'.join([str(x) for x in [region.chrom, region.start, region.end]])
+    if region.name != '' and region.name != '.':
+        regname = regname + '_' + region.name
+    regname= re.sub('[^a-zA-Z0-9_\.\-\+]', '_', regname) ## Get rid of metachar to make sensible file names
+    return(regname)
+
+## Overlapping regions are piled up together only while their cluster is not
+## wider than this, so that tiled windows don't chain into a single pileup of
+## the whole chromosome
+MAX_CLUSTER_WIDTH= 1000000
+
+## The pileup of a cluster is a dense array with one row per base and
+## len(pympileup.COUNT_HEADER) int64 counts per bam file, so the cluster width
+## is also capped to keep that array within this many bytes. The budget is per
+## worker process, each of --jobs holds one cluster pileup at a time.
+MAX_CLUSTER_BYTES= 256 * 1024 * 1024
+
+def max_cluster_width(nbams):
+    """Width of the widest cluster whose pileup of nbams bam files fits in
+    MAX_CLUSTER_BYTES, never more than MAX_CLUSTER_WIDTH.
+    """
+    bytes_per_base= len(pympileup.COUNT_HEADER) * 8 * max(nbams, 1)
+    return(max(min(MAX_CLUSTER_WIDTH, MAX_CLUSTER_BYTES // bytes_per_base), 1))
+
+def cluster_regions(regions, slop, nbams= 1):
+    """Group the regions whose slopped intervals overlap, so that the bam files
+    are piled up once for all the regions in a cluster. Like bedtools merge
+    but bookended intervals are not joined and clusters are split when wider
+    than max_cluster_width(nbams).
+    regions:
+        List of fields of the bed regions
+    slop:
+        Slop passed to pycoverage.slopbed()
+    nbams:
+        Number of bam files piled up for each cluster
+    Return:
+        List of clusters. Each cluster is a list of (<index in regions>,
+        <region fields>)
+    """
+    max_width= max_cluster_width(nbams)
+    slopped= []
+    for i, fields in enumerate(regions):
+        x= pycoverage.slopbed(pybedtools.create_interval_from_list(list(fields)), slop)
+        slopped.append((x.chrom, x.start, x.end, i))
+    slopped.sort()
+    clusters= []
+    chrom, start, end= None, None, None
+    for xchrom, xstart, xend, i in slopped:
+        if xchrom == chrom and xstart < end and max(end, xend) - start <= max_width:
+            end= max(end, xend)
+            clusters[-1].append((i, regions[i]))
+        else:
+            chrom, start, end= xchrom, xstart, xend
+            clusters.append([(i, regions[i])])
+    return(clusters)
+
+## Shared, read-only state for process_region(). Set by init_worker() in each
+## worker process (or in the main process if --jobs is 1).
+_CONTEXT= {}
+
+def init_worker(context, worker_tmpdir= False):
+    """Set the state shared by all the regions processed by this process.
+    context:
+        Dict of arguments to process_region(), see main()
+    worker_tmpdir:
+        If True, create a tmp dir inside context['tmpdir'] private to this
+        process and use it for all the pybedtools and tempfile files. Used by the
+        processes of the --jobs pool so that they don't step on each other.
+    """
+    _CONTEXT.clear()
+    _CONTEXT.update(context)
+    if worker_tmpdir:
+        wdir= tempfile.mkdtemp(prefix= 'worker_', dir= context['tmpdir'])
+        tempfile.tempdir= wdir
+        pybedtools.set_tempdir(wdir)
+
+def depth_only(args, region):
+    """True if only the depth of the bam files is needed for region (pysam
+    required), False if the individual nucleotides are plotted.
+    """
+    if args.full_counts:
+        return(False)
+    try:
+        import pysam
+    except ImportError:
+        return(False)
+    ## Same test as in R_template.R to colour nucleotides, where
+    ## xlim= c(start - 1, end)
+    return(args.no_col_bases or (region.end - region.start + 1) >= args.maxseq)
+
+def downsampled_names(names, inputlist, fractions):
+    """Track names with the downsampled bam files marked by the percentage of
+    reads kept, e.g. 'ds051.actb.bam (downsampled to 2.5%)'
+    names:
+        Names of the tracks, recycled to the length of inputlist. None for the
+        default, the file name
+    fractions:
+        Dict {<bam>: <fraction of reads kept>}, see
+        pympileup.read_sample_fractions()
+    """
+    if fractions == {}:
+        return(names)
+    marked= []
+    for i, x in enumerate(inputlist):
+        name= names[i % len(names)]
+        if x in fractions:
+            if name is None:
+                name= os.path.basename(x)
+            name= '%s (downsampled to %.2g%%)' %(name, 100 * fractions[x])
+        marked.append(name)
+    return(marked)
+
+def spill_size(args):
+    """--spill_mb in bytes
+    """
+    return(int(args.spill_mb * 1024 * 1024))
+
+def nonbam_source(args, nonbam):
+    """What to intersect with the regions for the pre-filtered non-bam file
+    nonbam: the file itself or, with --in_memory, its pycoverage.IntervalFile
+    if the file is not larger than --spill_mb
+    """
+    if args.in_memory and os.path.getsize(nonbam) <= spill_size(args):
+        return(pycoverage.get_interval_file(nonbam))
+    return(nonbam)
+
+def bam_cache_key(ctx, xregion):
+    """Key in the regioncache.RegionCache of the binned bam counts for the
+    slopped region xregion
+    """
+    args= ctx['args']
+    return(regioncache.cache_key('bam', VERSION, ctx['bam_ids'], ctx['fasta_id'],
+        xregion.chrom, xregion.start, xregion.end, ctx['nwinds'], args.group_fun,
+        args.rpm, args.engine, depth_only(args, xregion), args.max_depth_sample, args.sample_seed))
+
+def process_region(region, pileup= None):
+    """Prepare the intermediate files for one bed region and plot them.
+    region:
+        pybedtools.Interval to plot
+    pileup:
+        Pileup of the bam files for an interval containing the slopped
+        region, see process_cluster()
+    Return:
+        Name of the pdf file produced in tmpdir. With --in_memory, the name of
+        the final plot in outdir or, for --onefile, the content of the pdf.
+    Raise:
+        pycoverage.RPlotError if R fails
+    """
+    ctx= _CONTEXT
+    args= ctx['args']
+    tmpdir= ctx['tmpdir']
+    bamlist= ctx['bamlist']
+    nonbamlist= ctx['nonbamlist']
+    nonbam_dict= ctx['nonbam_dict']
+    nwinds= ctx['nwinds']
+    outdir= ctx['outdir']
+
+    print('Processing: %s' %(str(region).strip()))
+    bstart= region.start
+    bend= region.end
+    regname= region_name(region)
+    xregion= pycoverage.slopbed(region, ctx['slop'])
+    
+    ## --------------------[ Prepare output file names ]-------------------
+    
+    fasta_seq_name= os.path.join(tmpdir, regname + '.seq.txt')
+    if bamlist != []:
+        mpileup_name= os.path.join(tmpdir, regname + '.mpileup.bed.txt')
+        mpileup_grp_name= os.path.join(tmpdir, regname + '.grp.bin')
+    else:
+        mpileup_name= ''
+        mpileup_grp_name= ''
+    if nonbamlist != []:
+        non_bam_name= os.path.join(tmpdir, regname + '.nonbam.bed.txt')
+    else:
+        non_bam_name= ''
+    pdffile= os.path.join(tmpdir, regname + '.' + args.format)
+    final_pdffile= os.path.join(outdir, regname + '.' + args.format)
+    rscript= os.path.join(tmpdir, regname + '.R')
+    if args.in_memory:
+        ## Same data as above in spool.Spool objects. The plot goes straight
+        ## to outdir
+        fasta_seq_name= spool.Spool(spill_size(args))
+        if bamlist != []:
+            mpileup_name= None
+            mpileup_grp_name= spool.Spool(spill_size(args))
+        if nonbamlist != []:
+            non_bam_name= spool.Spool(spill_size(args))
+        if ctx['onefile']:
+            pdffile= spool.Spool(spill_size(args))
+        else:
+            pdffile= final_pdffile
+        spools= [x for x in [fasta_seq_name, mpileup_grp_name, non_bam_name, pdffile] if isinstance(x, spool.Spool)]
+    else:
+        spools= []
+    try:
+        cache= ctx['region_cache']
+        if not args.replot:
+            ref_key= regioncache.cache_key('ref', ctx['fasta_id'], xregion.chrom, xregion.start, xregion.end,
+                (xregion.end - xregion.start) <= args.maxseq)
+            with profiler.stage('reference'):
+                if cache is None or not cache.get(ref_key, '.seq.txt', fasta_seq_name):
+                    pycoverage.prepare_reference_fasta(fasta_seq_name, args.maxseq, xregion, args.fasta) ## Create reference file even if header only
+                    if cache is not None:
+                        cache.put(ref_key, '.seq.txt', fasta_seq_name)
+            ## ----------------------- BAM FILES -------------------------------
+            ## At the end of this session you have *.grp.bin (binary table in long
+            ## format read by R). The per-base *.mpileup.bed.txt is produced only
+            ## for regions not divided in windows or with --keep_pileup, and not
+            ## if *.grp.bin comes from the cache.
+            with profiler.stage('bam'):
+                if bamlist != []:
+                    bam_key= bam_cache_key(ctx, xregion)
+                    if cache is None or not cache.get(bam_key, '.grp.bin', mpileup_grp_name):
+                        pympileup.bamlist_to_mpileup(mpileup_name, mpileup_grp_name,
+                            bamlist, xregion, nwinds, args.fasta, args.rpm,
+                            samtools= args.samtools, groupFun= args.group_fun, engine= args.engine,
+                            libsizes= ctx['libsizes'], depth_only= depth_only(args, xregion),
+                            pileup= pileup, keep_pileup= args.keep_pileup,
+                            max_depth_sample= args.max_depth_sample, sample_seed= args.sample_seed) ## Produce mpileup matrix
+                        if cache is not None:
+                            cache.put(bam_key, '.grp.bin', mpileup_grp_name)
+                else:
+                    mpileup_grp_name= ''
+        
+            ## ----------------------NON BAM FILES -----------------------------
+            ## Produce coverage and annotation files for non-bam files. One output
+            ## file prooduced with format
+            ## chrom, start, end, file_name, A, C, G, T, Z.
+            ## NB: A,C,G,T are always NA. We keep them only for compatibility
+            ## with the output form BAM files. The `score` or `name` column from
+            ## bed files (4th) goes to column Z.
+            ## file_name has the name of the file as it has been passed to --ibam
+            with profiler.stage('nonbam'):
+                if nonbamlist != []:
+                    non_bam_fh= spool.open_write(non_bam_name) ## Here all the files concatenated.
+                    for x in nonbamlist:
+                        if bigwig.is_bigwig(x):
+                            ## Read directly, no need to pre-filter
+                            nlines= pycoverage.compressBigWig(xregion, nwinds, x, use_file_name= x,
+                                bedgraph_grp_fh= non_bam_fh, groupFun= args.group_fun)
+                            continue
+                        nonbam= nonbam_source(args, nonbam_dict[x])
+                        if x.endswith('.bedGraph') or x.endswith('.bedGraph.gz'):
+                            ## Compressed by windows if more than nwinds intervals
+                            nlines= pycoverage.compressBedGraph(xregion, nwinds, nonbam, use_file_name= x,
+                                bedgraph_grp_fh= non_bam_fh, groupFun= args.group_fun)
+                        else:
+                            nlines= pycoverage.prepare_nonbam_file(nonbam, non_bam_fh, xregion, use_file_name= x) ## Write to fh the overlaps btw nonbam and region. Return no. lines
+                    non_bam_fh.close()
+                else:
+                    non_bam_name= ''
+        # ----------------------------------------------------------------------
+        # Plotting 
+        # ----------------------------------------------------------------------
+        names= ctx['names']
+        if args.max_depth_sample > 0 and mpileup_grp_name != '':
+            names= downsampled_names(names, ctx['inputlist_all'], pympileup.read_sample_fractions(mpileup_grp_name))
+        if args.renderer == 'python':
+            with profiler.stage('plot'):
+                pyrender.plot_region(pdffile, args, ctx['inputlist_all'], names,
+                    mcov= mpileup_grp_name, nonbam= non_bam_name, refbases= fasta_seq_name,
+                    bstart= bstart, bend= bend, xregion= xregion)
+        else:
+            if args.r_session:
+                rsess= rsession.get_session()
+            else:
+                rsess= None
+            rgraph= pycoverage.RPlot(
+                  rsession= rsess,
+                  inputlist= pycoverage.quoteStringList(ctx['inputlist_all']),
+                  count_header= pycoverage.quoteStringList(pympileup.COUNT_HEADER),
+                  pdffile= pdffile,
+                  rscript= rscript,
+                  mcov= mpileup_grp_name,
+                  nonbam= non_bam_name,
+                  refbases= fasta_seq_name,
+                  title= pycoverage.quoteStringList([str(args.title)]),
+                  cex_title= args.cex_title,
+                  pheight= args.pheight,
+                  pwidth= args.pwidth,
+                  psize= args.psize,
+                  ylab= pycoverage.quoteStringList(args.ylab),
+                  cex_lab= pycoverage.quoteStringList(args.cex_lab),
+                  col_yaxis= pycoverage.quoteStringList(args.col_yaxis),
+                  bstart= bstart,
+                  bend= bend,
+                  xlim1= xregion.start,
+                  xlim2= xregion.end,
+                  maxseq= args.maxseq,
+                  ymax= pycoverage.quoteStringList(args.ymax),
+                  ymin= pycoverage.quoteStringList(args.ymin),
+                  chrom= pycoverage.quoteStringList([xregion.chrom]),
+                  vheights= pycoverage.quoteStringList(args.vheights),
+                  mar_heights= pycoverage.quoteStringList(args.mar_heights),
+                  cex= args.cex,
+                  cex_axis= args.cex_axis,
+                  col_mark= pycoverage.quoteStringList(args.col_mark),
+                  col_line= pycoverage.quoteStringList(args.col_line),
+                  lwd= pycoverage.quoteStringList(args.lwd),
+                  col_track= pycoverage.quoteStringList(args.col_track),
+                  col_track_rev= pycoverage.quoteStringList(args.col_track_rev),
+                  col_nuc= pycoverage.quoteStringList(args.col_nuc),
+                  no_col_bases= args.no_col_bases,
+                  bg= pycoverage.quoteStringList(args.bg),
+                  fbg= pycoverage.quoteStringList([args.fbg]),
+                  col_grid= pycoverage.quoteStringList(args.col_grid),
+                  col_text_ann= pycoverage.quoteStringList(args.col_text_ann),
+                  names= pycoverage.quoteStringList(names),
+                  col_names= pycoverage.quoteStringList(args.col_names),
+                  cex_names= args.cex_names,
+                  # cex_range= args.cex_range,
+                  cex_seq= args.cex_seq,
+                  col_seq= pycoverage.quoteStringList([args.col_seq]),
+                  mar= ', '.join([str(x) for x in [0, args.mar, 0.2, 1]]),
+                  col_all= args.col_all,
+                  rcode= pycoverage.quoteStringList(args.rcode),
+                  overplot= pycoverage.quoteStringList(args.overplot)
+                  )
+    
+            if rgraph['returncode'] != 0:
+                raise pycoverage.RPlotError('Exception in executing R script "%s"; returncode: %s\n** Captured stdout:\n%s\n** Captured stderr:\n%s' %(rscript, rgraph['returncode'], rgraph['stdout'], rgraph['stderr']))
+            if args.verbose:
+                print(rgraph['stderr'])
+                print(rgraph['stdout'])
+        if args.in_memory:
+            if ctx['onefile']:
+                return(pdffile.getvalue())
+        elif not ctx['onefile'] and tmpdir != outdir:
+            ## Copy PDFs from temp dir to output dir. Unless you want them in onefile or
+            ## if the final destination dir has been set to be also the tempdir
+            shutil.copyfile(pdffile, final_pdffile)
+        return(pdffile)
+    finally:
+        ## Spilled spools hold a temp file, also when the region fails
+        for x in spools:
+            x.close()
+
+def process_region_safe(fields, pileup= None):
+    """Wrapper around process_region(). A failing region does not stop the
+    other ones.
+    fields:
+        List of fields of the bed region. Intervals are passed as lists because
+        they have to be pickled to the --jobs workers.
+    Return:
+        Tuple (<region name>, <pdf file or None>, <error message or None>).
+        See process_region() for the pdf file with --in_memory
+    """
+    region= pybedtools.create_interval_from_list(fields)
+    profiler.set_region(region_name(region))
+    try:
+        with profiler.stage('region'):
+            pdffile= process_region(region, pileup)
+    except Exception:
+        return((region_name(region), None, traceback.format_exc()))
+    finally:
+        profiler.set_region(None)
+    return((region_name(region), pdffile, None))
+
+def process_cluster(cluster):
+    """Process the regions of one cluster from cluster_regions(), to be
+    mapped to the clusters. If more than one region of the cluster is not in
+    the region cache, the bam files are piled up once over these regions and
+    each region is sliced from it. The pileup has the individual nucleotides
+    if any region needs them.
+    Return:
+        List of tuples (<index of region>, <region name>, <pdf file or None>,
+        <error message or None>)
+    """
+    ctx= _CONTEXT
+    args= ctx['args']
+    bamlist= ctx['bamlist']
+    cache= ctx['region_cache']
+    pileup= None
+    if bamlist != [] and not args.replot and len(cluster) > 1 and args.max_depth_sample == 0:
+        xregions= [pycoverage.slopbed(pybedtools.create_interval_from_list(fields), ctx['slop']) for i, fields in cluster]
+        if cache is not None:
+            xregions= [x for x in xregions if not cache.contains(bam_cache_key(ctx, x), '.grp.bin')]
+        if len(xregions) > 1:
+            xcluster= pybedtools.Interval(xregions[0].chrom, min([x.start for x in xregions]), max([x.end for x in xregions]))
+            try:
+                with profiler.stage('cluster_pileup', region= region_name(xcluster)):
+                    pileup= pympileup.pileup_region(bamlist, xcluster, args.fasta, args.samtools, engine= args.engine,
+                        depth_only= all([depth_only(args, x) for x in xregions]))
+            except Exception:
+                ## Let each region pile up and report its own error
+                pileup= None
+    results= []
+    for i, fields in cluster:
+        results.append((i,) + process_region_safe(fields, pileup))
+    return(results)
+
+def prefilter_nonbam(task):
+    """Filter one non-bam file with pycoverage.prefilter_nonbam_multiproc().
+    Temporary files of bedtools go to a scratch dir in tmpdir removed as soon
+    as the file is done, so they don't pile up while filtering many files.
+    task:
+        Tuple (nonbam, name of merged regions bed file, tmpdir, cache_dir,
+        args.sorted, args.tabix)
+    Return:
+        Tuple (nonbam, name of filtered file)
+    """
+    nonbam, inbed, tmpdir, cache_dir, sorted, build_tabix= task
+    scratch= tempfile.mkdtemp(prefix= 'prefilter_', dir= tmpdir)
+    old_tempdir= tempfile.tempdir
+    old_bedtools_tempdir= pybedtools.get_tempdir()
+    tempfile.tempdir= scratch
+    pybedtools.set_tempdir(scratch)
+    try:
+        with profiler.stage('prefilter_file', region= nonbam):
+            tabix= pycoverage.tabix_file(nonbam, cache_dir, build= build_tabix)
+            x_name= pycoverage.prefilter_nonbam_multiproc(nonbam= nonbam, inbed= pybedtools.BedTool(inbed),
+                tmpdir= tmpdir, sorted= sorted, tabix= tabix)
+    finally:
+        tempfile.tempdir= old_tempdir
+        pybedtools.set_tempdir(old_bedtools_tempdir)
+        shutil.rmtree(scratch, ignore_errors= True)
+    return((nonbam, x_name))
+
+def parse_arguments(argv= None):
+    """Parse the command line arguments argv (default sys.argv) and check them.
+    Exit with a message if they are not valid.
+    Return:
+        Tuple (args, slop, nwinds)
+    """
+    args = parser.parse_args(argv)
     if args.parfile:
         pf= pycoverage.read_parfile(args.parfile)
         if not pf:
@@ -412,6 +978,41 @@ def main():
         nwinds= args.nwinds
     if args.replot and args.tmpdir is None:
         sys.exit('\nCannot replot without a working (--tmpdir) directory!\n')
+    if args.jobs < 1:
+        sys.exit('\n--jobs must be >= 1. Got %s\n' %(args.jobs))
+    if args.max_depth_sample < 0:
+        sys.exit('\n--max_depth_sample must be >= 0. Got %s\n' %(args.max_depth_sample))
+    if args.engine == 'native' or args.tabix or args.max_depth_sample > 0:
+        try:
+            import pysam
+        except ImportError:
+            sys.exit('''\nModule pysam could not be imported. Either install it
+(see https://pypi.python.org/pypi/pysam ) or use --engine java and no --tabix
+or --max_depth_sample.\n''')
+    if args.renderer == 'python':
+        try:
+            import matplotlib
+        except ImportError:
+            sys.exit('''\nModule matplotlib could not be imported. Either install it
+(see https://pypi.python.org/pypi/matplotlib ) or use --renderer R.\n''')
+    elif args.format != 'pdf':
+        sys.exit('\n--format %s requires --renderer python\n' %(args.format))
+    if args.in_memory:
+        if args.renderer != 'python':
+            sys.exit('\n--in_memory requires --renderer python\n')
+        if args.replot or args.keep_pileup:
+            sys.exit('\n--in_memory cannot be used with --replot or --keep_pileup\n')
+        if args.spill_mb < 0:
+            sys.exit('\n--spill_mb must be >= 0. Got %s\n' %(args.spill_mb))
+    return((args, slop, nwinds))
+
+def input_files(args):
+    """Files to plot from --ibam.
+    Return:
+        Tuple (inputlist_all, inputlist, bamlist, nonbamlist, names) with
+        inputlist_all the files as given, possibly repeated, inputlist
+        without duplicates and names the track names
+    """
     if args.ibam == ['-']:
         inputlist_all= [x.strip() for x in sys.stdin.readlines()]
     else:
@@ -420,6 +1021,17 @@ def main():
     bamlist= [x for x in inputlist if x.endswith('.bam')]
     nonbamlist= [x for x in inputlist if not x.endswith('.bam')]
     names= validate_args.parse_names(args.names, inputlist_all)
+    return((inputlist_all, inputlist, bamlist, nonbamlist, names))
+
+def main():
+    if sys.argv[1:2] == ['serve']:
+        import server
+        server.main(sys.argv[2:])
+        return
+    args, slop, nwinds= parse_arguments()
+    if args.profile:
+        profiler.enable(args.profile, truncate= True)
+    inputlist_all, inputlist, bamlist, nonbamlist, names= input_files(args)
     if not args.replot:
         print('\nFiles to analyze (%s found):\n%s\n' %(len(inputlist), ', '.join(inputlist)))
     if len(inputlist) == 0 and not args.replot:
@@ -441,11 +1053,8 @@ def main():
     else:
         onefile= True
         outdir= os.path.split(args.onefile)[0]
-        try:
-            import PyPDF2
-        except ImportError:
-            sys.exit('''\nModule PyPDF2 could not be imported. Eiher installed it
-(see https://pypi.python.org/pypi/PyPDF2 ) or avoid using the --onefile option.\n''')
+        if args.format != 'pdf':
+            sys.exit('\n--onefile requires --format pdf\n')
             
     ## Temp dir to dump intermediate files.
     ## -------------------------------------------------------------------------
@@ -456,15 +1065,35 @@ def main():
         tmpdir= args.tmpdir
         if not os.path.exists(tmpdir):
             os.makedirs(tmpdir)
-    
-    outputPDF= [] ## List of all the pdf files generated. Used only for --onefile
         
     ## -------------------------------------------------------------------------
+    if args.cache_dir is None:
+        cache_dir= regioncache.user_cache_dir()
+    else:
+        cache_dir= args.cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+    libsizes_dict= None
     if args.rpm and not args.replot:
         sys.stdout.write('Getting library sizes... ')
-        libsizes_dict= pympileup.getLibrarySizes(bamlist, args.samtools)
+        with profiler.stage('library_sizes'):
+            sample_catalog= catalog.SampleCatalog(os.path.join(cache_dir, catalog.CATALOG_NAME))
+            libsizes_dict= sample_catalog.library_sizes(bamlist, args.samtools, jobs= args.jobs)
+            sample_catalog.close()
         libsizes= [libsizes_dict[x] for x in bamlist]
         print(', '.join([str(x) for x in libsizes]))
+    ## With --in_memory the cache would write the files the option avoids,
+    ## unless asked for with an explicit --cache_dir
+    if args.cache_size > 0 and not args.replot and not (args.in_memory and args.cache_dir is None):
+        region_cache= regioncache.RegionCache(cache_dir, int(args.cache_size * 1024 * 1024))
+        bam_ids= [regioncache.file_identity(x) for x in bamlist]
+    else:
+        region_cache= None
+        bam_ids= []
+    if args.fasta and not args.replot:
+        fasta_id= regioncache.file_identity(args.fasta)
+    else:
+        fasta_id= None
     if args.bed == '-':
         inbed= sys.stdin
         fh= pycoverage.stdin_inbed_to_fh(inbed)
@@ -479,169 +1108,106 @@ def main():
     # ---------------------[ Pre-filter non-bam files ]-------------------------
     
     xinbed= pybedtools.BedTool(inbed).each(pycoverage.slopbed, slop).sort().merge().saveas()
-    ## BigWigs: Pass them through bigWigToBedGraph.py and replace the output name
-    ## in nonbamlist. exts: .bw, .bigWig, .bigwig 
+    ## BigWigs are read directly for each region, see bigwig.py
     nonbam_dict= {}
-    for nonbam in nonbamlist:
-        print('Pre-parsing %s' %(nonbam))
-        nonbam_dict[nonbam]= pycoverage.prefilter_nonbam_multiproc(nonbam= nonbam, inbed= xinbed, tmpdir= tmpdir, sorted= args.sorted)
+    tasks= [(nonbam, xinbed.fn, tmpdir, cache_dir, args.sorted, args.tabix) for nonbam in nonbamlist if not bigwig.is_bigwig(nonbam)]
+    if args.jobs > 1 and len(tasks) > 1:
+        pool= multiprocessing.Pool(processes= min(args.jobs, len(tasks)))
+        prefiltered= pool.imap_unordered(prefilter_nonbam, tasks)
+    else:
+        pool= None
+        prefiltered= (prefilter_nonbam(x) for x in tasks)
+    try:
+        with profiler.stage('prefilter'):
+            for nonbam, x_name in prefiltered:
+                nonbam_dict[nonbam]= x_name
+                print('Pre-parsed %s (%s of %s)' %(nonbam, len(nonbam_dict), len(tasks)))
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    ## Read the files to intersect in memory now, so that the --jobs workers
+    ## share them
+    for x_name in nonbam_dict.values():
+        nonbam_source(args, x_name)
 
     # -----------------------[ Loop thorugh regions ]----------------------------
-    for region in inbed:
-        print('Processing: %s' %(str(region).strip()))
-        bstart= region.start
-        bend= region.end
-        regname= '_'.join([str(x) for x in [region.chrom, bstart, bend]])
-        if region.name != '' and region.name != '.':
-            regname = regname + '_' + region.name
-        regname= re.sub('[^a-zA-Z0-9_\.\-\+]', '_', regname) ## Get rid of metachar to make sensible file names
-        xregion= pycoverage.slopbed(region, slop)
-        
-        ## --------------------[ Prepare output file names ]-------------------
-        
-        fasta_seq_name= os.path.join(tmpdir, regname + '.seq.txt')
-        if bamlist != []:
-            mpileup_name= os.path.join(tmpdir, regname + '.mpileup.bed.txt')
-            mpileup_grp_name= os.path.join(tmpdir, regname + '.grp.bed.txt')
-        else:
-            mpileup_name= ''
-            mpileup_grp_name= ''
-        if nonbamlist != []:
-            non_bam_name= os.path.join(tmpdir, regname + '.nonbam.bed.txt')
-        else:
-            non_bam_name= ''
-        pdffile= os.path.join(tmpdir, regname + '.pdf')
-        final_pdffile= os.path.join(outdir, regname + '.pdf')
-        rscript= os.path.join(tmpdir, regname + '.R')
-        if not args.replot:
-            pycoverage.prepare_reference_fasta(fasta_seq_name, args.maxseq, xregion, args.fasta) ## Create reference file even if header only
-            ## ----------------------- BAM FILES -------------------------------
-            ## At the end of this session you have *.grp.bed.txt (matrix-like
-            ## file read by R)
-            regionWindowsDone= False ## In previous versions this var was regionWindows itself.
-                                    ## However just checking `if regionWindows`
-                                    ## consumes a file handle which is never closed!!
-            if bamlist != []:
-                if not regionWindowsDone:
-                    regionWindows= pycoverage.makeWindows(xregion, nwinds) ## bed interval divided into nwinds intervals by bedtools windowMaker
-                    regionWindowsDone= True
-                pympileup.bamlist_to_mpileup(mpileup_name, mpileup_grp_name,
-                    bamlist, xregion, nwinds, args.fasta, args.rpm, regionWindows,
-                    samtools= args.samtools, groupFun= args.group_fun) ## Produce mpileup matrix
-            else:
-                mpileup_grp_name= ''
-            
-            ## ----------------------NON BAM FILES -----------------------------
-            ## Produce coverage and annotation files for non-bam files. One output
-            ## file prooduced with format
-            ## chrom, start, end, file_name, A, C, G, T, Z.
-            ## NB: A,C,G,T are always NA. We keep them only for compatibility
-            ## with the output form BAM files. The `score` or `name` column from
-            ## bed files (4th) goes to column Z.
-            ## file_name has the name of the file as it has been passed to --ibam
-            if nonbamlist != []:
-                non_bam_fh= open(non_bam_name, 'w') ## Here all the files concatenated.
-                for x in nonbamlist:
-                    nonbam= nonbam_dict[x]
-                    if x.endswith('.bedGraph') or x.endswith('.bedGraph.gz'):
-                        """Bedgraph needs to go to tmp file because you don't know if
-                        it has to be compressed by windows or not. <- This should be
-                        changed: You have already intersected the nonbam files with
-                        the bed regions.
-                        """
-                        tmpfh= tempfile.NamedTemporaryFile(dir= tmpdir, suffix= 'nonbam.tmp.bed', delete= False)
-                        tmp_name= tmpfh.name
-                        nlines= pycoverage.prepare_nonbam_file(nonbam, tmpfh, xregion, use_file_name= x) ## Write to fh the overlaps btw nonbam and region. Return no. lines
-                        tmpfh.close()
-                        if nlines > nwinds:
-
-                            if not regionWindowsDone:
-                                regionWindows= pycoverage.makeWindows(xregion, nwinds)
-                                regionWindowsDone= True
-                            pycoverage.compressBedGraph(regionWindows, tmp_name, use_file_name= x, bedgraph_grp_fh= non_bam_fh, col_idx= 4 + len(pympileup.COUNT_HEADER),
-                                groupFun= args.group_fun)
+    context= {'args': args,
+              'slop': slop,
+              'nwinds': nwinds,
+              'tmpdir': tmpdir,
+              'outdir': outdir,
+              'onefile': onefile,
+              'bamlist': bamlist,
+              'nonbamlist': nonbamlist,
+              'nonbam_dict': nonbam_dict,
+              'libsizes': libsizes_dict,
+              'region_cache': region_cache,
+              'bam_ids': bam_ids,
+              'fasta_id': fasta_id,
+              'inputlist_all': inputlist_all,
+              'names': names}
+    regions= [region.fields for region in inbed]
+    ## Regions sharing bases are piled up together, so each cluster goes to
+    ## one process
+    clusters= cluster_regions(regions, slop, len(bamlist))
+    if args.jobs > 1 and len(clusters) > 1:
+        pool= multiprocessing.Pool(processes= min(args.jobs, len(clusters)), initializer= init_worker, initargs= (context, True))
+        results= pool.imap(process_cluster, clusters, chunksize= 1)
+    else:
+        pool= None
+        init_worker(context)
+        results= (process_cluster(x) for x in clusters)
+    failed= []
+    done= [False] * len(regions)
+    ## Pages of --onefile are appended in the order of the regions, as soon as
+    ## all the preceding regions are done, so the output is deterministic and
+    ## the region pdfs do not pile up in tmpdir
+    pdfout= None
+    npages= 0
+    try:
+        for cluster_results in results:
+            for i, regname, pdffile, error in cluster_results:
+                if error is not None:
+                    sys.stderr.write('\ngenomeGraphs: Failed to process region %s:\n%s\n' %(regname, error))
+                    failed.append(regname)
+                    done[i]= None
+                else:
+                    done[i]= (regname, pdffile)
+            while onefile and npages < len(done) and done[npages] is not False:
+                if done[npages] is not None:
+                    regname, pdffile= done[npages]
+                    if pdfout is None:
+                        pdfout= pdfstream.PdfStream(args.onefile)
+                    with profiler.stage('onefile', region= regname):
+                        if args.in_memory:
+                            pdfout.add_pdf(regname, data= pdffile)
                         else:
-                            fh= open(tmp_name)
-                            for line in fh:
-                                non_bam_fh.write(line)
-                        os.remove(tmp_name)
-                    else:
-                        nlines= pycoverage.prepare_nonbam_file(nonbam, non_bam_fh, xregion, use_file_name= x) ## Write to fh the overlaps btw nonbam and region. Return no. lines
-                non_bam_fh.close()
-            else:
-                non_bam_name= ''
-        # ----------------------------------------------------------------------
-        # Plotting 
-        # ----------------------------------------------------------------------
-        outputPDF.append(pdffile)
-        rgraph= pycoverage.RPlot(
-              inputlist= pycoverage.quoteStringList(inputlist_all),
-              count_header= pycoverage.quoteStringList(pympileup.COUNT_HEADER),
-              pdffile= pdffile,
-              rscript= rscript,
-              mcov= mpileup_grp_name,
-              nonbam= non_bam_name,
-              refbases= fasta_seq_name,
-              title= args.title,
-              cex_title= args.cex_title,
-              pheight= args.pheight,
-              pwidth= args.pwidth,
-              psize= args.psize,
-              ylab= pycoverage.quoteStringList(args.ylab),
-              cex_lab= pycoverage.quoteStringList(args.cex_lab),
-              col_yaxis= pycoverage.quoteStringList(args.col_yaxis),
-              bstart= bstart,
-              bend= bend,
-              xlim1= xregion.start,
-              xlim2= xregion.end,
-              maxseq= args.maxseq,
-              ymax= pycoverage.quoteStringList(args.ymax),
-              ymin= pycoverage.quoteStringList(args.ymin),
-              chrom= xregion.chrom,
-              vheights= pycoverage.quoteStringList(args.vheights),
-              mar_heights= pycoverage.quoteStringList(args.mar_heights),
-              cex= args.cex,
-              cex_axis= args.cex_axis,
-              col_mark= pycoverage.quoteStringList(args.col_mark),
-              col_line= pycoverage.quoteStringList(args.col_line),
-              lwd= pycoverage.quoteStringList(args.lwd),
-              col_track= pycoverage.quoteStringList(args.col_track),
-              col_track_rev= pycoverage.quoteStringList(args.col_track_rev),
-              col_nuc= pycoverage.quoteStringList(args.col_nuc),
-              no_col_bases= args.no_col_bases,
-              bg= pycoverage.quoteStringList(args.bg),
-              fbg= args.fbg,
-              col_grid= pycoverage.quoteStringList(args.col_grid),
-              col_text_ann= pycoverage.quoteStringList(args.col_text_ann),
-              names= pycoverage.quoteStringList(names),
-              col_names= pycoverage.quoteStringList(args.col_names),
-              cex_names= args.cex_names,
-              # cex_range= args.cex_range,
-              cex_seq= args.cex_seq,
-              col_seq= args.col_seq,
-              mar= ', '.join([str(x) for x in [0, args.mar, 0.2, 1]]),
-              col_all= args.col_all,
-              rcode= pycoverage.quoteStringList(args.rcode),
-              overplot= pycoverage.quoteStringList(args.overplot)
-              )
-        
-        if rgraph['returncode'] != 0:
-            print('\ngenomeGraphs.py: Exception in executing R script "%s"; returncode: %s\n' %(rscript, rgraph['returncode']))
-            print('** Captured stdout:')
-            print(rgraph['stdout'])
-            print('** Captured stderr:')
-            sys.exit(rgraph['stderr'])
-        if args.verbose:
-            print(rgraph['stderr'])
-            print(rgraph['stdout'])
-        if not onefile and tmpdir != outdir:
-            ## Copy PDFs from temp dir to output dir. Unless you want them in onefile or
-            ## if the final destination dir has been set to be also the tempdir
-            shutil.copyfile(pdffile, final_pdffile)
-    if onefile:
-        pycoverage.catPdf(in_pdf= outputPDF, out_pdf= args.onefile)
+                            pdfout.add_pdf(pdffile)
+                    if args.tmpdir is None and not args.in_memory:
+                        os.remove(pdffile)
+                npages += 1
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pdfout is not None:
+            pdfout.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+        for wdir in glob.glob(os.path.join(tmpdir, 'worker_*')):
+            shutil.rmtree(wdir, ignore_errors= True)
     for f in nonbam_dict:
         os.remove(nonbam_dict[f])
+    if args.profile:
+        print('\nProfile of the stages, details in %s:\n%s\n' %(args.profile, profiler.summary(profiler.read_report(args.profile))))
+    if failed != []:
+        sys.exit('\n%s of %s regions failed:\n%s\n' %(len(failed), len(regions), '\n'.join(failed)))
 #    if args.tmpdir is None:
 #        shutil.rmtree(tmpdir)
 if __name__ == '__main__':
@@ -0,0 +1,335 @@
+"""Concatenate PDF files page by page into one output file, without PyPDF2.
+
+PdfStream writes the objects of each page to the output file as soon as the
+page is added, so only the file being added is in memory. What is kept for the
+whole output is the file offset of each object and the list of pages, written
+at the end as the page tree and the cross-reference table. See the PDF
+reference, sections 3.2 (objects), 3.4 (file structure) and 3.6.2 (page tree).
+
+Input files must have a classic cross-reference table, as written by the R pdf
+device and by matplotlib. Compressed object and cross-reference streams
+(PDF 1.5) are not supported.
+"""
+
+import re
+import collections
+
+WHITESPACE= ' \t\n\r\f\x00'
+DELIMITERS= '()<>[]{}/%'
+
+## Page attributes a page can inherit from its ancestors in the page tree
+INHERITABLE= ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+## Object number of catalog and page tree in the output file
+CATALOG_ID= 1
+PAGES_ID= 2
+
+_OBJ_RE= re.compile(r'(\d+)\s+(\d+)\s+obj')
+_XREF_SECTION_RE= re.compile(r'(\d+)\s+(\d+)')
+_XREF_ENTRY_RE= re.compile(r'(\d{10})\s(\d{5})\s([nf])')
+_INT_RE= re.compile(r'[+-]?\d+$')
+
+class PdfStreamError(Exception):
+    pass
+
+class Ref(object):
+    """Indirect reference to object num, generation gen
+    """
+    __slots__= ('num', 'gen')
+    def __init__(self, num, gen= 0):
+        self.num= num
+        self.gen= gen
+
+def _skip(data, pos):
+    """Return the position of the first character from pos that is not
+    whitespace or comment
+    """
+    while pos < len(data):
+        c= data[pos]
+        if c in WHITESPACE:
+            pos += 1
+        elif c == '%':
+            while pos < len(data) and data[pos] not in '\r\n':
+                pos += 1
+        else:
+            break
+    return(pos)
+
+def _token_end(data, pos):
+    while pos < len(data) and data[pos] not in WHITESPACE and data[pos] not in DELIMITERS:
+        pos += 1
+    return(pos)
+
+def parse_object(data, pos):
+    """Parse the PDF object starting at data[pos]. Dictionaries are returned as
+    OrderedDict, arrays as lists, indirect references as Ref. Everything else
+    (names, numbers, strings, booleans, null) is returned as its raw string,
+    e.g. '/Type', '12', '(Title)'.
+    Return:
+        Tuple (<object>, <position after the object>)
+    """
+    pos= _skip(data, pos)
+    if pos >= len(data):
+        raise PdfStreamError('Unexpected end of data')
+    c= data[pos]
+    if data.startswith('<<', pos):
+        value= collections.OrderedDict()
+        pos += 2
+        while True:
+            pos= _skip(data, pos)
+            if data.startswith('>>', pos):
+                return((value, pos + 2))
+            key, pos= parse_object(data, pos)
+            value[key], pos= parse_object(data, pos)
+    if c == '[':
+        value= []
+        pos += 1
+        while True:
+            pos= _skip(data, pos)
+            if data.startswith(']', pos):
+                return((value, pos + 1))
+            x, pos= parse_object(data, pos)
+            value.append(x)
+    if c == '(':
+        ## Literal string, with balanced parentheses and backslash escapes
+        start= pos
+        depth= 0
+        while pos < len(data):
+            c= data[pos]
+            if c == '\\':
+                pos += 2
+                continue
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+                if depth == 0:
+                    return((data[start:pos + 1], pos + 1))
+            pos += 1
+        raise PdfStreamError('Unterminated string at byte %s' %(start))
+    if c == '<':
+        end= data.find('>', pos)
+        if end == -1:
+            raise PdfStreamError('Unterminated hex string at byte %s' %(pos))
+        return((data[pos:end + 1], end + 1))
+    if c == '/':
+        end= _token_end(data, pos + 1)
+        return((data[pos:end], end))
+    end= _token_end(data, pos)
+    if end == pos:
+        raise PdfStreamError('Unexpected "%s" at byte %s' %(c, pos))
+    token= data[pos:end]
+    if _INT_RE.match(token):
+        ## Maybe the object number of a reference: <num> <gen> R
+        gen_start= _skip(data, end)
+        gen_end= _token_end(data, gen_start)
+        if _INT_RE.match(data[gen_start:gen_end]):
+            r_start= _skip(data, gen_end)
+            if data[r_start:_token_end(data, r_start)] == 'R':
+                return((Ref(int(token), int(data[gen_start:gen_end])), r_start + 1))
+    return((token, end))
+
+def dump_object(value):
+    """Return the PDF syntax of an object as returned by parse_object()
+    """
+    if isinstance(value, Ref):
+        return('%d %d R' %(value.num, value.gen))
+    if isinstance(value, dict):
+        return('<<' + ' '.join([k + ' ' + dump_object(v) for k, v in value.items()]) + '>>')
+    if isinstance(value, list):
+        return('[' + ' '.join([dump_object(x) for x in value]) + ']')
+    return(value)
+
+class PdfReader(object):
+    """Objects of a PDF file, read in memory.
+    Attributes:
+        offsets: Dict {<object number>: <byte offset>} from the cross-reference table
+        trailer: Trailer dictionary
+    """
+    def __init__(self, filename, data= None):
+        self.filename= filename
+        if data is None:
+            data= open(filename, 'rb').read()
+        self.data= data
+        if not self.data.startswith('%PDF-'):
+            raise PdfStreamError('%s is not a PDF file' %(filename))
+        self.offsets, self.trailer= self._read_xref()
+
+    def _read_xref(self):
+        data= self.data
+        pos= data.rfind('startxref')
+        if pos == -1:
+            raise PdfStreamError('startxref not found in %s' %(self.filename))
+        offset= int(parse_object(data, pos + len('startxref'))[0])
+        offsets= {}
+        trailer= None
+        ## Follow the chain of incremental updates, newest first
+        while offset is not None:
+            pos= _skip(data, offset)
+            if not data.startswith('xref', pos):
+                raise PdfStreamError('Cross-reference table not found in %s. Cross-reference streams are not supported' %(self.filename))
+            pos += 4
+            while True:
+                pos= _skip(data, pos)
+                if data.startswith('trailer', pos):
+                    break
+                m= _XREF_SECTION_RE.match(data, pos)
+                if m is None:
+                    raise PdfStreamError('Invalid cross-reference table in %s' %(self.filename))
+                first, count= int(m.group(1)), int(m.group(2))
+                pos= m.end()
+                for num in range(first, first + count):
+                    m= _XREF_ENTRY_RE.match(data, _skip(data, pos))
+                    if m is None:
+                        raise PdfStreamError('Invalid cross-reference entry in %s' %(self.filename))
+                    pos= m.end()
+                    if m.group(3) == 'n' and num not in offsets:
+                        offsets[num]= int(m.group(1))
+            xtrailer, pos= parse_object(data, pos + len('trailer'))
+            if trailer is None:
+                trailer= xtrailer
+            if '/XRefStm' in xtrailer:
+                raise PdfStreamError('Cross-reference streams are not supported in %s' %(self.filename))
+            offset= int(xtrailer['/Prev']) if '/Prev' in xtrailer else None
+        return((offsets, trailer))
+
+    def get(self, num):
+        """Return object number num as tuple (<object>, <stream data or None>).
+        Missing objects are null, as by the PDF reference.
+        """
+        if num not in self.offsets:
+            return(('null', None))
+        data= self.data
+        m= _OBJ_RE.match(data, _skip(data, self.offsets[num]))
+        if m is None or int(m.group(1)) != num:
+            raise PdfStreamError('Object %s not found at its offset in %s' %(num, self.filename))
+        value, pos= parse_object(data, m.end())
+        pos= _skip(data, pos)
+        stream= None
+        if data.startswith('stream', pos):
+            pos += len('stream')
+            if data.startswith('\r\n', pos):
+                pos += 2
+            elif data.startswith('\n', pos):
+                pos += 1
+            length= int(self.resolve(value['/Length']))
+            stream= data[pos:pos + length]
+        if isinstance(value, dict) and value.get('/Type') == '/ObjStm':
+            raise PdfStreamError('Compressed object streams are not supported in %s' %(self.filename))
+        return((value, stream))
+
+    def resolve(self, value):
+        if isinstance(value, Ref):
+            return(self.get(value.num)[0])
+        return(value)
+
+    def pages(self):
+        """Walk the page tree.
+        Return:
+            Tuple (<pages>, <nodes>). pages is the list of (<object number>,
+            <dict of inherited attributes>) of the pages in order, nodes the
+            object numbers of the intermediate nodes
+        """
+        pages= []
+        nodes= []
+        catalog= self.resolve(self.trailer['/Root'])
+        stack= [(catalog['/Pages'], {})]
+        while stack != []:
+            ref, inherited= stack.pop()
+            node= self.resolve(ref)
+            if node.get('/Type') == '/Pages' or '/Kids' in node:
+                nodes.append(ref.num)
+                inherited= dict(inherited)
+                for k in INHERITABLE:
+                    if k in node:
+                        inherited[k]= node[k]
+                kids= self.resolve(node['/Kids'])
+                stack.extend([(kid, inherited) for kid in reversed(kids)])
+            else:
+                pages.append((ref.num, inherited))
+        return((pages, nodes))
+
+class PdfStream(object):
+    """Output PDF file open for appending pages.
+    filename:
+        Output file, written incrementally. The file is complete after close()
+    """
+    def __init__(self, filename):
+        self.filename= filename
+        self.fh= open(filename, 'wb')
+        self.fh.write('%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+        self.offsets= [None, None] ## Offset of object n at index n-1
+        self.kids= [] ## Object numbers of the pages
+
+    def _new_object(self):
+        self.offsets.append(None)
+        return(len(self.offsets))
+
+    def _write_object(self, num, value, stream= None):
+        self.offsets[num - 1]= self.fh.tell()
+        self.fh.write('%d 0 obj\n%s\n' %(num, dump_object(value)))
+        if stream is not None:
+            self.fh.write('stream\n')
+            self.fh.write(stream)
+            self.fh.write('\nendstream\n')
+        self.fh.write('endobj\n')
+
+    def add_pdf(self, filename, data= None):
+        """Append all the pages of PDF file filename. If data is given, it is
+        the content of the PDF and filename is used only in error messages.
+        """
+        reader= PdfReader(filename, data)
+        pages, nodes= reader.pages()
+        ## Object numbers in filename -> object numbers in output. The page
+        ## tree of filename is replaced by the one of the output
+        newid= {reader.trailer['/Root'].num: CATALOG_ID}
+        for num in nodes:
+            newid[num]= PAGES_ID
+        for num, inherited in pages:
+            newid[num]= self._new_object()
+        queue= collections.deque()
+        def remap(value):
+            if isinstance(value, Ref):
+                if value.num not in newid:
+                    newid[value.num]= self._new_object()
+                    queue.append(value.num)
+                return(Ref(newid[value.num]))
+            if isinstance(value, dict):
+                return(collections.OrderedDict([(k, remap(v)) for k, v in value.items()]))
+            if isinstance(value, list):
+                return([remap(x) for x in value])
+            return(value)
+        for num, inherited in pages:
+            page, stream= reader.get(num)
+            for k in inherited:
+                if k not in page:
+                    page[k]= inherited[k]
+            page.pop('/Parent', None)
+            page= remap(page)
+            page['/Parent']= Ref(PAGES_ID)
+            self._write_object(newid[num], page, stream)
+            self.kids.append(newid[num])
+        ## Everything the pages refer to, e.g. contents, fonts, images
+        while len(queue) > 0:
+            num= queue.popleft()
+            value, stream= reader.get(num)
+            self._write_object(newid[num], remap(value), stream)
+
+    def close(self):
+        """Write page tree, catalog and cross-reference table and close the file
+        """
+        pages= collections.OrderedDict([('/Type', '/Pages'),
+            ('/Kids', [Ref(x) for x in self.kids]),
+            ('/Count', str(len(self.kids)))])
+        self._write_object(PAGES_ID, pages)
+        self._write_object(CATALOG_ID, collections.OrderedDict([('/Type', '/Catalog'), ('/Pages', Ref(PAGES_ID))]))
+        startxref= self.fh.tell()
+        self.fh.write('xref\n0 %d\n' %(len(self.offsets) + 1))
+        self.fh.write('0000000000 65535 f \n')
+        for offset in self.offsets:
+            if offset is None:
+                self.fh.write('0000000000 00000 f \n')
+            else:
+                self.fh.write('%010d 00000 n \n' %(offset))
+        self.fh.write('trailer\n%s\nstartxref\n%d\n%%%%EOF\n' %(dump_object(collections.OrderedDict([('/Size', str(len(self.offsets) + 1)), ('/Root', Ref(CATALOG_ID))])), startxref))
+        self.fh.close()
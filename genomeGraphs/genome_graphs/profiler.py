@@ -0,0 +1,150 @@
+"""Timing of the stages of a run for --profile.
+
+Code to time is wrapped in `with profiler.stage(<name>):`. When profiling is
+enabled, each stage appends one JSON record to the report file:
+
+    {"stage": "pileup", "region": "chr7_5566755_5567571_ACTB", "pid": 123,
+     "start": <epoch seconds>, "wall": <seconds>, "cpu": <seconds>,
+     "child_cpu": <seconds>, "maxrss_mb": <MB>, "child_maxrss_mb": <MB>,
+     "failed": false}
+
+cpu is the user + system time of this process during the stage, child_cpu the
+same for the child processes (samtools, java, R) that ended during the stage.
+maxrss_mb and child_maxrss_mb are the peak memory so far of this process and
+of the largest child process waited for so far. Stages nest, e.g. pileup is
+part of bam which is part of region.
+
+Processes of the --jobs pools are forked after profiling is enabled, so they
+write to the same file. Each record is appended with a single write.
+
+When profiling is not enabled stage() returns a context manager that does
+nothing.
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import collections
+
+## Report file and region being processed by this process
+_STATE= {'filename': None, 'region': None}
+
+def _cpu_seconds(ru_start, ru_end):
+    ## + 0.0 turns the -0.0 of rounding into 0.0
+    return(round(ru_end.ru_utime + ru_end.ru_stime - ru_start.ru_utime - ru_start.ru_stime, 6) + 0.0)
+
+def _maxrss_mb(ru):
+    ## ru_maxrss is in KB on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return(ru.ru_maxrss / 1024.0 / 1024.0)
+    return(ru.ru_maxrss / 1024.0)
+
+class _Stage(object):
+    def __init__(self, name, region):
+        self.name= name
+        self.region= region
+
+    def __enter__(self):
+        self.start= time.time()
+        self.ru_self= resource.getrusage(resource.RUSAGE_SELF)
+        self.ru_children= resource.getrusage(resource.RUSAGE_CHILDREN)
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        wall= time.time() - self.start
+        ru_self= resource.getrusage(resource.RUSAGE_SELF)
+        ru_children= resource.getrusage(resource.RUSAGE_CHILDREN)
+        record= collections.OrderedDict([
+            ('stage', self.name),
+            ('region', self.region),
+            ('pid', os.getpid()),
+            ('start', round(self.start, 6)),
+            ('wall', round(wall, 6)),
+            ('cpu', _cpu_seconds(self.ru_self, ru_self)),
+            ('child_cpu', _cpu_seconds(self.ru_children, ru_children)),
+            ('maxrss_mb', round(_maxrss_mb(ru_self), 3)),
+            ('child_maxrss_mb', round(_maxrss_mb(ru_children), 3)),
+            ('failed', exc_type is not None)])
+        write_record(record)
+        return(False)
+
+class _NoStage(object):
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return(False)
+
+_NO_STAGE= _NoStage()
+
+def enable(filename, truncate= False):
+    """Write the stages to the report filename, emptied first if truncate
+    """
+    if truncate:
+        open(filename, 'w').close()
+    _STATE['filename']= filename
+
+def disable():
+    _STATE['filename']= None
+    _STATE['region']= None
+
+def enabled():
+    return(_STATE['filename'] is not None)
+
+def set_region(region):
+    """Set the region of the next stages of this process, by default None
+    for stages not specific to a region
+    """
+    _STATE['region']= region
+
+def stage(name, region= None):
+    """Context manager timing the code in its block as stage name. region
+    defaults to the one from set_region()
+    """
+    if _STATE['filename'] is None:
+        return(_NO_STAGE)
+    if region is None:
+        region= _STATE['region']
+    return(_Stage(name, region))
+
+def write_record(record):
+    fh= open(_STATE['filename'], 'a')
+    fh.write(json.dumps(record) + '\n')
+    fh.close()
+
+def read_report(filename):
+    """Return the list of records in the report filename
+    """
+    records= []
+    for line in open(filename):
+        if line.strip() != '':
+            records.append(json.loads(line))
+    return(records)
+
+def summary(records):
+    """Table with the time and memory of each stage summed across regions,
+    stages in order of first appearance
+    """
+    stages= collections.OrderedDict()
+    for r in records:
+        stages.setdefault(r['stage'], []).append(r)
+    header= ['stage', 'calls', 'wall_s', 'wall_mean_s', 'wall_max_s', 'cpu_s', 'child_cpu_s', 'maxrss_mb', 'child_maxrss_mb']
+    rows= []
+    for name in stages:
+        x= stages[name]
+        wall= [r['wall'] for r in x]
+        rows.append([name, str(len(x)),
+            '%.3f' %(sum(wall)),
+            '%.3f' %(sum(wall) / len(wall)),
+            '%.3f' %(max(wall)),
+            '%.3f' %(sum([r['cpu'] for r in x])),
+            '%.3f' %(sum([r['child_cpu'] for r in x])),
+            '%.1f' %(max([r['maxrss_mb'] for r in x])),
+            '%.1f' %(max([r['child_maxrss_mb'] for r in x]))])
+    widths= [max([len(row[i]) for row in [header] + rows]) for i in range(len(header))]
+    lines= []
+    for row in [header] + rows:
+        lines.append('  '.join([row[0].ljust(widths[0])] + [row[i].rjust(widths[i]) for i in range(1, len(row))]))
+    return('\n'.join(lines))
@@ -3,14 +3,22 @@ import pybedtools
 import os
 import tempfile
 import subprocess
+import pipes
 import glob
 import gzip
 import re
 import csv
+import hashlib
 import copy
 import inspect
+import numpy as np
 import genome_graphs ## Currently (v 0.2.0) this is necessary only to get the dir to Rscript(s)
 import pympileup
+import bigwig
+import fasta as indexed_fasta
+import pdfstream
+import profiler
+import spool
 
 ## IMPORTS TO BE DEPRECATED:
 # import genomeGraphs
@@ -81,6 +89,9 @@ def stdin_inbed_to_fh(stdin):
 class SlopError(Exception):
     pass
 
+class RPlotError(Exception):
+    pass
+
 def slopbed(interval, slop):
     """Extend bed interval by given slop.
     interval:
@@ -163,7 +174,7 @@ def dedupFileList(x):
             inputlist.append(a)
     return(inputlist)
 
-def prefilter_nonbam_multiproc(inbed, nonbam, tmpdir, sorted):
+def prefilter_nonbam_multiproc(inbed, nonbam, tmpdir, sorted, tabix= None):
     """For each filename in nonbamlist do the intersection with the regions in
     inbed. Produce filtered files to tmpdir and return a dict of original filenames
     and the filtered name
@@ -175,7 +186,11 @@ def prefilter_nonbam_multiproc(inbed, nonbam, tmpdir, sorted):
         Where intersected files will go. Output name is
         tmpdir/x_<original name w/o .gz>
     sorted:
-        True/False passed to intersectbed(sorted) to use chromsweep algorithm
+        If True, nonbam is sorted by position and it is filtered in a single
+        pass by prefilter_sweep()
+    tabix:
+        Tabix indexed version of nonbam (see tabix_file()). If given, only the
+        records overlapping inbed are read from it instead of scanning nonbam.
     Return:
         Name of the (temp) file with the filetered regions.
 #        dict of original names:filtered names
@@ -185,22 +200,17 @@ def prefilter_nonbam_multiproc(inbed, nonbam, tmpdir, sorted):
     bname= re.sub('\.gz$', '', os.path.split(nonbam)[1])
     fn= tempfile.NamedTemporaryFile(dir= tmpdir, suffix= '_' + bname, delete= False)
     x_name= fn.name
+    if tabix is not None:
+        prefilter_tabix(inbed, tabix, fn)
+        fn.close()
+        return(x_name)
+    if sorted:
+        prefilter_sweep(inbed, nonbam, fn)
+        fn.close()
+        return(x_name)
+    fn.close()
     pynonbam= pybedtools.BedTool(nonbam)
-    ncolbdg= len(list(pynonbam[0]))
-    ncolbed= len(list(inbed[0]))
-    if not sorted:
-        nonbam_x_inbed= pybedtools.BedTool().intersect(a= pynonbam, b= inbed, u= True, sorted= sorted, stream= False)
-    else:
-        ## With sorted input the b.file is the "big one" (e.g. bedgraph).
-        ## We need to rows from the b-file which are the columns after the a-file. Use cut to get these columns
-        ## Since a b-feature can span several a-features, use sort | uniq the remove duplicate rows coming from the b-file
-        nonbam_x_inbed= pybedtools.BedTool().intersect(b= pynonbam, a= inbed, wb= True, sorted= sorted).cut(range(ncolbed, ncolbdg+ncolbed)).saveas()
-        cmd= 'set -e; set -o pipefail; sort -k1,1 -k2,2n -k3,3n %(bed)s | uniq > %(bedu)s; mv %(bedu)s %(bed)s' %{'bed': nonbam_x_inbed.fn, 'bedu': nonbam_x_inbed.fn + '.uniq'}
-        p= subprocess.Popen(cmd, shell= True, stderr= subprocess.PIPE, stdout= subprocess.PIPE, executable='/bin/bash')
-        stdout, stderr= p.communicate()
-        if p.returncode != 0:
-            print(sterr)
-            sys.exit('\n\nError executing \n%s\n' %(cmd))
+    nonbam_x_inbed= pybedtools.BedTool().intersect(a= pynonbam, b= inbed, u= True, stream= False)
     if nonbam_x_inbed.count() == 0:
         pass        
     else:
@@ -208,9 +218,276 @@ def prefilter_nonbam_multiproc(inbed, nonbam, tmpdir, sorted):
     #ori_new= (nonbam, x_name)
     return(x_name)
 
+def prefilter_sweep(inbed, nonbam, outfile_handle):
+    """Write to outfile_handle the records of nonbam overlapping the regions in
+    inbed, each record once and in the same order as in nonbam. Both inbed and
+    nonbam must be sorted by position within chromosome, inbed must be merged.
+    nonbam is read once, line by line. Comment, track and browser lines are
+    skipped.
+    Return:
+        Number of records written
+    """
+    ## Regions of each chromosome and index of the first one that may overlap
+    ## the current record
+    regions= {}
+    for region in inbed:
+        regions.setdefault(region.chrom, []).append((region.start, region.end))
+    first= dict([(chrom, 0) for chrom in regions])
+    if is_gtf(nonbam):
+        start_col, offset= 3, 1 ## GTF is 1-based
+    else:
+        start_col, offset= 1, 0
+    if nonbam.endswith('.gz'):
+        fin= gzip.open(nonbam)
+    else:
+        fin= open(nonbam)
+    n= 0
+    for line in fin:
+        if line.startswith('#') or line.startswith('track') or line.startswith('browser') or line.strip() == '':
+            continue
+        fields= line.split('\t', start_col + 2)
+        chrom= fields[0]
+        if chrom not in regions:
+            continue
+        start= int(fields[start_col]) - offset
+        end= int(fields[start_col + 1])
+        chrom_regions= regions[chrom]
+        i= first[chrom]
+        ## Regions ending before this record cannot overlap the next ones either
+        while i < len(chrom_regions) and chrom_regions[i][1] <= start:
+            i += 1
+        first[chrom]= i
+        if i < len(chrom_regions) and chrom_regions[i][0] < end:
+            outfile_handle.write(line)
+            n += 1
+    fin.close()
+    return(n)
+
+def prefilter_tabix(inbed, tabix, outfile_handle):
+    """Write to outfile_handle the records of the tabix indexed file overlapping
+    the regions in inbed. inbed must be sorted and merged. Records spanning more
+    than one region are written once, output is sorted as inbed.
+    """
+    tbx= get_tabix(tabix)
+    contigs= set(tbx.contigs)
+    if is_gtf(tabix):
+        start_col, offset= 3, 1 ## GTF is 1-based
+    else:
+        start_col, offset= 1, 0
+    prev_chrom= None
+    prev_end= 0
+    for region in inbed:
+        if region.chrom not in contigs:
+            continue
+        if region.chrom != prev_chrom:
+            prev_end= 0
+        for line in tbx.fetch(region.chrom, region.start, region.end):
+            fields= line.split('\t', start_col + 2)
+            start= int(fields[start_col]) - offset
+            end= int(fields[start_col + 1])
+            ## fetch() may return records adjacent to region, skip them. Records
+            ## starting before the end of the previous region overlap it, so
+            ## they have been written already
+            if start >= region.end or end <= region.start or start < prev_end:
+                continue
+            outfile_handle.write(line + '\n')
+        prev_chrom= region.chrom
+        prev_end= region.end
+
+## Open tabix files of this process, see get_tabix()
+_TABIX_OPEN= {}
+
+def get_tabix(tabix):
+    """Return the pysam.TabixFile of tabix, kept open for the next calls in
+    this process. The file is opened again if it changed in the meantime.
+    """
+    import pysam
+    st= os.stat(tabix)
+    stamp= (st.st_size, st.st_mtime)
+    if tabix in _TABIX_OPEN and _TABIX_OPEN[tabix][0] != stamp:
+        _TABIX_OPEN.pop(tabix)[1].close()
+    if tabix not in _TABIX_OPEN:
+        _TABIX_OPEN[tabix]= (stamp, pysam.TabixFile(tabix))
+    return(_TABIX_OPEN[tabix][1])
+
+## Non-bam files read in memory by this process, see get_interval_file()
+_INTERVAL_FILES= {}
+
+def get_interval_file(filename):
+    """Return the IntervalFile of filename, kept for the next calls in this
+    process. The file is read again if it changed in the meantime.
+    """
+    st= os.stat(filename)
+    stamp= (st.st_size, st.st_mtime)
+    if filename not in _INTERVAL_FILES or _INTERVAL_FILES[filename][0] != stamp:
+        _INTERVAL_FILES[filename]= (stamp, IntervalFile(filename))
+    return(_INTERVAL_FILES[filename][1])
+
+class IntervalFile(object):
+    """Intervals of a bed, bedGraph or gtf file read in memory and indexed by
+    chromosome, to intersect regions without running bedtools (--in_memory).
+    Lines are kept as they are in the file.
+    filename:
+        File to read, gzip'd or not. gtf files are recognized by the name, see
+        is_gtf()
+    """
+    def __init__(self, filename):
+        self.filename= filename
+        gtf= is_gtf(filename)
+        fh= open(filename, 'rb')
+        magic= fh.read(2)
+        fh.close()
+        if magic == '\x1f\x8b':
+            fin= gzip.open(filename)
+        else:
+            fin= open(filename)
+        chroms= {}
+        for line in fin:
+            if line.startswith('#') or line.startswith('track') or line.startswith('browser') or line.strip() == '':
+                continue
+            fields= line.split('\t', 5)
+            if gtf:
+                start, end= int(fields[3]) - 1, int(fields[4])
+            else:
+                start, end= int(fields[1]), int(fields[2])
+            starts, ends, lines= chroms.setdefault(fields[0], ([], [], []))
+            starts.append(start)
+            ends.append(end)
+            lines.append(line)
+        fin.close()
+        ## {<chrom>: (starts, ends, lines, length of the longest interval)}
+        ## sorted by start
+        self.index= {}
+        for chrom, (starts, ends, lines) in chroms.items():
+            starts= np.array(starts, dtype= int)
+            ends= np.array(ends, dtype= int)
+            order= np.argsort(starts, kind= 'mergesort')
+            self.index[chrom]= (starts[order], ends[order], [lines[i] for i in order], (ends - starts).max())
+
+    def overlaps(self, region):
+        """Intervals overlapping region by at least one base, clipped to it, in
+        order of start, as from bedtools intersect -a <this file> -b <region>
+        Return:
+            Tuple (starts, ends, lines) with starts and ends as arrays
+        """
+        if region.chrom not in self.index:
+            return((np.zeros(0, dtype= int), np.zeros(0, dtype= int), []))
+        starts, ends, lines, maxlen= self.index[region.chrom]
+        lo= np.searchsorted(starts, region.start - maxlen)
+        hi= np.searchsorted(starts, region.end)
+        idx= lo + np.nonzero(ends[lo:hi] > region.start)[0]
+        return((np.maximum(starts[idx], region.start), np.minimum(ends[idx], region.end), [lines[i] for i in idx]))
+
+    def intervals(self, region):
+        """As overlaps() with the clipped lines as pybedtools.Interval
+        """
+        starts, ends, lines= self.overlaps(region)
+        for start, end, line in zip(starts, ends, lines):
+            interval= pybedtools.create_interval_from_list(line.rstrip('\r\n').split('\t'))
+            interval.start= int(start)
+            interval.end= int(end)
+            yield(interval)
+
+def is_gtf(filename):
+    return(re.sub('\.gz$', '', filename).endswith('.gtf'))
+
+def find_tabix_index(filename):
+    """Return the tabix index of filename (.tbi or .csi) or None
+    """
+    for idx in [filename + '.tbi', filename + '.csi']:
+        if os.path.isfile(idx):
+            return(idx)
+    return(None)
+
+## Maximum total size in bytes of the copies made by tabix_file() in cache_dir
+TABIX_CACHE_SIZE= 2 * 1024 * 1024 * 1024
+
+def tabix_file(nonbam, cache_dir, build= False, max_size= TABIX_CACHE_SIZE):
+    """Return the name of a tabix indexed version of nonbam or None if not
+    available. This is nonbam itself if it has an index next to it. Otherwise,
+    if build is True, a sorted, bgzip compressed and indexed copy of nonbam is
+    made in cache_dir. The copy is named after path, size and mtime of nonbam so
+    it is reused until nonbam changes. The least recently used copies are
+    removed when they take more than max_size bytes, see evict_tabix_copies().
+    Requires pysam. If pysam is not available return None.
+    """
+    try:
+        import pysam
+    except ImportError:
+        return(None)
+    if find_tabix_index(nonbam) is not None:
+        return(nonbam)
+    if not build:
+        return(None)
+    st= os.stat(nonbam)
+    key= hashlib.md5('\t'.join([os.path.abspath(nonbam), str(st.st_size), str(st.st_mtime)])).hexdigest()
+    bname= re.sub('\.gz$', '', os.path.split(nonbam)[1])
+    tabix= os.path.join(cache_dir, 'tabix_' + key + '_' + bname + '.gz')
+    if os.path.isfile(tabix):
+        try:
+            ## Mark as recently used. The index is touched, not the copy, so
+            ## that get_tabix() keeps the copy open.
+            os.utime(tabix + '.tbi', None)
+            return(tabix)
+        except OSError:
+            ## Index missing or removed by another process, build again
+            pass
+    print('Building tabix index for %s' %(nonbam))
+    fn= tempfile.NamedTemporaryFile(dir= cache_dir, suffix= '_' + bname, delete= False)
+    fn.close()
+    if is_gtf(nonbam):
+        preset= 'gff'
+    else:
+        preset= 'bed'
+    try:
+        pybedtools.BedTool(nonbam).sort().saveas(fn.name)
+        gz= pysam.tabix_index(fn.name, preset= preset, force= True)
+        os.rename(gz + '.tbi', tabix + '.tbi')
+        os.rename(gz, tabix)
+    except:
+        ## Don't leave partial files in cache_dir
+        for x in [fn.name, fn.name + '.gz', fn.name + '.gz.tbi']:
+            if os.path.exists(x):
+                os.remove(x)
+        raise
+    evict_tabix_copies(cache_dir, max_size, keep= tabix)
+    return(tabix)
+
+def evict_tabix_copies(cache_dir, max_size, keep= None):
+    """Remove the copies made by tabix_file() in cache_dir, with their index,
+    least recently used first until they take no more than max_size bytes.
+    The copy keep is not removed.
+    """
+    copies= []
+    for fn in os.listdir(cache_dir):
+        if not (fn.startswith('tabix_') and fn.endswith('.gz')):
+            continue
+        tabix= os.path.join(cache_dir, fn)
+        try:
+            st= os.stat(tabix + '.tbi')
+            size= os.path.getsize(tabix) + st.st_size
+        except OSError:
+            continue
+        copies.append((st.st_mtime, size, tabix))
+    copies.sort()
+    total= sum([size for mtime, size, tabix in copies])
+    for mtime, size, tabix in copies:
+        if total <= max_size:
+            break
+        if tabix == keep:
+            continue
+        for x in [tabix, tabix + '.tbi']:
+            try:
+                os.remove(x)
+            except OSError:
+                ## Removed by another process in the meantime
+                pass
+        total -= size
+
 
 def makeWindows(region, n):
-    """Divide a region in n windows. If the region size is < n, than each postion
+    """DEPRECATED: Windows are computed arithmetically by pympileup.window_size()
+    Divide a region in n windows. If the region size is < n, than each postion
     is returned.
     region:
         pybedtools interval object or string as '<chrom>\t<start>\t<end>'
@@ -240,7 +517,9 @@ def mergePDF(filenames, output_filename):
     outputstream.close()
 
 def getRefSequence(fasta, region):
-    """Read the fasta file and extract the region given in bedtool interval region.
+    """DEPRECATED: prepare_reference_fasta() reads the sequence with
+    fasta.IndexedFasta.
+    Read the fasta file and extract the region given in bedtool interval region.
     Return:
         List of tuples with inner tuple ['chrom', 'start', 'end', 'base']
     NB: You need to reduce the start by 1 because fastaFromBed seems to be 1-based.
@@ -268,19 +547,23 @@ def quoteStringList(x):
         Numbers are converted to strings and quoted as well! None is converted to
         'NA'.
     NB2:
-        This function is not meant to cope well with strings containing double quotes,
-        weird metachars etc.
+        Backslashes and double quotes are escaped, so the strings cannot end
+        the R string early and inject code.
     '''
     s= ''
     for y in x:
         if y is None:
             y= 'NA'
-        s= s + '"' + str(y) + '", '
+        s= s + '"' + str(y).replace('\\', '\\\\').replace('"', '\\"') + '", '
     s= s.strip(', ')
     return(s)
 
-def RPlot(**kwargs):
+def RPlot(rsession= None, **kwargs):
     """Write to file the R script to produce the plots and execute it using Rscript
+    rsession:
+        rsession.RSession where to run the script. If None, the script
+        includes the helper functions in R_functions.R and it is executed
+        by a new Rscript process.
     kwargs: 
         Arguments that will be interpolated in the string that make up the script.
     Return:
@@ -292,29 +575,30 @@ def RPlot(**kwargs):
     rin= os.path.join(path_to_Rscript, 'R_template.R')
     rtemplate= open(rin).read()
     rplot= rtemplate %kwargs
+    if rsession is None:
+        rplot= open(os.path.join(path_to_Rscript, 'R_functions.R')).read() + '\n' + rplot
     rout.write(rplot)
     rout.close()
-    p= subprocess.Popen('Rscript %s' %(kwargs['rscript']), stdout= subprocess.PIPE, stderr= subprocess.PIPE, shell= True)
-    stdout, stderr= p.communicate()
+    with profiler.stage('plot'):
+        if rsession is not None:
+            rgraph= rsession.run(kwargs['rscript'])
+            stdout, stderr, returncode= rgraph['stdout'], rgraph['stderr'], rgraph['returncode']
+        else:
+            p= subprocess.Popen('Rscript %s' %(pipes.quote(kwargs['rscript'])), stdout= subprocess.PIPE, stderr= subprocess.PIPE, shell= True)
+            stdout, stderr= p.communicate()
+            returncode= p.returncode
     if stderr != '':
         print(stderr)
-    return({'stdout':stdout, 'stderr': stderr, 'returncode': p.returncode})
+    return({'stdout':stdout, 'stderr': stderr, 'returncode': returncode})
         
 def catPdf(in_pdf, out_pdf):
-    """Concatenate the PDF files in list `in_pdf` into the single file `out_pdf`:
-    Return:
-        True if successful False otherwise.
-    See also:
-        http://www.blog.pythonlibrary.org/2010/05/15/manipulating-pdfs-with-python-and-pypdf/
+    """Concatenate the PDF files in list `in_pdf` into the single file `out_pdf`.
+    Pages are streamed to out_pdf one file at a time, see pdfstream.PdfStream
     """
-    import PyPDF2
-    output = PyPDF2.PdfFileWriter()
+    output= pdfstream.PdfStream(out_pdf)
     for pdf in in_pdf:
-        pdfOne = PyPDF2.PdfFileReader(file(pdf, "rb"))
-        output.addPage(pdfOne.getPage(0))
-    outputStream = file(out_pdf, "wb")
-    output.write(outputStream)
-    outputStream.close()
+        output.add_pdf(pdf)
+    output.close()
 
 def prepare_nonbam_file(infile_name, outfile_handle, region, use_file_name):
     """Intersect a bed interval with the bed, bed-like or gtf file. Each intersected
@@ -327,7 +611,8 @@ def prepare_nonbam_file(infile_name, outfile_handle, region, use_file_name):
     Output an annotation file suitable for R plotting.
     infile_name:
         Annotation or covergae file. Can be gtf (annotation) or any 4-column
-        tab delimited file with chrom, start, end, score/name.
+        tab delimited file with chrom, start, end, score/name. Or the
+        IntervalFile of such file.
     region:
         A pybedtools.Interval to intersect to the gtf. Intersected feature will be
         sent to output
@@ -338,42 +623,45 @@ def prepare_nonbam_file(infile_name, outfile_handle, region, use_file_name):
     Return:
         Number of intervals that overlap `region` (n lines)
     """
-    infile= pybedtools.BedTool(infile_name)
     nlines= 0
-
-    if open(infile.fn).readline().strip() == '':
+    if isinstance(infile_name, IntervalFile):
+        region_x_infile= infile_name.intervals(region)
+        infile_name= infile_name.filename
+    elif open(infile_name).readline().strip() == '':
         """If there are no intersecting features return 0
         """
-        pass
+        region_x_infile= []
     else:
+        infile= pybedtools.BedTool(infile_name)
         region_x_infile= pybedtools.BedTool().intersect(a= infile,
             b= pybedtools.BedTool(str(region), from_string= True),
             sorted= True, stream= True)
-        for line in region_x_infile:
-            if line.name == '':
-                name= 'NA'
-            else:
-                name= line.name
-            if line.strand == '':
-                strand= '.'
-            else:
-                strand= line.strand
-            if infile_name.endswith('.gtf') or infile_name.endswith('.gtf.gz'):
-                outline= [line.chrom, line.start - 1, line.end, use_file_name] + ['NA'] * len(pympileup.COUNT_HEADER) + [line.fields[2], name, strand] ## NA for padding depthACTGNZactgnz
-            elif infile_name.lower().endswith('.bedgraph') or infile_name.lower().endswith('.bedgraph.gz'):
-                outline= [line.chrom, line.start, line.end, use_file_name] + ['0'] * (len(pympileup.COUNT_HEADER)-1) + [line.name, 'coverage', 'NA', strand] ## The column to plot is line.name, ['0']*9 is for padding
-            else:
-                outline= [line.chrom, line.start, line.end, use_file_name, ] + ['NA'] * len(pympileup.COUNT_HEADER) + ['generic', line.name, strand]
-            outfile_handle.write('\t'.join([str(x) for x in outline]) + '\n')
-            nlines += 1
+    for line in region_x_infile:
+        if line.name == '':
+            name= 'NA'
+        else:
+            name= line.name
+        if line.strand == '':
+            strand= '.'
+        else:
+            strand= line.strand
+        if infile_name.endswith('.gtf') or infile_name.endswith('.gtf.gz'):
+            outline= [line.chrom, line.start - 1, line.end, use_file_name] + ['NA'] * len(pympileup.COUNT_HEADER) + [line.fields[2], name, strand] ## NA for padding depthACTGNZactgnz
+        elif infile_name.lower().endswith('.bedgraph') or infile_name.lower().endswith('.bedgraph.gz'):
+            outline= [line.chrom, line.start, line.end, use_file_name] + ['0'] * (len(pympileup.COUNT_HEADER)-1) + [line.name, 'coverage', 'NA', strand] ## The column to plot is line.name, ['0']*9 is for padding
+        else:
+            outline= [line.chrom, line.start, line.end, use_file_name, ] + ['NA'] * len(pympileup.COUNT_HEADER) + ['generic', line.name, strand]
+        outfile_handle.write('\t'.join([str(x) for x in outline]) + '\n')
+        nlines += 1
     return(nlines)
 
 def prepare_reference_fasta(fasta_seq_name, maxseq, region, fasta):
-    """Output a reference file with the base at each postion in
-    the region interval
+    """Output a reference file with the sequence of the region interval
     fasta_seq_name:
-        Output name for reference file. Will have format <chrom> <pos> <refbase>
-        included header.
+        Output name for reference file, or a spool.Spool. Will have format
+        <chrom> <start> <end> <sequence> included header, with the sequence on
+        one line. R expands it to one base per position, see seq_to_refbases()
+        in R_functions.R
     maxseq:
         Maximum size of the interval to extract sequence. If exceeded, only the header
         will be in ouput file.
@@ -381,49 +669,185 @@ def prepare_reference_fasta(fasta_seq_name, maxseq, region, fasta):
         pybedtools region. All the bases in this interval will be sent to
         fasta_seq_name
     fasta:
-        Refernce FASTA file from where to extract sequence
+        Refernce FASTA file from where to extract sequence. Read via its .fai
+        index, see fasta.py
     Returns:
         True on success. Side effect produce the reference file *.seq.txt
     """
-    region_seq= open(fasta_seq_name, 'w')
-    region_seq.write('\t'.join(['chrom', 'start', 'end', 'base']) + '\n')
+    region_seq= spool.open_write(fasta_seq_name)
+    region_seq.write('\t'.join(['chrom', 'start', 'end', 'sequence']) + '\n')
     if ((region.end - region.start) <= maxseq) and fasta:
-        fasta_seq= getRefSequence(fasta, region)
-        for line in fasta_seq:
-            region_seq.write('\t'.join([str(x) for x in line]) + '\n')
+        ref= indexed_fasta.get_fasta(fasta)
+        if region.chrom in ref.index:
+            seq= ref.fetch(region.chrom, region.start, region.end)
+            if len(seq) > 0:
+                region_seq.write('\t'.join([region.chrom, str(region.start), str(region.start + len(seq))]) + '\t')
+                region_seq.write(seq.tostring())
+                region_seq.write('\n')
     region_seq.close()
     return(True)
     
-def compressBedGraph(regionWindows, bedgraph_name, use_file_name, bedgraph_grp_fh, col_idx= 4 + len(pympileup.COUNT_HEADER), groupFun= 'mean'):
-    """Compress a bedgraph by dividing it in n windows and averaging windows
-    regionWindows:
-        bed interval divided into n windows by pycoverage.makeWindows
+def read_bedgraph(infile_name, region):
+    """Read the intervals of bedgraph infile_name overlapping region, clipped
+    to region. infile_name can also be the IntervalFile of the bedgraph.
+    Return:
+        Tuple of arrays (starts, ends, values) and the list of values as
+        strings, as found in the input.
+    """
+    starts= []
+    ends= []
+    scores= []
+    if isinstance(infile_name, IntervalFile):
+        starts, ends, lines= infile_name.overlaps(region)
+        scores= [line.rstrip('\r\n').split('\t')[3] for line in lines]
+    elif open(infile_name).readline().strip() != '':
+        infile= pybedtools.BedTool(infile_name)
+        region_x_infile= pybedtools.BedTool().intersect(a= infile,
+            b= pybedtools.BedTool(str(region), from_string= True),
+            sorted= True, stream= True)
+        for line in region_x_infile:
+            starts.append(line.start)
+            ends.append(line.end)
+            scores.append(line.name)
+    values= np.array(scores, dtype= float) if scores != [] else np.zeros(0)
+    return((np.array(starts, dtype= int), np.array(ends, dtype= int), values), scores)
+
+def group_bedgraph_by_window(starts, ends, values, region, n, groupFun= 'mean', coverage= None):
+    """Aggregate bedgraph intervals by the window of region they overlap,
+    each interval weighted by the number of bases overlapping the window.
+    I.e. the result is the same as expanding each interval to one value per
+    base and grouping the bases by window. Bases not covered by any interval
+    are ignored. Only windows overlapping at least one interval are returned.
+    starts, ends, values:
+        Arrays of intervals, sorted and within region, as from read_bedgraph()
+    region, n:
+        pybedtools interval divided into n windows of size pympileup.window_size()
+    groupFun:
+        One of pympileup.GROUP_FUNS
+    coverage:
+        Optional array of the fraction of bases of each interval having a
+        value, e.g. from bigWig zoom summaries. Default is 1 for all intervals.
+        For sum and mean the weight of each interval is overlap * coverage.
+    Return:
+        Tuple of arrays (window starts, window ends, aggregated values)
+    """
+    if groupFun not in pympileup.GROUP_FUNS:
+        raise ValueError('Invalid function to group windows: %s. Valid options are %s' %(groupFun, pympileup.GROUP_FUNS))
+    if len(starts) == 0:
+        return((starts, ends, values))
+    ws= pympileup.window_size(region, n)
+    first_win= (starts - region.start) // ws
+    last_win= (ends - 1 - region.start) // ws
+    ## One item for each interval/window pair
+    nwin= last_win - first_win + 1
+    idx= np.repeat(np.arange(len(starts)), nwin)
+    win= np.repeat(first_win, nwin) + np.arange(nwin.sum()) - np.repeat(np.cumsum(nwin) - nwin, nwin)
+    win_start= region.start + win * ws
+    overlap= np.minimum(ends[idx], win_start + ws) - np.maximum(starts[idx], win_start)
+    if coverage is not None:
+        overlap= overlap * coverage[idx]
+    val= values[idx]
+    if groupFun == 'median':
+        ## Sort by window then value. The median of each window is the
+        ## value at the middle base(s), found on the cumulative overlap.
+        order= np.lexsort((val, win))
+        win, val, overlap= win[order], val[order], overlap[order]
+    first= np.concatenate(([0], np.flatnonzero(np.diff(win)) + 1)) ## First pair of each window
+    win_starts= region.start + win[first] * ws
+    win_ends= np.minimum(win_starts + ws, region.end)
+    if groupFun == 'sum':
+        agg= np.add.reduceat(val * overlap, first)
+    elif groupFun == 'mean':
+        agg= np.add.reduceat(val * overlap, first) / np.add.reduceat(overlap, first).astype(float)
+    elif groupFun == 'max':
+        agg= np.maximum.reduceat(val, first)
+    elif groupFun == 'min':
+        agg= np.minimum.reduceat(val, first)
+    elif groupFun == 'median':
+        cum= np.cumsum(overlap)
+        offset= cum[first] - overlap[first] ## Bases in the preceding windows
+        nbases= np.add.reduceat(overlap, first)
+        lower= np.searchsorted(cum, offset + (nbases - 1) // 2, side= 'right')
+        upper= np.searchsorted(cum, offset + nbases // 2, side= 'right')
+        agg= (val[lower] + val[upper]) / 2.0
+    return((win_starts, win_ends, agg))
+
+def compressBedGraph(region, nwinds, bedgraph_name, use_file_name, bedgraph_grp_fh, groupFun= 'mean'):
+    """Write the intervals of bedgraph_name overlapping region to bedgraph_grp_fh
+    in the format of prepare_nonbam_file(). If there are more than nwinds
+    intervals, compress them by dividing the region in nwinds windows and
+    aggregating the values in each window weighted by overlap, see
+    group_bedgraph_by_window()
     bedgraph_name:
-        bedgraph file to compress and name for output compressed bedgraph.
+        bedgraph file to compress
     use_file_name:
         Put this file name in the output line. Must be the same as original
         input.
     bedgraph_grp_fh:
         Output file handle to write to
-    col_idx:
-        Column index 1 BASED to summarize.
     groupFun:
-        Apply this function to group-by windows. This opt passed to bedtools
-        groupby. Check there for valid options
+        Apply this function to group-by windows. One of pympileup.GROUP_FUNS
+    Return:
+        Number of intervals that overlap `region`
+    """
+    intervals, scores= read_bedgraph(bedgraph_name, region)
+    return(write_coverage_track(region, nwinds, intervals, use_file_name, bedgraph_grp_fh, groupFun, scores))
 
+def compressBigWig(region, nwinds, bigwig_name, use_file_name, bedgraph_grp_fh, groupFun= 'mean'):
+    """As compressBedGraph() for a bigWig file. Only the data in region is
+    read, see bigwig.BigWigFile.
+    If the windows are at least twice the resolution of a zoom level of the
+    bigWig, the precomputed summaries of the coarsest such level are
+    aggregated instead of the base-level data. Summaries straddling two
+    windows are shared proportionally, so values are approximate. Not used
+    for median.
+    Return:
+        Number of base-level intervals or zoom summaries in region
     """
-    ## Assign to each pileup position its window --------------------------
-    if bedgraph_name.endswith('.gz'):
-        ncols= len(gzip.open(bedgraph_name).readline().split('\t')) ## get number of columns in this bedgraph
+    bw= bigwig.get_bigwig(bigwig_name)
+    zoom= None
+    if groupFun != 'median':
+        ## At least two summaries per window, as UCSC does
+        zoom= bw.zoom_level(pympileup.window_size(region, nwinds) / 2)
+    if zoom is None:
+        intervals= bw.fetch(region.chrom, region.start, region.end)
+        return(write_coverage_track(region, nwinds, intervals, use_file_name, bedgraph_grp_fh, groupFun))
+    starts, ends, coverage, mins, maxs, means= bw.fetch_zoom(zoom, region.chrom, region.start, region.end)
+    if groupFun == 'max':
+        values= maxs
+    elif groupFun == 'min':
+        values= mins
     else:
-        ncols= len(open(bedgraph_name).readline().split('\t')) ## get number of columns in this bedgraph
-    bedgraph_winds= pybedtools.BedTool(bedgraph_name).intersect(regionWindows, wb= True, stream= False)
-    ## Aggregate counts in each position by window: -----------------------
-    wind_idx= [ncols+1, ncols+2, ncols+3] ## These are the indexes of the columns containing the windows. 1 based!
-    bedgraph_grp= bedgraph_winds.groupby(g= wind_idx, c= col_idx, o= groupFun, stream= True)
-    for line in bedgraph_grp:
-        outline= [line.chrom, str(line.start), str(line.end), use_file_name] +  ['0'] * (len(pympileup.COUNT_HEADER)-1) + [line.name, 'coverage', 'NA', '.']
-        bedgraph_grp_fh.write('\t'.join(outline) + '\n')
+        values= means
+    intervals= group_bedgraph_by_window(starts, ends, values, region, nwinds, groupFun, coverage)
+    write_coverage_track(region, nwinds, intervals, use_file_name, bedgraph_grp_fh, groupFun)
+    return(len(starts))
+
+def write_coverage_track(region, nwinds, intervals, use_file_name, bedgraph_grp_fh, groupFun= 'mean', scores= None):
+    """Write the coverage intervals to bedgraph_grp_fh, compressed if more
+    than nwinds. See compressBedGraph()
+    intervals:
+        Tuple of arrays (starts, ends, values) within region
+    scores:
+        Optional list of values as strings to write instead of values
+    Return:
+        Number of intervals
+    """
+    starts, ends, values= intervals
+    nlines= len(starts)
+    if nlines > nwinds:
+        starts, ends, values= group_bedgraph_by_window(starts, ends, values, region, nwinds, groupFun)
+    elif scores is not None:
+        for start, end, score in zip(starts, ends, scores):
+            outline= [region.chrom, start, end, use_file_name] + ['0'] * (len(pympileup.COUNT_HEADER)-1) + [score, 'coverage', 'NA', '.']
+            bedgraph_grp_fh.write('\t'.join([str(x) for x in outline]) + '\n')
+        return(nlines)
+    if len(starts) > 0:
+        chrom= str(region.chrom).replace('%', '%%')
+        padding= '\t'.join([use_file_name.replace('%', '%%')] + ['0'] * (len(pympileup.COUNT_HEADER)-1))
+        fmt= '\t'.join([chrom, '%d', '%d', padding, '%.10g', 'coverage', 'NA', '.'])
+        np.savetxt(bedgraph_grp_fh, np.column_stack((starts, ends, values)), fmt= fmt)
+    return(nlines)
 
 def get_open_fds():
     '''Fro debugging: Get number of open files
@@ -4,15 +4,52 @@
 import sys
 import pybedtools
 import os
+import pipes
 import tempfile
 import subprocess
 import gzip
 import re
+import zlib
 import inspect
+import math
+import numpy as np
 import genome_graphs
+import columnar
+import profiler
 
 COUNT_HEADER= ['A', 'a', 'C', 'c', 'G', 'g', 'T', 't', 'N', 'n', 'Z', 'z']
 
+## Counts produced in depth-only mode, see pileup_depth()
+DEPTH_HEADER= ['Z', 'z']
+
+## Approximate number of bytes of mpileupToNucCounts.jar output to parse in one go
+PARSE_CHUNK_SIZE= 8 * 1024 * 1024
+
+## Functions to aggregate positions falling in the same window (--group_fun)
+GROUP_FUNS= ['mean', 'sum', 'max', 'min', 'median']
+
+## Pileup engines: 'java' is samtools mpileup | mpileupToNucCounts.jar, 'native'
+## reads the bam files with pysam.
+ENGINES= ['java', 'native']
+
+## Reads skipped by samtools mpileup by default: unmapped, secondary, qc fail,
+## duplicate
+MPILEUP_SKIP_FLAG= 0x4 | 0x100 | 0x200 | 0x400
+
+## Number of reads for which aligned bases are collected before counting them
+NATIVE_READ_BATCH= 100000
+
+## Maximum number of counts (positions x counts x bam files) piled up at once
+## by pileup_chunks(). Larger regions are piled up in consecutive slices.
+NATIVE_CHUNK_CELLS= 8 * 1024 * 1024
+
+## Index of the forward count of A, C, G, T, N in COUNT_HEADER divided by 2.
+## The reverse count is next to it.
+_NUC_CODE= np.zeros(256, dtype= np.int8) - 1
+for _i, _b in enumerate('ACGTN'):
+    _NUC_CODE[ord(_b)]= _i
+    _NUC_CODE[ord(_b.lower())]= _i
+
 def getLibrarySizes(bams, samtools_path= ''):
     """Get the number of reads for each bam file (library sizes)
     bams:
@@ -20,10 +57,10 @@ def getLibrarySizes(bams, samtools_path= ''):
     Returns:
         Dict as {<bam name>:<tot reads>}    
     """
-    samtools_idx= os.path.join(samtools_path, 'samtools idxstats')
+    samtools_idx= pipes.quote(os.path.join(samtools_path, 'samtools')) + ' idxstats'
     libsizes= {}
     for bam in bams:
-        cmd= samtools_idx + ' ' + bam
+        cmd= samtools_idx + ' ' + pipes.quote(bam)
         proc= subprocess.Popen(cmd, shell= True, stdout= subprocess.PIPE, stderr= subprocess.PIPE)
         idxstat, idxerr= proc.communicate()
         idxstat= idxstat.strip().split('\n')
@@ -47,15 +84,15 @@ def mpileup_cmd(bamlist, region, fasta= None, mpileup= 'samtools mpileup'):
     Return:
         String
     """
-    r= '-r ' + region.chrom + ':' + str(region.start + 1) + '-' + str(region.end)
+    r= '-r ' + pipes.quote(region.chrom + ':' + str(region.start + 1) + '-' + str(region.end))
     if fasta:
-        f= '-f %s' %(fasta)
+        f= '-f %s' %(pipes.quote(fasta))
     else:
         f= ''        
-    cmd= '%(mpileup)s %(f)s -BQ0 -d10000000 %(r)s %(bamlist)s' %{'mpileup': mpileup, 'f': f, 'r': r, 'bamlist': ' '.join(bamlist)}
+    cmd= '%(mpileup)s %(f)s -BQ0 -d10000000 %(r)s %(bamlist)s' %{'mpileup': mpileup, 'f': f, 'r': r, 'bamlist': ' '.join([pipes.quote(x) for x in bamlist])}
     return(cmd)
 
-def mpileup_java_cmd(bamlist, region, fasta= None, mpileup= 'samtools mpileup'):
+def mpileup_java_cmd(bamlist, region, fasta= None, mpileup= 'samtools mpileup', fractions= None, seed= 0, view= 'samtools view'):
     """Compile a command string to execute samtools mpileup piped to
     java mpileupParser
     bamlist:
@@ -66,25 +103,44 @@ def mpileup_java_cmd(bamlist, region, fasta= None, mpileup= 'samtools mpileup'):
         FASTA file to get sequence from.
     mpileup:
         String with the full path to mpileup or just samtools mpileup
-        if the program is on path
+        if the program is on path. Used as it is in the shell command, so the
+        path must be quoted, see pileup_java()
+    fractions, seed:
+        Dict {<bam>: <fraction of reads to keep>} for the bam files to
+        downsample with `samtools view -s <seed>.<fraction>`, see
+        sample_fractions(). The bam files are then streamed to mpileup by
+        samtools view without -r, so mpileup also reports the positions
+        outside region covered by the reads in region.
+    view:
+        As mpileup for samtools view
     Return:
-        String to pass to subprocess.Popen(). Subprocess will return a string
-        formatted as a dict like:
-    {'chrom': 'chr7', 'pos': 5566778, 'base': 'N',
-    0: {'A': 0, 'a': 0, 'C': 1, 'c': 0, 'G': 0, 'g': 0, 'T': 0, 't': 0, 'N': 0, 'n': 0, 'Z': 1, 'z': 0},
-    1: {'A': 0, 'a': 0, 'C': 1, 'c': 0, 'G': 0, 'g': 0, 'T': 0, 't': 0, 'N': 0, 'n': 0, 'Z': 1, 'z': 0},}
-    The numeric keys are one for each bamfile passed to mpileup
-    """
-    r= '-r ' + "'" + region.chrom + ':' + str(region.start + 1) + '-' + str(region.end) + "'"
+        String to pass to subprocess.Popen(). Subprocess will return one line
+        per position with tab separated position and counts, see
+        parse_nuc_counts().
+    """
+    r= '-r ' + pipes.quote(region.chrom + ':' + str(region.start + 1) + '-' + str(region.end))
     if fasta:
-        f= '-f %s' %(fasta)
+        f= '-f %s' %(pipes.quote(fasta))
     else:
         f= ''
+    if fractions:
+        ## Streams from samtools view are not indexed so -r goes to samtools view
+        streams= []
+        for bam in bamlist:
+            if bam in fractions:
+                sample= '-s %s ' %(samtools_sample_arg(seed, fractions[bam]))
+            else:
+                sample= ''
+            streams.append('<(%s -u %s%s %s)' %(view, sample, pipes.quote(bam), r[3:]))
+        bamlist= streams
+        r= ''
+    else:
+        bamlist= [pipes.quote(x) for x in bamlist]
     pathToJar= os.path.split(inspect.getfile(genome_graphs))[0]
     mpileupParserJar= os.path.join(pathToJar, 'mpileupToNucCounts.jar')
     
-    cmd= 'set -e; set -o pipefail; %(mpileup)s %(f)s -BQ0 -d 1000000 %(r)s %(bamlist)s | java -Xmx200m -jar %(mpileupParserJar)s' %{'mpileup': mpileup,
-            'f': f, 'r': r, 'bamlist': ' '.join(bamlist), 'mpileupParserJar': mpileupParserJar}
+    cmd= 'set -e; set -o pipefail; %(mpileup)s %(f)s -BQ0 -d 1000000 %(r)s %(bamlist)s | java -Xmx200m -jar %(mpileupParserJar)s -tsv' %{'mpileup': mpileup,
+            'f': f, 'r': r, 'bamlist': ' '.join(bamlist), 'mpileupParserJar': pipes.quote(mpileupParserJar)}
     return(cmd)
 
                 
@@ -158,8 +214,234 @@ def parse_pileup(pileup_line, bams):
         N += 2
     return(pdict)
 
+def parse_nuc_counts(lines, nbams, count_header= COUNT_HEADER):
+    """Parse in bulk a chunk of lines from mpileupToNucCounts.jar.
+    lines:
+        List of lines as returned by the jar with the -tsv option:
+        <pos> <A.1> ... <A.n> <a.1> ... <z.n>
+    nbams:
+        Number of bam files passed to mpileup
+    Return:
+        Tuple of numpy arrays (pos, counts). pos: 1-based positions. counts:
+        One row per position and one column for each count in count_header
+        for each bam. Columns in the same order as pileupToBed():
+        A.1, A.2, ..., A.n, a.1, ..., z.n
+    """
+    x= np.fromstring(''.join(lines), dtype= int, sep= ' ').reshape(-1, 1 + len(count_header) * nbams)
+    return((x[:, 0], x[:, 1:]))
+
+def write_pileup_bed(fh, chrom, pos, counts):
+    """Write to open file handle fh the pileup counts as bed lines:
+    <chrom> <pos-1> <pos> <counts...>
+    pos, counts:
+        Arrays as returned by parse_nuc_counts()
+    """
+    write_bed_matrix(fh, chrom, pos - 1, pos, counts)
+
+def write_bed_matrix(fh, chrom, starts, ends, values):
+    """Write to open file handle fh one bed line for each row of array values:
+    <chrom> <start> <end> <values...>
+    """
+    if len(starts) == 0:
+        return
+    if values.dtype.kind == 'f':
+        cfmt= '%g'
+    else:
+        cfmt= '%d'
+    fmt= str(chrom).replace('%', '%%') + '\t%d\t%d' + ('\t' + cfmt) * values.shape[1]
+    np.savetxt(fh, np.column_stack((starts, ends, values)), fmt= fmt)
+
+def write_long_counts(filename, chrom, starts, ends, counts, bamlist, count_header= COUNT_HEADER, fractions= None):
+    """Write the counts to filename as binary table (see columnar.py) in the
+    long format used for plotting: One row for each interval and bam file with
+    columns chrom, start, end, file_name, <COUNT_HEADER>, feature, name,
+    strand. Rows are ordered by bam file.
+    counts:
+        Array with one row for each interval and columns grouped by
+        count_header, then by bam, as from parse_nuc_counts()
+    count_header:
+        COUNT_HEADER or DEPTH_HEADER. For depth only counts the nucleotides
+        are 0 and N, n are set to Z, z so that stacked counts sum up to the
+        depth.
+    fractions:
+        Dict {<bam>: <fraction of reads kept>} of downsampled bam files. The
+        fraction goes to the name column of their rows, NA for the others. See
+        read_sample_fractions()
+    """
+    nbams= len(bamlist)
+    n= len(starts)
+    columns= [('chrom', columnar.constant(chrom, n * nbams)),
+              ('start', np.tile(starts, nbams)),
+              ('end', np.tile(ends, nbams)),
+              ('file_name', columnar.factor(bamlist, np.repeat(np.arange(nbams), n)))]
+    long_counts= {}
+    for k, h in enumerate(count_header):
+        long_counts[h]= counts[:, (k * nbams):((k + 1) * nbams)].T.reshape(-1)
+    if count_header == DEPTH_HEADER:
+        long_counts['N']= long_counts['Z']
+        long_counts['n']= long_counts['z']
+    for h in COUNT_HEADER:
+        if h in long_counts:
+            columns.append((h, long_counts[h]))
+        else:
+            columns.append((h, np.zeros(n * nbams, dtype= counts.dtype)))
+    if fractions:
+        levels= ['%.6g' %(fractions.get(bam, 1)) for bam in bamlist]
+        codes= np.repeat([i if bam in fractions else -1 for i, bam in enumerate(bamlist)], n)
+        name= columnar.factor(levels, codes)
+    else:
+        name= columnar.constant(None, n * nbams)
+    columns.extend([('feature', columnar.constant('coverage', n * nbams)),
+                    ('name', name),
+                    ('strand', columnar.constant('.', n * nbams))])
+    columnar.write_columns(filename, columns)
+
+def read_sample_fractions(filename):
+    """Fraction of reads kept for the downsampled bam files in the file from
+    write_long_counts()
+    Return:
+        Dict {<bam>: <fraction>}
+    """
+    columns= columnar.read_columns(filename)
+    fractions= {}
+    for bam, name in zip(columns['file_name'], columns['name']):
+        if name is not None:
+            fractions[bam]= float(name)
+    return(fractions)
+
+def window_size(region, n):
+    """Size of the windows dividing region in n windows. As for bedtools
+    makewindows -n, each window is ceil(<region size>/n) long except the last
+    which may be shorter. If region is shorter than n, each position is a window.
+    """
+    return(max(int(math.ceil((region.end - region.start) / float(n))), 1))
+
+def group_by_window(starts, values, region, n, groupFun= 'mean'):
+    """Aggregate the rows of values by the window of region they fall in.
+    Only windows containing at least one row are returned, as for bedtools
+    intersect | groupby.
+    starts:
+        Array of 0-based positions, sorted, one for each row of values
+    values:
+        2D array to aggregate by column
+    region:
+        pybedtools interval divided into n windows of size window_size()
+    groupFun:
+        One of GROUP_FUNS
+    Return:
+        Tuple of arrays (window starts, window ends, aggregated values)
+    """
+    acc= WindowAccumulator(region, n, groupFun)
+    if len(starts) == 0:
+        return((starts, starts, values))
+    acc.add(starts, values)
+    return(acc.result())
+
+def _window_rows(starts, region, ws):
+    """Window index of the windows of size ws containing the sorted positions
+    starts, index of the first row of each window and number of rows in it
+    """
+    win= (starts - region.start) // ws
+    first= np.concatenate(([0], np.flatnonzero(np.diff(win)) + 1))
+    nrows= np.diff(np.append(first, len(win)))
+    return((win[first], first, nrows))
+
+def _reduce_rows(values, first, nrows, groupFun):
+    """Aggregate the rows of values in groups starting at first, of nrows each.
+    For 'mean' this is the sum, to be divided by the number of rows.
+    """
+    if groupFun in ('sum', 'mean'):
+        return(np.add.reduceat(values, first, axis= 0))
+    if groupFun == 'max':
+        return(np.maximum.reduceat(values, first, axis= 0))
+    if groupFun == 'min':
+        return(np.minimum.reduceat(values, first, axis= 0))
+    ## Median: groups padded with nan to the size of the largest one
+    padded= np.empty((len(first), nrows.max(), values.shape[1]))
+    padded.fill(np.nan)
+    row_in_win= np.arange(values.shape[0]) - np.repeat(first, nrows)
+    padded[np.repeat(np.arange(len(first)), nrows), row_in_win]= values
+    return(np.nanmedian(padded, axis= 1))
+
+class WindowAccumulator(object):
+    """Aggregate by window chunks of rows arriving in order of position, with
+    the same result as group_by_window() on all the rows at once. Only one
+    row per window is kept, so memory is proportional to the number of
+    windows, not to the region size. For 'median' the rows of the last window
+    seen are also kept until the window is complete.
+    region, n, groupFun:
+        As for group_by_window()
+    """
+    def __init__(self, region, n, groupFun= 'mean'):
+        if groupFun not in GROUP_FUNS:
+            raise ValueError('Invalid function to group windows: %s. Valid options are %s' %(groupFun, GROUP_FUNS))
+        self.region= region
+        self.groupFun= groupFun
+        self.ws= window_size(region, n)
+        self.win= []    ## Chunks of window indexes...
+        self.agg= []    ## ...aggregated values...
+        self.nrows= []  ## ...and number of rows of each window
+        self.pending= None ## Rows of the last window, for median
+
+    def add(self, starts, values):
+        """Add the rows of values at 0-based positions starts, sorted and
+        after the positions already added
+        """
+        if len(starts) == 0:
+            return
+        if self.groupFun == 'median':
+            if self.pending is not None:
+                starts= np.concatenate((self.pending[0], starts))
+                values= np.concatenate((self.pending[1], values))
+            last= np.searchsorted((starts - self.region.start) // self.ws, (starts[-1] - self.region.start) // self.ws)
+            self.pending= (starts[last:], values[last:])
+            starts= starts[:last]
+            values= values[:last]
+            if len(starts) == 0:
+                return
+        win, first, nrows= _window_rows(starts, self.region, self.ws)
+        agg= _reduce_rows(values, first, nrows, self.groupFun)
+        if self.win != [] and self.win[-1][-1] == win[0]:
+            ## First window continues the last one of the previous chunk
+            prev= self.agg[-1]
+            if self.groupFun == 'max':
+                prev[-1]= np.maximum(prev[-1], agg[0])
+            elif self.groupFun == 'min':
+                prev[-1]= np.minimum(prev[-1], agg[0])
+            else:
+                prev[-1]= prev[-1] + agg[0]
+            self.nrows[-1][-1] += nrows[0]
+            win, agg, nrows= win[1:], agg[1:], nrows[1:]
+        if len(win) > 0:
+            self.win.append(win)
+            self.agg.append(agg)
+            self.nrows.append(nrows)
+
+    def result(self):
+        """Tuple of arrays (window starts, window ends, aggregated values) of
+        the windows with at least one row
+        """
+        if self.pending is not None:
+            starts, values= self.pending
+            self.pending= None
+            win, first, nrows= _window_rows(starts, self.region, self.ws)
+            self.win.append(win)
+            self.agg.append(_reduce_rows(values, first, nrows, 'median'))
+            self.nrows.append(nrows)
+        if self.win == []:
+            empty= np.zeros(0, dtype= int)
+            return((empty, empty, np.zeros((0, 0))))
+        win= np.concatenate(self.win)
+        agg= np.concatenate(self.agg)
+        if self.groupFun == 'mean':
+            agg= agg / np.concatenate(self.nrows).astype(float)[:, None]
+        win_starts= self.region.start + win * self.ws
+        win_ends= np.minimum(win_starts + self.ws, self.region.end)
+        return((win_starts, win_ends, agg))
+
 def pileupToBed(pdict, bams, count_header= COUNT_HEADER):
-    """Convert the dictionary produced by parse_pileup to a list suitable to
+    """DEPRECATED: The jar output is parsed by parse_nuc_counts()
+    Convert the dictionary produced by parse_pileup to a list suitable to
     be written as bedfile. The bed line as:
     <chrom> <pos-1> <pos> <nuc.1> <nuc.2> ... <nuc.n>
     bams:
@@ -210,10 +492,355 @@ def make_dummy_mpileup(chrom, start, end, nbams, count_header= COUNT_HEADER):
     bedline= [chrom, start, end] + zeros
     return(bedline)
 
-def bamlist_to_mpileup(mpileup_name, mpileup_grp_name, bamlist, region, nwinds, fasta, RPM, regionWindows, samtools, groupFun= 'mean', count_header= COUNT_HEADER):
-    """Output mpileup and grouped mpileup files for list of bam files
+def samtools_sample_arg(seed, fraction):
+    """Argument of samtools view -s: integer part is the seed, decimal part the
+    fraction of reads to keep
+    """
+    fraction= min(max(fraction, 0.000001), 0.999999)
+    return('%d.%s' %(seed, ('%.6f' %(fraction))[2:]))
+
+def pileup_java(bamlist, region, fasta, samtools, count_header= COUNT_HEADER, fractions= None, seed= 0):
+    """Generate chunks of nucleotide counts for the bam files in region using
+    samtools mpileup | mpileupToNucCounts.jar
+    fractions, seed:
+        Downsample the reads as in mpileup_java_cmd()
+    Return:
+        Generator of (pos, counts) tuples, see parse_nuc_counts()
+    """
+    samtools= pipes.quote(os.path.join(samtools, 'samtools'))
+    cmd= mpileup_java_cmd(bamlist= bamlist, region= region, fasta= fasta, mpileup= samtools + ' mpileup',
+        fractions= fractions, seed= seed, view= samtools + ' view')
+    proc= subprocess.Popen(cmd, shell= True, stdout=subprocess.PIPE, stderr= subprocess.PIPE, executable='/bin/bash')
+    while True:
+        ## Use this while loop to avoid reading in memory all the output of mpileup.
+        ## Each chunk of lines is parsed in one go.
+        with profiler.stage('pileup'):
+            lines= proc.stdout.readlines(PARSE_CHUNK_SIZE)
+        if not lines:
+            break
+        with profiler.stage('parse'):
+            chunk= parse_nuc_counts(lines, len(bamlist), count_header)
+            if fractions:
+                ## Positions outside region, see mpileup_java_cmd()
+                inside= (chunk[0] > region.start) & (chunk[0] <= region.end)
+                chunk= (chunk[0][inside], chunk[1][inside])
+        yield(chunk)
+    stdout, stderr= proc.communicate()
+    if proc.returncode != 0:
+        print('\n' + stderr)
+        print('samtools exit code: ' + str(proc.returncode) + '\n')
+        raise Exception('Failed to execute:\n%s' %(cmd))
+
+## Open bam files of this process, see get_bam()
+_BAM_OPEN= {}
+
+def get_bam(bam):
+    """Return the pysam.AlignmentFile of bam, kept open for the next calls in
+    this process. The file is opened again if it changed in the meantime.
+    """
+    import pysam
+    st= os.stat(bam)
+    stamp= (st.st_size, st.st_mtime)
+    if bam in _BAM_OPEN and _BAM_OPEN[bam][0] != stamp:
+        _BAM_OPEN.pop(bam)[1].close()
+    if bam not in _BAM_OPEN:
+        _BAM_OPEN[bam]= (stamp, pysam.AlignmentFile(bam))
+    return(_BAM_OPEN[bam][1])
+
+def read_sampled(name, threshold, seed):
+    """True if the read with this name is kept when downsampling: The seeded
+    hash of the name is below threshold, the fraction of reads to keep times
+    2^32. Mates have the same name so they are kept or dropped together.
+    """
+    return((zlib.crc32(name, seed) & 0xffffffff) < threshold)
+
+def sample_threshold(fraction):
+    return(int(fraction * 2 ** 32))
+
+def span_depth(bam, region):
+    """Largest number of reads spanning a position of region, counting the
+    reads as in pileup_native() from their start to their end. Faster than
+    pileup_depth() since aligned blocks are not considered, so deletions and
+    skipped reference count as covered.
+    """
+    width= region.end - region.start
+    starts= []
+    ends= []
+    for read in get_bam(bam).fetch(region.chrom, region.start, region.end):
+        if read.flag & MPILEUP_SKIP_FLAG:
+            continue
+        if read.is_paired and not read.is_proper_pair:
+            continue
+        starts.append(read.reference_start)
+        ends.append(read.reference_end)
+    if starts == []:
+        return(0)
+    delta= np.bincount(np.clip(np.array(starts) - region.start, 0, width), minlength= width + 1)
+    delta -= np.bincount(np.clip(np.array(ends) - region.start, 0, width), minlength= width + 1)
+    return(np.cumsum(delta[:-1]).max())
+
+def sample_fractions(bamlist, region, max_depth):
+    """Fraction of reads to keep in each bam file so that the largest depth in
+    region is about max_depth.
+    Return:
+        Dict {<bam>: <fraction>} for the bam files with depth > max_depth
+    """
+    fractions= {}
+    for bam in bamlist:
+        if get_bam(bam).count(region.chrom, region.start, region.end) <= max_depth:
+            ## Depth cannot be more than the number of reads
+            continue
+        top= span_depth(bam, region)
+        if top > max_depth:
+            fractions[bam]= float(max_depth) / top
+    return(fractions)
+
+def pileup_native(bamlist, region, count_header= COUNT_HEADER, fractions= None, seed= 0):
+    """Count nucleotides for the bam files in region reading the alignments
+    with pysam. Counts are the same as from mpileup_java_cmd(), i.e.
+    `samtools mpileup -BQ0`: Unmapped, secondary, qc fail, duplicate reads and
+    paired reads not in proper pair are skipped. Deletions and skipped
+    reference (N) are not counted but positions covered only by them are
+    reported (with 0 counts).
+    count_header:
+        Only the default COUNT_HEADER is supported
+    fractions, seed:
+        Dict {<bam>: <fraction of reads to keep>} for the bam files to
+        downsample, see sample_fractions() and read_sampled(). Counts are not
+        rescaled.
+    Return:
+        Tuple (pos, counts) like parse_nuc_counts()
+    """
+    nbams= len(bamlist)
+    ncounts= len(count_header)
+    width= region.end - region.start
+    counts= np.zeros((width, ncounts, nbams), dtype= int)
+    covered= np.zeros(width + 1, dtype= int)
+    for i, bam in enumerate(bamlist):
+        reads= get_bam(bam).fetch(region.chrom, region.start, region.end)
+        if fractions and bam in fractions:
+            threshold= sample_threshold(fractions[bam])
+        else:
+            threshold= None
+        while True:
+            nreads= count_aligned_bases(reads, region.start, counts[:, :, i], covered, NATIVE_READ_BATCH, threshold, seed)
+            if nreads < NATIVE_READ_BATCH:
+                break
+    fwd= range(0, 10, 2)
+    counts[:, 10, :]= counts[:, fwd, :].sum(axis= 1) ## Z
+    counts[:, 11, :]= counts[:, [x + 1 for x in fwd], :].sum(axis= 1) ## z
+    idx= np.nonzero(np.cumsum(covered[:-1]) > 0)[0]
+    return((idx + region.start + 1, counts[idx].reshape(-1, ncounts * nbams)))
+
+def count_aligned_bases(reads, offset, counts, covered, nmax, threshold= None, seed= 0):
+    """Add to array counts the bases of the next nmax reads from iterator reads
+    counts:
+        Array of shape (<region width>, >=10) with one row per position (0 is
+        offset) and columns A, a, C, c, G, g, T, t, N, n. Updated in place.
+    covered:
+        Array of length <region width> + 1 updated in place with +1 at the
+        start and -1 at the end of each read. Its cumsum is the depth
+        including deletions and ref skips.
+    threshold, seed:
+        If threshold is not None only the reads selected by read_sampled()
+        are counted
+    Return:
+        Number of reads consumed from the iterator
+    """
+    width= counts.shape[0]
+    block_ref= []   ## Start on reference of each aligned block...
+    block_qry= []   ## ...its start in the concatenated read sequences...
+    block_len= []   ## ...its length...
+    block_rev= []   ## ...and strand
+    seqs= []
+    qoffset= 0
+    nreads= 0
+    for read in reads:
+        nreads += 1
+        if read.flag & MPILEUP_SKIP_FLAG:
+            pass
+        elif read.is_paired and not read.is_proper_pair:
+            pass
+        elif threshold is not None and not read_sampled(read.query_name, threshold, seed):
+            pass
+        elif read.query_sequence is not None:
+            rpos= read.reference_start
+            qpos= qoffset
+            rev= int(read.is_reverse)
+            for op, n in read.cigartuples:
+                if op in (0, 7, 8): ## M, =, X
+                    block_ref.append(rpos)
+                    block_qry.append(qpos)
+                    block_len.append(n)
+                    block_rev.append(rev)
+                    rpos += n
+                    qpos += n
+                elif op in (1, 4): ## I, S
+                    qpos += n
+                elif op in (2, 3): ## D, N
+                    rpos += n
+            seqs.append(read.query_sequence)
+            qoffset += len(read.query_sequence)
+            covered[max(read.reference_start - offset, 0)] += 1
+            covered[min(max(rpos - offset, 0), width)] -= 1
+        if nreads == nmax:
+            break
+    if block_len == []:
+        return(nreads)
+    ## Expand blocks to one item per aligned base
+    block_len= np.array(block_len)
+    nbases= block_len.sum()
+    within= np.arange(nbases) - np.repeat(np.cumsum(block_len) - block_len, block_len)
+    ref= np.repeat(np.array(block_ref) - offset, block_len) + within
+    qry= np.repeat(np.array(block_qry), block_len) + within
+    col= _NUC_CODE[np.frombuffer(''.join(seqs), dtype= np.uint8)[qry]].astype(int) * 2 + np.repeat(np.array(block_rev), block_len)
+    keep= (ref >= 0) & (ref < width) & (col >= 0)
+    counts[:, 0:10] += np.bincount(ref[keep] * 10 + col[keep], minlength= width * 10).reshape(width, 10)
+    return(nreads)
+
+def pileup_depth(bamlist, region):
+    """Strand specific depth for the bam files in region, i.e. the columns Z
+    and z of pileup_native() without counting the individual nucleotides.
+    Depth is accumulated from the aligned blocks of each read as +1 at the
+    block start and -1 at the block end. Reads are filtered as in
+    pileup_native().
+    Return:
+        Tuple (pos, counts) like parse_nuc_counts() with count header
+        DEPTH_HEADER
+    """
+    nbams= len(bamlist)
+    width= region.end - region.start
+    ## Change of depth at each position for each bam and strand, plus read
+    ## spans to report the same positions as pileup_native()
+    delta= np.zeros((width + 1, len(DEPTH_HEADER), nbams), dtype= int)
+    covered= np.zeros(width + 1, dtype= int)
+    for i, bam in enumerate(bamlist):
+        reads= get_bam(bam).fetch(region.chrom, region.start, region.end)
+        while True:
+            nreads= accumulate_depth(reads, region.start, delta[:, :, i], covered, NATIVE_READ_BATCH)
+            if nreads < NATIVE_READ_BATCH:
+                break
+    depth= np.cumsum(delta[:-1], axis= 0)
+    idx= np.nonzero(np.cumsum(covered[:-1]) > 0)[0]
+    return((idx + region.start + 1, depth[idx].reshape(-1, len(DEPTH_HEADER) * nbams)))
+
+def accumulate_depth(reads, offset, delta, covered, nmax):
+    """Add to array delta the start (+1) and end (-1) of the aligned blocks
+    of the next nmax reads from iterator reads.
+    delta:
+        Array of shape (<region width> + 1, 2) for forward and reverse reads.
+        Updated in place.
+    covered:
+        As for count_aligned_bases()
+    Return:
+        Number of reads consumed from the iterator
+    """
+    width= delta.shape[0] - 1
+    block_start= []
+    block_end= []
+    block_rev= []
+    nreads= 0
+    for read in reads:
+        nreads += 1
+        if read.flag & MPILEUP_SKIP_FLAG:
+            pass
+        elif read.is_paired and not read.is_proper_pair:
+            pass
+        elif read.query_sequence is not None:
+            blocks= read.get_blocks()
+            rev= int(read.is_reverse)
+            for start, end in blocks:
+                block_start.append(start)
+                block_end.append(end)
+                block_rev.append(rev)
+            covered[min(max(read.reference_start - offset, 0), width)] += 1
+            covered[min(max(read.reference_end - offset, 0), width)] -= 1
+        if nreads == nmax:
+            break
+    if block_start == []:
+        return(nreads)
+    block_rev= np.array(block_rev)
+    start= np.clip(np.array(block_start) - offset, 0, width)
+    end= np.clip(np.array(block_end) - offset, 0, width)
+    size= (width + 1) * 2
+    delta += np.bincount(start * 2 + block_rev, minlength= size).reshape(width + 1, 2)
+    delta -= np.bincount(end * 2 + block_rev, minlength= size).reshape(width + 1, 2)
+    return(nreads)
+
+def pileup_region(bamlist, region, fasta, samtools, engine= 'java', depth_only= False):
+    """Pileup of the bam files in region collected in memory, to be shared by
+    several regions with slice_pileup(). Arguments as in bamlist_to_mpileup()
+    Return:
+        Tuple (pos, counts) like parse_nuc_counts() with count header
+        COUNT_HEADER or DEPTH_HEADER if depth_only
+    """
+    if depth_only:
+        return(pileup_depth(bamlist, region))
+    if engine == 'native':
+        return(pileup_native(bamlist, region))
+    chunks= list(pileup_java(bamlist, region, fasta, samtools))
+    if chunks == []:
+        return((np.zeros(0, dtype= int), np.zeros((0, len(COUNT_HEADER) * len(bamlist)), dtype= int)))
+    return((np.concatenate([x[0] for x in chunks]), np.concatenate([x[1] for x in chunks])))
+
+def pileup_chunks(bamlist, region, depth_only= False, fractions= None, seed= 0):
+    """Generate the pileup of region with pileup_native(), or pileup_depth()
+    if depth_only, in consecutive slices of region so that each slice has at
+    most NATIVE_CHUNK_CELLS counts. Reads overlapping two slices are fetched
+    for both and each slice counts only its own positions. fractions and
+    seed are passed to pileup_native().
+    Return:
+        Generator of (pos, counts) tuples, see parse_nuc_counts()
+    """
+    if depth_only:
+        ncounts= len(DEPTH_HEADER)
+    else:
+        ncounts= len(COUNT_HEADER)
+    width= max(NATIVE_CHUNK_CELLS // (ncounts * len(bamlist)), 1)
+    for start in range(region.start, region.end, width):
+        xregion= pybedtools.Interval(region.chrom, start, min(start + width, region.end))
+        with profiler.stage('pileup'):
+            if depth_only:
+                chunk= pileup_depth(bamlist, xregion)
+            else:
+                chunk= pileup_native(bamlist, xregion, fractions= fractions, seed= seed)
+        yield(chunk)
+
+def slice_pileup(pileup, region, nbams, depth_only= False):
+    """Extract region from the pileup returned by pileup_region() for a
+    larger interval containing region.
+    nbams:
+        Number of bam files in the pileup
+    depth_only:
+        Return only the columns DEPTH_HEADER. The pileup can have either
+        COUNT_HEADER or DEPTH_HEADER columns.
+    Return:
+        Tuple (pos, counts) for the positions in region
+    """
+    pos, counts= pileup
+    i= np.searchsorted(pos, region.start + 1)
+    j= np.searchsorted(pos, region.end, side= 'right')
+    pos= pos[i:j]
+    counts= counts[i:j]
+    if depth_only and counts.shape[1] != len(DEPTH_HEADER) * nbams:
+        ## Columns are grouped by header, then by bam
+        cols= []
+        for h in DEPTH_HEADER:
+            k= COUNT_HEADER.index(h) * nbams
+            cols.extend(range(k, k + nbams))
+        counts= counts[:, cols]
+    return((pos, counts))
+
+def bamlist_to_mpileup(mpileup_name, mpileup_grp_name, bamlist, region, nwinds, fasta, RPM, samtools, groupFun= 'mean', count_header= COUNT_HEADER, engine= 'java', libsizes= None, depth_only= False, pileup= None, keep_pileup= False, max_depth_sample= 0, sample_seed= 0):
+    """Output mpileup and grouped mpileup files for list of bam files.
+    The pileup is folded into the windows as it is generated, chunk by chunk,
+    so the per-base counts of large regions are never held in memory.
     mpileup_name, mpileup_grp_name:
-        Name for output mpileup and grouped mpileup file
+        Name for output mpileup and grouped mpileup file. The grouped file is
+        binary in long format, see write_long_counts(), and can be a
+        spool.Spool. The per-base mpileup_name is written only if the region
+        has no more than nwinds positions or keep_pileup is True, never if
+        mpileup_name is None (--in_memory).
     bamlist:
         List of bam files
     region:
@@ -225,80 +852,116 @@ def bamlist_to_mpileup(mpileup_name, mpileup_grp_name, bamlist, region, nwinds,
         fasta file for mpileup reference
     RPM:
         True/False for whether mpileup counts should be normlaized to RPM
-    regionWindows:
-        bed interval divided into regions by (output of) pycoverage.makeWindows
     samtools:
         Path to samtools (just the path, e.g. /home/myself/bin)
     groupFun:
-        Apply this function to group-by windows. This opt passed to bedtools
-        groupby. Check there for valid options
+        Apply this function to group-by windows. One of GROUP_FUNS, see
+        group_by_window()
+    engine:
+        One of ENGINES: 'java' for pileup_java() or 'native' for pileup_native()
+    libsizes:
+        Dict {<bam>: <library size>} to use with RPM. If None, get them with
+        getLibrarySizes()
+    depth_only:
+        Only compute the strand specific depth (columns DEPTH_HEADER) with
+        pileup_depth(), regardless of engine. For regions too large to show
+        individual nucleotides.
+    pileup:
+        Pileup of an interval containing region, from pileup_region(). If
+        given, region is sliced from it instead of piling up the bam files
+        again.
+    keep_pileup:
+        Always write the per-base counts to mpileup_name (--keep_pileup)
+    max_depth_sample, sample_seed:
+        If max_depth_sample > 0, downsample the reads of the bam files with
+        depth larger than this (see sample_fractions()) and scale the counts
+        back by the inverse of the fraction of reads kept. Not applied to
+        depth_only or to a given pileup.
     Returns:
-        True on success. Side effect is to produce *.mpileup.bed.txt, *.grp.bed.txt
-    """
-    ## Make header line for grouped bed files (*.grp.bed.txt) from mpileup
-    ## --------------------------------------------------------------------------
-    header= ['chrom', 'start', 'end']
-    for h in count_header:
-        header.extend([x + '.' + h for x in bamlist])
-    header= '\t'.join(header)
-    mpileup_bed= open(mpileup_name, 'w')
+        Dict {<bam>: <fraction of reads kept>} of the downsampled bam files.
+        Side effect is to produce *.grp.bin and, see above, *.mpileup.bed.txt
+    """
+    if depth_only:
+        count_header= DEPTH_HEADER
+    fractions= {}
+    if max_depth_sample > 0 and not depth_only and pileup is None:
+        with profiler.stage('sample_depth'):
+            fractions= sample_fractions(bamlist, region, max_depth_sample)
+    if fractions:
+        ## Multiplier for each column of counts
+        sample_scale= np.tile(np.array([1 / fractions.get(x, 1.0) for x in bamlist]), len(count_header))
     if RPM:
-        libsizes= getLibrarySizes(bamlist, samtools_path= samtools)
-        libsizes= [libsizes[x] for x in bamlist]
-    cmd= mpileup_java_cmd(bamlist= bamlist, region= region, fasta= fasta, mpileup= os.path.join(samtools, 'samtools mpileup'))
-    proc= subprocess.Popen(cmd, shell= True, stdout=subprocess.PIPE, stderr= subprocess.PIPE, executable='/bin/bash')
+        if libsizes is None:
+            libsizes= getLibrarySizes(bamlist, samtools_path= samtools)
+        ## Divisor for each column of counts. Same as recycling in rpm()
+        rpm_libsizes= np.tile(np.array([libsizes[x] for x in bamlist], dtype= float), len(count_header)) / 1000000
+    if pileup is not None:
+        chunks= [slice_pileup(pileup, region, len(bamlist), depth_only)]
+    elif depth_only or engine == 'native':
+        ## Stage pileup is timed by pileup_chunks() chunk by chunk
+        chunks= pileup_chunks(bamlist, region, depth_only, fractions, sample_seed)
+    else:
+        ## Stages pileup and parse are timed by pileup_java() chunk by chunk
+        chunks= pileup_java(bamlist, region, fasta, samtools, count_header, fractions, sample_seed)
+    if keep_pileup:
+        mpileup_bed= open(mpileup_name, 'w')
+    acc= WindowAccumulator(region, nwinds, groupFun)
     nlines= 0
-    while True:
-        ## Use this while loop to avoid reading in memory all the output of mpileup.
-        ## See also http://stackoverflow.com/questions/2804543/read-subprocess-stdout-line-by-line
-        line= proc.stdout.readline()
-        sys.stdout.flush()
-        if not line:
-            break
-        pd= eval(line)
-#        pd= parse_pileup(line, bamlist)
-        bedline= pileupToBed(pd, bamlist)
-        cnt_indx= 3 ## Column index in bedline where counts start (4th columns)
+    ## Per-base chunks, kept only as long as there are no more than nwinds
+    ## positions. Then they go to the window accumulator.
+    pos_chunks= []
+    count_chunks= []
+    for pos, counts in chunks:
+        if fractions:
+            counts= counts * sample_scale
         if RPM:
-            bedline= bedline[0:cnt_indx] + rpm(bedline[cnt_indx:], libsizes)
-        mpileup_bed.write('\t'.join([str(x) for x in bedline]) + '\n')
-        nlines += 1
-    stdout, stderr= proc.communicate()
-    if proc.returncode != 0:
-        print('\n' + stderr)
-        print('samtools exit code: ' + str(proc.returncode) + '\n')
-        raise Exception('Failed to execute:\n%s' %(cmd))
-    mpileup_bed.close()
-    if os.stat(mpileup_name).st_size == 0:
-        mpileup_bed= open(mpileup_name, 'w')
-        bedline= make_dummy_mpileup(region.chrom, region.start, region.start + 1, len(bamlist))
-        mpileup_bed.write('\t'.join([str(x) for x in bedline]) + '\n')
+            counts= counts / rpm_libsizes
+        if keep_pileup:
+            write_pileup_bed(mpileup_bed, region.chrom, pos, counts)
+        windowed= nlines > nwinds
+        nlines += len(pos)
+        if windowed:
+            with profiler.stage('windowing'):
+                acc.add(pos - 1, counts)
+            continue
+        pos_chunks.append(pos)
+        count_chunks.append(counts)
+        if nlines > nwinds:
+            ## Divide interval in nwinds regions since the number of
+            ## positions to plot is >nwinds and aggregate the counts in each
+            ## window.
+            with profiler.stage('windowing'):
+                for xpos, xcounts in zip(pos_chunks, count_chunks):
+                    acc.add(xpos - 1, xcounts)
+            pos_chunks= []
+            count_chunks= []
+    if keep_pileup:
         mpileup_bed.close()
-    mpileup_grp_fout= open(mpileup_grp_name, 'w')
-    if nlines > nwinds:
-        """Divide interval in nwinds regions if the number of positions to plot is >nwinds
-        
-        Issue with pybedtools leaking file handles:
-            It seems that intersect(stream= False)
-            and .groupby(stream= True) doesn't leak (?!)
-        """
-        mpileup_winds= pybedtools.BedTool(mpileup_name).intersect(regionWindows, wb= True, stream= False)  ## Assign to each pileup position its window
-        pile_cols= range(cnt_indx+1, len(bedline)+1) ## Indexes of columns with counts 1-BASED!
-        wind_idx= [len(bedline)+1, len(bedline)+2, len(bedline)+3] ## These are the indexes of the columns containing the windows
-        mpileup_grp= mpileup_winds.groupby(g= wind_idx, c= pile_cols, o= [groupFun] * len(pile_cols), stream= True) ## Aggregate counts in each position by window
-        mpileup_grp_fout.write(header + '\n')
-        for line in mpileup_grp:
-            mpileup_grp_fout.write(str(line))
+    if nlines == 0:
+        ## Dummy line so that regions without reads are plotted
+        bedline= make_dummy_mpileup(region.chrom, region.start, region.start + 1, len(bamlist), count_header)
+        if mpileup_name is not None:
+            mpileup_bed= open(mpileup_name, 'w')
+            mpileup_bed.write('\t'.join([str(x) for x in bedline]) + '\n')
+            mpileup_bed.close()
+        starts= np.array(bedline[1:2])
+        ends= np.array(bedline[2:3])
+        counts= np.array([bedline[3:]])
+    elif nlines > nwinds:
+        with profiler.stage('windowing'):
+            starts, ends, counts= acc.result()
     else:
-        """If all the positions are to be plotted (nlines < nwinds), copy the output of
-        mpileup with the header line.
-        """
-        mpileup_bed= open(mpileup_name)
-        mpileup_grp_fout.write(header + '\n')        
-        for line in mpileup_bed:
-            mpileup_grp_fout.write(str(line))
-    mpileup_grp_fout.close()        
-    return(True)
+        pos= np.concatenate(pos_chunks)
+        counts= np.concatenate(count_chunks)
+        starts= pos - 1
+        ends= pos
+        if not keep_pileup and mpileup_name is not None:
+            mpileup_bed= open(mpileup_name, 'w')
+            write_pileup_bed(mpileup_bed, region.chrom, pos, counts)
+            mpileup_bed.close()
+    with profiler.stage('write_counts'):
+        write_long_counts(mpileup_grp_name, region.chrom, starts, ends, counts, bamlist, count_header, fractions)
+    return(fractions)
     
 def normMultiCovLine(line):
     """line is a line of output from multi_bam_coverage. Divide each count by
@@ -0,0 +1,478 @@
+"""Draw the plots with matplotlib instead of R, see --renderer python.
+
+The layout follows R_template.R: a top panel with the title, one panel for
+each group of overplotted tracks and a bottom panel with the x-axis and the
+reference sequence. The input files are the same as for R: *.grp.bin for bam
+files, *.nonbam.bed.txt for the other files and *.seq.txt for the reference.
+Rectangles and lines are added as collections built from the arrays of
+coordinates, not one by one.
+
+Colours are given as in R. Names known to matplotlib, '#RRGGBB[AA]' and
+greyNN are understood. Other R names with a numeric suffix (e.g. firebrick4)
+are looked up in R_COLOURS or the suffix is dropped.
+"""
+
+import os
+import re
+import numpy as np
+import columnar
+import pympileup
+import spool
+
+## R colours with numeric suffix used as defaults or commonly given
+R_COLOURS= {'firebrick4': '#8B1A1A', 'firebrick3': '#CD2626', 'firebrick1': '#FF3030',
+    'red4': '#8B0000', 'blue4': '#00008B', 'green4': '#008B00', 'darkgoldenrod1': '#FFB90F',
+    'dodgerblue4': '#104E8B', 'steelblue4': '#36648B', 'orange3': '#CD8500'}
+
+COVERAGE_EXT= ['bedGraph', 'bedgraph', 'bam', 'bw', 'bigWig', 'bigwig']
+
+## Size of one line of margin in inches at pointsize 12, as par('csi') in R
+LINE_HEIGHT= 0.2
+
+def r_colour(col):
+    """Convert the R colour col to a matplotlib colour
+    """
+    if col is None or col in ('NA', 'transparent'):
+        return('none')
+    col= str(col)
+    if col.startswith('#'):
+        return(col)
+    m= re.match('^gr[ae]y(\d+)$', col)
+    if m:
+        level= int(round(int(m.group(1)) * 255 / 100.0))
+        return('#%02x%02x%02x' %(level, level, level))
+    if col in R_COLOURS:
+        return(R_COLOURS[col])
+    return(re.sub('\d+$', '', col))
+
+def make_transparent(col, alpha= 50):
+    """RGBA tuple for colour col with alpha in [0, 100], as makeTransparent()
+    in R_functions.R
+    """
+    from matplotlib.colors import to_rgba
+    rgba= to_rgba(r_colour(col))
+    return((rgba[0], rgba[1], rgba[2], np.floor(255 * alpha / 100.0) / 255))
+
+def recycle(n, y):
+    """Recycle or trim list y to length n, as recycle() in R_functions.R.
+    None gives a list of None
+    """
+    if y is None or len(y) == 0:
+        return([None] * n)
+    return([y[i % len(y)] for i in range(n)])
+
+def set_overplotting(overplot, n):
+    """Overplot group of each of n tracks, as setOverplotting() in
+    R_functions.R. Groups are numbered from 1 with no gaps.
+    """
+    overplot= list(overplot)[0:n]
+    if 'NA' in [str(x) for x in overplot]:
+        return(range(1, n + 1))
+    ranks= sorted(set(overplot))
+    overplot= [ranks.index(x) + 1 for x in overplot]
+    nextra= n - len(overplot)
+    return(overplot + range(max(overplot) + 1, max(overplot) + 1 + nextra))
+
+def track_type(filename):
+    """'coverage' or 'annotation' from the file extension, as
+    filename2tracktype() in R_functions.R
+    """
+    filename= re.sub('\.gz', '', filename)
+    if os.path.splitext(filename)[1].lstrip('.') in COVERAGE_EXT:
+        return('coverage')
+    return('annotation')
+
+def to_float(x):
+    try:
+        return(float(x))
+    except (TypeError, ValueError):
+        return(np.nan)
+
+def track_params(args, inputlist, names):
+    """List of dicts with the parameters of each track, sorted by overplot
+    group as in R_template.R
+    """
+    n= len(inputlist)
+    keys= ['col_line', 'lwd', 'col_text_ann', 'col_track', 'col_track_rev', 'col_names',
+        'col_mark', 'bg', 'col_grid', 'ymax', 'ymin', 'ylab', 'col_yaxis', 'cex_lab', 'vheights']
+    values= dict([(k, recycle(n, getattr(args, k))) for k in keys])
+    values['snames']= recycle(n, names)
+    values['overplot']= set_overplotting(args.overplot, n)
+    params= []
+    for i, file_name in enumerate(inputlist):
+        p= dict([(k, values[k][i]) for k in values])
+        p['file_name']= file_name
+        p['feature']= track_type(file_name)
+        p['input_order']= i
+        p['vheights']= to_float(p['vheights'])
+        params.append(p)
+    params.sort(key= lambda p: (p['overplot'], p['input_order']))
+    return(params)
+
+def read_nonbam(nonbam):
+    """Read the *.nonbam.bed.txt file, or spool.Spool, written by
+    pycoverage.prepare_nonbam_file() and friends.
+    Return:
+        Dict of columns file_name, start, end, totZ, feature, name, strand
+    """
+    data= {'file_name': [], 'start': [], 'end': [], 'totZ': [], 'feature': [], 'name': [], 'strand': []}
+    ncounts= len(pympileup.COUNT_HEADER)
+    for line in spool.open_read(nonbam):
+        line= line.rstrip('\n').split('\t')
+        if len(line) < 4 + ncounts + 3:
+            continue
+        data['file_name'].append(line[3])
+        data['start'].append(int(line[1]))
+        data['end'].append(int(line[2]))
+        Z= to_float(line[3 + ncounts - 1])
+        z= to_float(line[3 + ncounts])
+        data['totZ'].append(Z + z)
+        data['feature'].append(line[4 + ncounts])
+        data['name'].append(line[5 + ncounts])
+        data['strand'].append(line[6 + ncounts])
+    for k in ['start', 'end', 'totZ']:
+        data[k]= np.array(data[k], dtype= float)
+    return(data)
+
+def split_by_file(columns):
+    """Split the dict of columns by the column file_name
+    Return:
+        Dict {<file name>: <dict of columns as arrays>}
+    """
+    file_names= np.array(columns['file_name'], dtype= object)
+    by_file= {}
+    for f in set(columns['file_name']):
+        idx= np.nonzero(file_names == f)[0]
+        by_file[f]= dict([(k, np.asarray(v, dtype= None if isinstance(v, np.ndarray) else object)[idx]) for k, v in columns.items()])
+    return(by_file)
+
+def read_refbases(refbases):
+    """Read the *.seq.txt file, or spool.Spool, written by
+    pycoverage.prepare_reference_fasta()
+    Return:
+        Tuple (start of sequence, upper case sequence). Sequence is '' if there
+        is none
+    """
+    lines= spool.open_read(refbases).readlines()
+    if len(lines) < 2 or lines[1].strip() == '':
+        return((0, ''))
+    chrom, start, end, seq= lines[1].rstrip('\n').split('\t')
+    return((int(start), seq.upper()))
+
+def track_colours(p):
+    """Colours for forward and reverse of the track p as in R_template.R
+    """
+    if p['col_track'] in ('', None):
+        if p['feature'] == 'coverage':
+            col= make_transparent('grey', 90)
+        else:
+            col= r_colour('firebrick4')
+    else:
+        col= r_colour(p['col_track'])
+    if p['col_track_rev'] in ('', None):
+        if p['feature'] == 'coverage':
+            col_rev= r_colour('pink')
+        else:
+            col_rev= r_colour('firebrick4')
+    elif p['col_track_rev'] == 'NA':
+        col_rev= col
+    else:
+        col_rev= r_colour(p['col_track_rev'])
+    return((col, col_rev))
+
+def nuc_colours(col_nuc):
+    """Colours of A, C, G, T for mismatches, with the defaults of R_template.R
+    """
+    defaults= [make_transparent(x, 80) for x in ['green', 'blue', 'orange', 'red']]
+    cols= recycle(4, col_nuc)
+    return([defaults[i] if cols[i] in ('', None) else r_colour(cols[i]) for i in range(4)])
+
+def add_rects(ax, x0, x1, y0, y1, facecolors, edgecolor):
+    """Add the rectangles (x0, y0)-(x1, y1) to ax as one collection. Empty
+    rectangles are skipped
+    """
+    from matplotlib.collections import PolyCollection
+    keep= (y1 != y0) & ~np.isnan(y0) & ~np.isnan(y1)
+    if not np.any(keep):
+        return
+    if isinstance(facecolors, np.ndarray) and facecolors.ndim == 2:
+        facecolors= facecolors[keep]
+    x0, x1, y0, y1= x0[keep], x1[keep], y0[keep], y1[keep]
+    verts= np.empty((len(x0), 4, 2))
+    verts[:, 0, 0]= x0
+    verts[:, 0, 1]= y0
+    verts[:, 1, 0]= x0
+    verts[:, 1, 1]= y1
+    verts[:, 2, 0]= x1
+    verts[:, 2, 1]= y1
+    verts[:, 3, 0]= x1
+    verts[:, 3, 1]= y0
+    ax.add_collection(PolyCollection(verts, facecolors= facecolors, edgecolors= edgecolor, linewidths= 0.3))
+
+def add_bdg_lines(ax, start, end, score, colour, lwd):
+    """Profile line of a bedgraph, as lines.bdg() in R_functions.R: horizontal
+    segments at each score joined by vertical segments where features are
+    adjacent.
+    """
+    from matplotlib.collections import LineCollection
+    n= len(start)
+    if n == 0:
+        return
+    segs= [np.column_stack((start, score, end, score)).reshape(-1, 2, 2)]
+    if n > 1:
+        disc= start[1:] - end[:-1]
+        gaps= np.nonzero(np.diff(disc) > 0)[0] + 1
+        nogaps= np.setdiff1d(np.arange(n - 1), gaps)
+        segs.append(np.column_stack((end[nogaps], score[nogaps], end[nogaps], score[nogaps + 1])).reshape(-1, 2, 2))
+    segs= np.concatenate(segs)
+    segs= segs[~np.isnan(segs).any(axis= 2).any(axis= 1)]
+    ax.add_collection(LineCollection(segs, colors= r_colour(colour), linewidths= to_float(lwd) * 0.75))
+
+def plot_heights(params, mar_heights):
+    """Relative heights of the top panel, of each overplot group and of the
+    bottom panel, as in R_template.R and setPlotHeights()
+    """
+    groups= []
+    heights= []
+    features= []
+    all_na= all([np.isnan(p['vheights']) for p in params])
+    for p in params:
+        if p['overplot'] in groups:
+            continue
+        groups.append(p['overplot'])
+        features.append(p['feature'])
+        if all_na:
+            heights.append(1.0 if p['feature'] == 'coverage' else 1/6.0)
+        else:
+            heights.append(p['vheights'])
+    if all([x < 0 for x in mar_heights]):
+        ann= [h for h, f in zip(heights, features) if f != 'coverage']
+        if ann != []:
+            ref= np.mean(ann)
+            top, bottom= ref * 0.75, ref * 2
+        else:
+            ref= np.mean(heights) / 4
+            top, bottom= ref * 0.5, ref * 2
+    else:
+        top, bottom= mar_heights
+    return([top] + heights + [bottom])
+
+def figure_height(params, pwidth):
+    """Height in cm as setHeight() in R_functions.R
+    """
+    ncoverage= len(set([p['overplot'] for p in params if p['feature'] == 'coverage']))
+    nannotation= len(set([p['overplot'] for p in params if p['feature'] != 'coverage']))
+    if ncoverage == 0:
+        return(pwidth / 10.0 * nannotation)
+    return(pwidth / 5.0 + (pwidth / 6.0 * ncoverage) + (pwidth / 10.0 * nannotation))
+
+def plot_name(chrom, bstart, bend, title):
+    """Title of the plot as makePlotName() in R_functions.R
+    """
+    region= '%s:%s-%s' %(chrom, '{:,}'.format(bstart), '{:,}'.format(bend))
+    if title is None or title == 'None':
+        return(region)
+    return(title.replace(':region:', region))
+
+def plot_region(plotfile, args, inputlist, names, mcov, nonbam, refbases, bstart, bend, xregion):
+    """Draw the plot for one region to plotfile. The format (pdf, png, svg) is
+    from the extension of plotfile, or args.format if plotfile is a
+    spool.Spool.
+    args:
+        Parsed command line arguments with the graphical options
+    inputlist, names:
+        Input files, with duplicates, and their sample names
+    mcov, nonbam, refbases:
+        Names of the *.grp.bin, *.nonbam.bed.txt and *.seq.txt files, or
+        spool.Spool objects with their content. mcov and nonbam are '' if
+        there are no such files
+    bstart, bend:
+        Extremes of the bed region, before slop
+    xregion:
+        pybedtools.Interval of the region after slop
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.gridspec import GridSpec
+    from matplotlib.ticker import MaxNLocator
+
+    params= track_params(args, inputlist, names)
+    psize= args.psize
+    cex= args.cex
+    xlim= (xregion.start - 1, xregion.end)
+    reg_lim= (bstart - 1, bend)
+
+    ## Data: one dict of arrays for each file
+    data= {}
+    if nonbam != '':
+        data.update(split_by_file(read_nonbam(nonbam)))
+    if mcov != '':
+        mc= columnar.read_columns(mcov)
+        for f, d in split_by_file(mc).items():
+            for k in ['start', 'end'] + pympileup.COUNT_HEADER:
+                d[k]= d[k].astype(float)
+            d['totZ']= d['Z'] + d['z']
+            data[f]= d
+    all_z= [d['totZ'][~np.isnan(d['totZ'])] for d in data.values() if 'totZ' in d]
+    all_z= np.concatenate(all_z) if all_z != [] else np.zeros(0)
+    max_Z= all_z.max() if len(all_z) > 0 else 0
+    min_Z= all_z.min() if len(all_z) > 0 else 0
+    seq_start, seq= read_refbases(refbases)
+
+    ## Figure and layout
+    pwidth= args.pwidth
+    pheight= args.pheight if args.pheight > 0 else figure_height(params, pwidth)
+    fig= Figure(figsize= (pwidth / 2.54, pheight / 2.54), facecolor= r_colour(args.fbg))
+    FigureCanvasAgg(fig)
+    heights= plot_heights(params, args.mar_heights)
+    line= LINE_HEIGHT * psize / 12.0 ## Inches
+    left= min(args.mar * line / (pwidth / 2.54), 0.5)
+    right= 1 - min(1 * line / (pwidth / 2.54), 0.2)
+    grid= GridSpec(len(heights), 1, height_ratios= heights, hspace= 0, left= left, right= right, top= 1, bottom= 0)
+
+    def new_axes(row, ylim):
+        ax= fig.add_subplot(grid[row, 0])
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
+        ax.set_facecolor('none')
+        for side in ax.spines:
+            ax.spines[side].set_visible(False)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        return(ax)
+
+    ## Top panel
+    ## Title shrunk to fit the height of the panel, as in R
+    ax= new_axes(0, (0, 100))
+    top_height= pheight / 2.54 * heights[0] / sum(heights) * 72 ## Points
+    ax.text(np.mean(xlim), 10, plot_name(xregion.chrom, bstart, bend, args.title), ha= 'center', va= 'bottom',
+        fontsize= min(psize * 1.2, top_height * 0.7) * args.cex_title, clip_on= False)
+
+    ## Main panels
+    groups= []
+    for p in params:
+        d= data.get(p['file_name'], None)
+        new_plot= p['overplot'] not in groups
+        if new_plot:
+            groups.append(p['overplot'])
+        row= len(groups)
+        libname= os.path.basename(p['file_name']) if p['snames'] is None else p['snames']
+        col, col_rev= track_colours(p)
+        if p['feature'] == 'coverage':
+            group_z= [data[q['file_name']]['totZ'] for q in params if q['overplot'] == p['overplot'] and q['file_name'] in data]
+            group_z= np.concatenate(group_z) if group_z != [] else np.zeros(0)
+            group_z= group_z[~np.isnan(group_z)]
+            min_z= group_z.min() if len(group_z) > 0 else 0
+            max_z= group_z.max() if len(group_z) > 0 else 0
+            if p['ymax'] == 'indiv':
+                ymax= max_z
+            elif p['ymax'] == 'max':
+                ymax= max_Z
+            else:
+                ymax= float(p['ymax'])
+            if p['ymin'] == 'indiv':
+                ymin= min_z
+            elif p['ymin'] == 'min':
+                ymin= min(min_Z, 0)
+            else:
+                ymin= float(p['ymin'])
+            if ymax <= ymin:
+                ymax= ymin + 1
+            if new_plot:
+                ax= new_axes(row, (ymin, ymax))
+                ax.set_facecolor(r_colour(p['bg']))
+                ax.yaxis.set_major_locator(MaxNLocator(nbins= 4))
+                ax.tick_params(axis= 'y', labelsize= psize * args.cex_axis, colors= r_colour(p['col_yaxis']), width= 0.5, length= 2)
+                ax.grid(True, color= r_colour(p['col_grid']), linewidth= 0.5, linestyle= ':')
+                ax.set_axisbelow(True)
+                cex_lab= to_float(p['cex_lab'])
+                ax.set_ylabel(p['ylab'] or '', fontsize= psize * (args.cex_axis if cex_lab < 0 else cex * cex_lab))
+                ax.text(xlim[0] + (xlim[1] - xlim[0]) * 0.01, ymax, libname, ha= 'left', va= 'top',
+                    color= r_colour(p['col_names']), fontsize= psize * args.cex_names)
+                ax.plot(reg_lim, [ymin, ymin], linestyle= 'none', marker= '^', markersize= psize * 0.6,
+                    color= r_colour(p['col_mark']), clip_on= False)
+            if d is None or len(d['start']) == 0:
+                continue
+            span= np.sum(d['end'] - d['start'])
+            border= 'none' if span / float(xlim[1] - xlim[0]) >= 0.1 else col
+            ybottom= np.zeros(len(d['start']))
+            if 'A' in d:
+                ## Bam files: stack the bases
+                if (xlim[1] - xlim[0]) < args.maxseq and not args.no_col_bases:
+                    bases= ['A', 'a', 'C', 'c', 'G', 'g', 'T', 't', 'N', 'n']
+                    mismatch= nuc_colours(args.col_nuc)
+                    mismatch= dict(zip(['A', 'C', 'G', 'T'], mismatch))
+                    refbase= np.array([''] * len(d['start']), dtype= object)
+                    if seq != '':
+                        k= d['start'].astype(int) - seq_start
+                        ok= (k >= 0) & (k < len(seq))
+                        refbase[ok]= np.array(list(seq), dtype= object)[k[ok]]
+                else:
+                    bases= ['A', 'C', 'G', 'T', 'N', 'a', 'c', 'g', 't', 'n']
+                    mismatch= None
+                from matplotlib.colors import to_rgba
+                for b in bases:
+                    ytop= ybottom + d[b]
+                    if mismatch is None:
+                        colours= col if b.isupper() else col_rev
+                    elif b.upper() == 'N':
+                        colours= col
+                    else:
+                        colours= np.where((refbase == b.upper())[:, None], np.array(to_rgba(col)), np.array(to_rgba(mismatch[b.upper()])))
+                    add_rects(ax, d['start'], d['end'], ybottom, ytop, colours, border)
+                    ybottom= ytop
+            else:
+                add_rects(ax, d['start'], d['end'], ybottom, d['totZ'], col, border)
+            add_bdg_lines(ax, d['start'], d['end'], d['totZ'], p['col_line'], p['lwd'])
+        else:
+            ## Annotation
+            if new_plot:
+                ax= new_axes(row, (0, 100))
+                ax.set_facecolor(make_transparent('blue', 20))
+            offs= 35
+            thick= (offs - 28, offs + 28)
+            thin= (offs - 15, offs + 15)
+            if d is not None and len(d['start']) > 0:
+                cds= d['feature'] == 'CDS'
+                add_rects(ax, d['start'], d['end'], np.where(cds, thick[0], thin[0]).astype(float),
+                    np.where(cds, thick[1], thin[1]).astype(float), col, col)
+                ## Extremes of each feature
+                extremes= {}
+                for start, end, name, strand in zip(d['start'], d['end'], d['name'], d['strand']):
+                    key= (name, strand)
+                    if key in extremes:
+                        extremes[key]= (min(extremes[key][0], start), max(extremes[key][1], end))
+                    else:
+                        extremes[key]= (start, end)
+                for (name, strand), (start, end) in extremes.items():
+                    ax.plot([start, end], [offs, offs], color= col, linewidth= 0.75)
+                    lab= name if strand == '.' else '%s %s' %(name, strand)
+                    ax.text((start + end) / 2.0, thick[1] + 2, lab, ha= 'center', va= 'bottom',
+                        color= r_colour(p['col_text_ann']), fontsize= psize * args.cex_names * 0.8, clip_on= True)
+            ax.text(xlim[0] + (xlim[1] - xlim[0]) * 0.01, 100, libname, ha= 'left', va= 'top',
+                color= r_colour(p['col_names']), fontsize= psize * args.cex_names * 0.8)
+            ax.plot(reg_lim, [0, 0], linestyle= 'none', marker= '^', markersize= psize * 0.3, color= 'red', clip_on= False)
+
+    ## Bottom panel: x-axis, range and sequence
+    ax= new_axes(len(heights) - 1, (0, 100))
+    ticks= [x for x in MaxNLocator(nbins= 6, integer= True).tick_values(xlim[0], xlim[1]) if xlim[0] <= x <= xlim[1]]
+    fontsize= psize * args.cex_axis
+    for x in ticks:
+        ax.plot([x, x], [100, 92], color= 'black', linewidth= 0.5, clip_on= False)
+        ax.text(x, 88, '{:,}'.format(int(x)), ha= 'right', va= 'top', fontsize= fontsize)
+    if len(ticks) > 1:
+        xrange= int(ticks[-1] - ticks[0])
+        ax.text(np.mean([ticks[0], ticks[-1]]), 60, '{:,} bp'.format(xrange), ha= 'center', va= 'top', fontsize= fontsize)
+        for x in [ticks[0], ticks[-1]]:
+            ax.text(x, 60, '|', ha= 'center', va= 'top', fontsize= fontsize)
+    if seq != '':
+        ## One base for each position, right-aligned at its end as in R
+        ends= seq_start + np.arange(len(seq)) + 1
+        for x, b in zip(ends, seq):
+            ax.text(x, 35, b, ha= 'right', va= 'top', family= 'monospace', color= r_colour(args.col_seq),
+                fontsize= psize * args.cex_seq)
+    if isinstance(plotfile, spool.Spool):
+        fig.savefig(plotfile.writer(), format= args.format, facecolor= fig.get_facecolor())
+    else:
+        fig.savefig(plotfile, facecolor= fig.get_facecolor())
+    return(plotfile)
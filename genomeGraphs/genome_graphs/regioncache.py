@@ -0,0 +1,139 @@
+"""Content-addressed cache of the per-region files read by R.
+
+Each entry is a file named after the hash of everything that determines its
+content: identity of the input files (name as given, path, size, modification
+time), region after slop, number of windows, group function, etc. Changing
+only graphical parameters gives the same keys so the pileup is not computed
+again.
+
+Entries are touched when used and the least recently used ones are removed
+when the cache grows above its maximum size.
+"""
+
+import os
+import hashlib
+import tempfile
+import spool
+
+CACHE_NAME= 'genomeGraphs_region_cache'
+
+## Change when the content of the cached files changes for the same key
+CACHE_VERSION= 1
+
+def user_cache_dir():
+    """Default directory for the caches (--cache_dir): genomeGraphs in
+    $XDG_CACHE_HOME, or ~/.cache, created private to the user (mode 0700) so
+    that other users cannot read or plant entries.
+    """
+    base= os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    cache_dir= os.path.join(base, 'genomeGraphs')
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir, 0700)
+        except OSError:
+            ## Created by another process in the meantime
+            pass
+    return(cache_dir)
+
+def file_identity(filename):
+    """String identifying the current version of filename. The name as given is
+    part of it because it goes in the header of the cached files.
+    """
+    st= os.stat(filename)
+    return('%s:%s:%s:%r' %(filename, os.path.abspath(filename), st.st_size, st.st_mtime))
+
+def cache_key(*items):
+    """Hash of the items as strings
+    """
+    items= [CACHE_VERSION] + list(items)
+    return(hashlib.md5('\t'.join([str(x) for x in items])).hexdigest())
+
+class RegionCache(object):
+    """Cache of files in directory cache_dir/CACHE_NAME, holding up to max_size
+    bytes. The size is tracked by each process from its own additions, so with
+    several processes writing at the same time the cache can briefly exceed
+    max_size.
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir= os.path.join(cache_dir, CACHE_NAME)
+        self.max_size= max_size
+        self.size= None ## Total size, as last seen by this process
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                ## Created by another process in the meantime
+                pass
+
+    def _entry(self, key, suffix):
+        return(os.path.join(self.cache_dir, key + suffix))
+
+    def contains(self, key, suffix):
+        return(os.path.exists(self._entry(key, suffix)))
+
+    def get(self, key, suffix, dest):
+        """Copy the entry for key to dest, a file name or spool.Spool, and mark
+        it as recently used.
+        Return:
+            True if the entry was found, False otherwise
+        """
+        entry= self._entry(key, suffix)
+        try:
+            spool.copy(entry, dest)
+            os.utime(entry, None)
+        except (IOError, OSError):
+            ## Missing or evicted by another process
+            return(False)
+        return(True)
+
+    def put(self, key, suffix, src):
+        """Store a copy of src, a file name or spool.Spool, as the entry for key
+        and evict the least recently used entries if the cache is too large.
+        """
+        entry= self._entry(key, suffix)
+        fd, tmp= tempfile.mkstemp(prefix= '.tmp_', dir= self.cache_dir)
+        os.close(fd)
+        spool.copy(src, tmp)
+        new_size= os.path.getsize(tmp)
+        try:
+            ## An entry replaced by this one
+            old_size= os.path.getsize(entry)
+        except OSError:
+            old_size= 0
+        os.rename(tmp, entry)
+        if self.size is None:
+            self.size= sum([size for mtime, size, path in self.entries()])
+        else:
+            self.size += new_size - old_size
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        """Return the list of (mtime, size, path) of the entries
+        """
+        entries= []
+        for fn in os.listdir(self.cache_dir):
+            if fn.startswith('.tmp_'):
+                continue
+            path= os.path.join(self.cache_dir, fn)
+            try:
+                st= os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return(entries)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is not larger
+        than max_size.
+        """
+        entries= sorted(self.entries())
+        self.size= sum([size for mtime, size, path in entries])
+        for mtime, size, path in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
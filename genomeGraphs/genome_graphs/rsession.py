@@ -0,0 +1,114 @@
+"""Long-lived R process to render the plots.
+
+Starting Rscript for each region means parsing R_functions.R again and again.
+RSession starts R once with R_session.R, which loads the helper functions, and
+then sends it the path to each filled-in template to source.
+"""
+
+import os
+import subprocess
+import tempfile
+import inspect
+import genome_graphs
+
+DONE= '__genomeGraphs_done__'
+
+class RSession(object):
+    """Persistent R process. The process is started on the first call to run()
+    and restarted on the next call if it dies.
+    rscript_exe:
+        Command to execute R scripts
+    """
+    def __init__(self, rscript_exe= 'Rscript'):
+        path_to_R= os.path.split(inspect.getfile(genome_graphs))[0]
+        self.rscript_exe= rscript_exe
+        self.session_R= os.path.join(path_to_R, 'R_session.R')
+        self.functions_R= os.path.join(path_to_R, 'R_functions.R')
+        self.proc= None
+        self.errlog= None
+
+    def start(self):
+        ## stderr of the session goes to file, not to a pipe that nobody reads.
+        ## The stderr of each job is sunk to its own file by R_session.R
+        self.errlog= tempfile.TemporaryFile()
+        self.proc= subprocess.Popen([self.rscript_exe, self.session_R, self.functions_R],
+            stdin= subprocess.PIPE, stdout= subprocess.PIPE, stderr= self.errlog)
+
+    def is_alive(self):
+        return(self.proc is not None and self.proc.poll() is None)
+
+    def close(self):
+        """Stop the R process by closing its stdin.
+        """
+        if self.is_alive():
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.proc= None
+        if self.errlog is not None:
+            self.errlog.close()
+            self.errlog= None
+
+    def run(self, rscript):
+        """Source the R script rscript in the session.
+        Return:
+            A dictionary {'stdout': 'stderr': 'returncode':} like pycoverage.RPlot.
+            If R died while running the script, returncode is -1 and stderr
+            has whatever R wrote to its stderr. The session will be restarted
+            at the next call.
+        """
+        if not self.is_alive():
+            self.start()
+        stdout_file= rscript + '.stdout'
+        stderr_file= rscript + '.stderr'
+        returncode= -1
+        try:
+            self.proc.stdin.write('\t'.join([rscript, stdout_file, stderr_file]) + '\n')
+            self.proc.stdin.flush()
+            while True:
+                line= self.proc.stdout.readline()
+                if not line:
+                    break
+                if line.startswith(DONE):
+                    returncode= int(line.split()[1])
+                    break
+        except IOError:
+            ## Broken pipe: R died before reading the job
+            pass
+        if returncode == -1:
+            ## R crashed. Collect what it said and let it be restarted next time
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+            self.proc.wait()
+            self.errlog.seek(0)
+            session_err= self.errlog.read()
+            self.errlog.close()
+            self.errlog= None
+            self.proc= None
+        stdout= read_and_remove(stdout_file)
+        stderr= read_and_remove(stderr_file)
+        if returncode == -1:
+            stderr= stderr + session_err + '\nR session died while running %s\n' %(rscript)
+        return({'stdout': stdout, 'stderr': stderr, 'returncode': returncode})
+
+def read_and_remove(fn):
+    """Return the content of file fn and delete it. Empty string if fn does
+    not exist
+    """
+    if not os.path.exists(fn):
+        return('')
+    txt= open(fn).read()
+    os.remove(fn)
+    return(txt)
+
+## One session per process, created at the first use so that each --jobs worker
+## gets its own.
+_SESSION= []
+
+def get_session():
+    """Return the RSession of this process, starting it if necessary.
+    """
+    if _SESSION == []:
+        _SESSION.append(RSession())
+    return(_SESSION[0])
@@ -0,0 +1,426 @@
+"""genomeGraphs serve: plot regions on request over HTTP, keeping the state that
+the command line rebuilds at each call warm between requests.
+
+Plots are drawn by a pool of --jobs worker processes, so at most --jobs
+requests are rendered at the same time. Each worker keeps open the bam, bigWig,
+tabix and FASTA files it has read, the library sizes for --rpm, its region
+cache and, for the R renderer, its R session (see rsession.py). Annotation
+files are read via their tabix index if they have one. With --tabix in the
+request, indexed copies of the others are built in --cache_dir, up to
+pycoverage.TABIX_CACHE_SIZE bytes in total.
+
+Requests:
+
+    POST /plot
+        JSON body {"region": [<chrom>, <start>, <end>, (<name>)], "args": [...]}
+        region is a bed interval (0-based start). args are genomeGraphs
+        command line options, e.g. ["-i", "a.bam", "genes.gtf.gz", "--format",
+        "png", "--renderer", "python"]. --bed is not needed. Only the options
+        in ALLOWED can be set: the input files and how they are summarized
+        and drawn. Options running commands or code (--samtools, --rcode),
+        reading other files (--parfile) or choosing where files go are set
+        by the server. Files are read by the server, so paths are relative to
+        its working directory.
+        Response: the image, or a text error message with status 400 (invalid
+        request), 500 (plotting failed), 503 (too many requests) or 504
+        (timeout).
+
+    GET /status
+        JSON {"version":, "jobs":, "active":} with active the number of
+        requests being rendered or waiting.
+"""
+
+import sys
+import os
+import argparse
+import json
+import shutil
+import signal
+import tempfile
+import threading
+import traceback
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import pybedtools
+import genomeGraphs
+import pycoverage
+import catalog
+import bigwig
+import regioncache
+
+CONTENT_TYPES= {'pdf': 'application/pdf', 'png': 'image/png', 'svg': 'image/svg+xml'}
+
+## Largest request body accepted, in bytes
+MAX_REQUEST_SIZE= 1024 * 1024
+
+## Options of the command line (argparse dest) that a request can set. Any
+## other option must be left to its default
+ALLOWED= ['ibam', 'bed', 'slop', 'fasta', 'engine', 'tabix', 'sorted',
+    'nwinds', 'rpm', 'r_session', 'renderer', 'format', 'verbose', 'group_fun',
+    'maxseq', 'full_counts', 'max_depth_sample', 'sample_seed', 'col_nuc', 'no_col_bases', 'col_all',
+    'col_line', 'lwd', 'cex', 'col_text_ann', 'col_track', 'col_track_rev',
+    'ymax', 'ymin', 'ylab', 'cex_lab', 'col_yaxis', 'vheights', 'mar_heights', 'names',
+    'cex_names', 'col_names', 'bg', 'col_grid', 'col_mark', 'overplot',
+    'cex_axis', 'cex_seq', 'col_seq',
+    'title', 'cex_title', 'fbg', 'mar', 'pwidth', 'pheight', 'psize']
+
+class RequestError(Exception):
+    pass
+
+parser = argparse.ArgumentParser(description= """
+
+DESCRIPTION
+
+    Serve plots over HTTP. POST to /plot a JSON request with the region to plot
+    and the genomeGraphs options, get back the image. See the documentation of
+    server.py for the request format.
+
+EXAMPLE:
+
+    genomeGraphs serve --port 8090 --jobs 4 &
+    curl -d '{"region": ["chr7", 5566778, 5567522], "args": ["-i", "ds051.actb.bam"]}' \\
+        http://127.0.0.1:8090/plot > actb.pdf
+    """, prog= 'genomeGraphs serve', formatter_class= argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('--host',
+                    default= '127.0.0.1',
+                    help='''Address to listen on. Default 127.0.0.1, i.e. only
+local clients.''')
+
+parser.add_argument('--port',
+                    default= 8090,
+                    type= int,
+                    help='''Port to listen on. Default 8090.''')
+
+parser.add_argument('--socket',
+                    default= None,
+                    help='''Listen on this Unix socket instead of --host and
+--port.''')
+
+parser.add_argument('--jobs', '-j',
+                    default= 2,
+                    type= int,
+                    help='''Number of worker processes, i.e. maximum number of
+plots drawn at the same time. Default 2.''')
+
+parser.add_argument('--max_queue',
+                    default= 16,
+                    type= int,
+                    help='''Maximum number of requests waiting for a free worker.
+Further requests get status 503. Default 16.''')
+
+parser.add_argument('--timeout',
+                    default= 600,
+                    type= float,
+                    help='''Seconds to wait for a plot before answering 504.
+The plot still counts towards --jobs and --max_queue until it is done.
+Default 600.''')
+
+parser.add_argument('--tmpdir', '-t',
+                    default= None,
+                    help='''Directory for the working files of the requests.
+Default is a new temporary dir, deleted on exit.''')
+
+parser.add_argument('--cache_dir',
+                    default= None,
+                    help='''Directory for the library sizes, tabix indexes and
+region cache, as genomeGraphs --cache_dir. Default ~/.cache/genomeGraphs,
+private to the user.''')
+
+parser.add_argument('--cache_size',
+                    default= 1000,
+                    type= float,
+                    help='''Size of the region cache in MB, as genomeGraphs
+--cache_size. Default 1000. 0 disables the cache.''')
+
+# -----------------------------------------------------------------------------
+
+## State of a worker process, set by init_server_worker()
+_WORKER= {}
+
+def init_server_worker(tmpdir, cache_dir, cache_size):
+    """Initialize a worker process of the pool. Working files go to a tmp dir
+    private to the process, as for genomeGraphs --jobs.
+    """
+    genomeGraphs.init_worker({'tmpdir': tmpdir}, worker_tmpdir= True)
+    _WORKER.clear()
+    _WORKER['tmpdir']= tmpdir
+    _WORKER['cache_dir']= cache_dir
+    if cache_size > 0:
+        _WORKER['region_cache']= regioncache.RegionCache(cache_dir, int(cache_size * 1024 * 1024))
+    else:
+        _WORKER['region_cache']= None
+    _WORKER['libsizes']= {} ## {catalog.file_key(bam): <library size>}
+
+def parse_request(request):
+    """Check the request decoded from JSON and parse its options.
+    Return:
+        Tuple (<region fields>, args, slop, nwinds)
+    Raise:
+        RequestError if the request is not valid
+    """
+    if not isinstance(request, dict) or 'region' not in request:
+        raise RequestError('Request must be a JSON object with "region" and "args"')
+    fields= request['region']
+    if not isinstance(fields, list) or len(fields) < 3:
+        raise RequestError('"region" must be a list [<chrom>, <start>, <end>, (<name>)]')
+    fields= [str(x) for x in fields]
+    try:
+        if int(fields[1]) < 0 or int(fields[2]) <= int(fields[1]):
+            raise ValueError
+    except ValueError:
+        raise RequestError('Invalid start and end of region: %s' %(fields[1:3]))
+    argv= request.get('args', [])
+    if not isinstance(argv, list):
+        raise RequestError('"args" must be a list of genomeGraphs options')
+    argv= [str(x) for x in argv]
+    if '-' in argv:
+        raise RequestError('Input from stdin (-) is not supported')
+    ## --bed is required by the parser but not used, the region comes with the
+    ## request
+    stdout, stderr= sys.stdout, sys.stderr
+    sys.stdout= sys.stderr= StringIO.StringIO()
+    try:
+        ## Options are checked before parse_arguments() reads any --parfile
+        given= genomeGraphs.parser.parse_args(argv + ['--bed', 'request'])
+        not_allowed= sorted([k for k, v in vars(given).items() if k not in ALLOWED and v != genomeGraphs.parser.get_default(k)])
+        if not_allowed != []:
+            raise RequestError(', '.join(['--' + k for k in not_allowed]) + ' cannot be used in a request')
+        args, slop, nwinds= genomeGraphs.parse_arguments(argv + ['--bed', 'request'])
+    except SystemExit as e:
+        ## The message passed to sys.exit() or the last line printed, i.e. the
+        ## error after the usage for argparse
+        if isinstance(e.code, basestring):
+            msg= e.code
+        else:
+            msg= sys.stderr.getvalue().strip().split('\n')[-1]
+        raise RequestError('Invalid options: %s' %(msg.strip()))
+    finally:
+        sys.stdout, sys.stderr= stdout, stderr
+    return((fields, args, slop, nwinds))
+
+def library_sizes(bamlist, samtools):
+    """Library sizes of the bam files, from memory if the files didn't change
+    since they were last seen by this worker, otherwise from the sample
+    catalog.
+    """
+    known= _WORKER['libsizes']
+    keys= dict([(bam, catalog.file_key(bam)) for bam in bamlist])
+    missing= [bam for bam in bamlist if keys[bam] not in known]
+    if missing != []:
+        sample_catalog= catalog.SampleCatalog(os.path.join(_WORKER['cache_dir'], catalog.CATALOG_NAME))
+        libsizes= sample_catalog.library_sizes(missing, samtools)
+        sample_catalog.close()
+        for bam in missing:
+            known[keys[bam]]= libsizes[bam]
+    return(dict([(bam, known[keys[bam]]) for bam in bamlist]))
+
+def render(request):
+    """Plot the region of a request. Run by the worker processes.
+    Return:
+        Tuple (<HTTP status>, <content type>, <body>)
+    """
+    try:
+        fields, args, slop, nwinds= parse_request(request)
+        inputlist_all, inputlist, bamlist, nonbamlist, names= genomeGraphs.input_files(args)
+        if inputlist == []:
+            raise RequestError('No file found!')
+        missing= [x for x in inputlist if not os.path.isfile(x)]
+        if missing != []:
+            raise RequestError('File(s) not found: %s' %(', '.join(missing)))
+    except RequestError as e:
+        return((400, 'text/plain', str(e) + '\n'))
+    except Exception:
+        return((500, 'text/plain', traceback.format_exc()))
+    ## Keep the renderer warm between requests
+    args.r_session= True
+    ## All the temp files of the request, including those of pybedtools, go to
+    ## a dir removed at the end so they don't pile up while the server runs
+    reqdir= tempfile.mkdtemp(prefix= 'request_', dir= _WORKER['tmpdir'])
+    old_tempdir= tempfile.tempdir
+    old_bedtools_tempdir= pybedtools.get_tempdir()
+    tempfile.tempdir= reqdir
+    pybedtools.set_tempdir(reqdir)
+    try:
+        region= pybedtools.create_interval_from_list(fields)
+        xregion= pycoverage.slopbed(region, slop)
+        if args.rpm:
+            libsizes= library_sizes(bamlist, args.samtools)
+        else:
+            libsizes= None
+        nonbam_dict= {}
+        for nonbam in nonbamlist:
+            if bigwig.is_bigwig(nonbam):
+                continue
+            nonbam_dict[nonbam]= pycoverage.prefilter_nonbam_multiproc(inbed= pybedtools.BedTool([xregion]).saveas(),
+                nonbam= nonbam, tmpdir= reqdir, sorted= args.sorted,
+                tabix= pycoverage.tabix_file(nonbam, _WORKER['cache_dir'], build= args.tabix))
+        region_cache= _WORKER['region_cache']
+        context= {'args': args,
+                  'slop': slop,
+                  'nwinds': nwinds,
+                  'tmpdir': reqdir,
+                  'outdir': reqdir,
+                  'onefile': False,
+                  'bamlist': bamlist,
+                  'nonbamlist': nonbamlist,
+                  'nonbam_dict': nonbam_dict,
+                  'libsizes': libsizes,
+                  'region_cache': region_cache,
+                  'bam_ids': [regioncache.file_identity(x) for x in bamlist] if region_cache is not None else [],
+                  'fasta_id': regioncache.file_identity(args.fasta) if args.fasta else None,
+                  'inputlist_all': inputlist_all,
+                  'names': names}
+        genomeGraphs.init_worker(context)
+        plotfile= genomeGraphs.process_region(region)
+        body= open(plotfile, 'rb').read()
+    except Exception:
+        return((500, 'text/plain', traceback.format_exc()))
+    finally:
+        tempfile.tempdir= old_tempdir
+        pybedtools.set_tempdir(old_bedtools_tempdir)
+        shutil.rmtree(reqdir, ignore_errors= True)
+    return((200, CONTENT_TYPES[args.format], body))
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        ## client_address is '' for a Unix socket
+        if isinstance(self.client_address, tuple):
+            client= self.client_address[0]
+        else:
+            client= 'unix'
+        sys.stderr.write('%s - - [%s] %s\n' %(client, self.log_date_time_string(), format %args))
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.reply(404, 'text/plain', 'Not found: %s\n' %(self.path))
+            return
+        status= {'version': genomeGraphs.VERSION, 'jobs': self.server.jobs, 'active': self.server.active}
+        self.reply(200, 'application/json', json.dumps(status) + '\n')
+
+    def do_POST(self):
+        if self.path != '/plot':
+            self.reply(404, 'text/plain', 'Not found: %s\n' %(self.path))
+            return
+        size= int(self.headers.getheader('Content-Length', 0))
+        if size > MAX_REQUEST_SIZE:
+            self.reply(413, 'text/plain', 'Request larger than %s bytes\n' %(MAX_REQUEST_SIZE))
+            return
+        try:
+            request= json.loads(self.rfile.read(size))
+        except ValueError:
+            self.reply(400, 'text/plain', 'Request body is not valid JSON\n')
+            return
+        if not self.server.slots.acquire(False):
+            self.reply(503, 'text/plain', 'Too many requests, try again later\n')
+            return
+        self.server.count_active(1)
+        ## The slot is released when the worker is done with the plot, also if
+        ## the client got 504 before, so that no more than the number of slots
+        ## is ever queued. render() does not raise, so the callback is always
+        ## called.
+        try:
+            result= self.server.pool.apply_async(render, (request,), callback= self.server.release_slot)
+        except:
+            self.server.release_slot(None)
+            raise
+        try:
+            ## With a timeout get() can be interrupted by Ctrl-C
+            status, content_type, body= result.get(self.server.plot_timeout)
+        except multiprocessing.TimeoutError:
+            status, content_type, body= 504, 'text/plain', 'No plot after %s seconds\n' %(self.server.plot_timeout)
+        self.reply(status, content_type, body)
+
+class PlotServer(SocketServer.ThreadingMixIn):
+    """One thread per connection, waiting for the plot from the worker pool
+    """
+    daemon_threads= True
+
+    def setup_plots(self, pool, jobs, max_queue, plot_timeout):
+        self.pool= pool
+        self.jobs= jobs
+        self.plot_timeout= plot_timeout
+        self.slots= threading.BoundedSemaphore(jobs + max_queue)
+        self.active= 0
+        self.active_lock= threading.Lock()
+
+    def count_active(self, n):
+        with self.active_lock:
+            self.active += n
+
+    def release_slot(self, result):
+        self.count_active(-1)
+        self.slots.release()
+
+class HTTPServer(PlotServer, BaseHTTPServer.HTTPServer):
+    pass
+
+class UnixHTTPServer(PlotServer, SocketServer.UnixStreamServer):
+    pass
+
+def make_server(opts, pool):
+    """Return the HTTP server for the options opts, handing the plots to
+    the worker pool
+    """
+    if opts.socket is not None:
+        if os.path.exists(opts.socket):
+            os.remove(opts.socket)
+        server= UnixHTTPServer(opts.socket, RequestHandler)
+    else:
+        server= HTTPServer((opts.host, opts.port), RequestHandler)
+    server.setup_plots(pool, opts.jobs, opts.max_queue, opts.timeout)
+    return(server)
+
+def main(argv= None):
+    opts= parser.parse_args(argv)
+    if opts.jobs < 1:
+        sys.exit('\n--jobs must be >= 1. Got %s\n' %(opts.jobs))
+    if opts.max_queue < 0:
+        sys.exit('\n--max_queue must be >= 0. Got %s\n' %(opts.max_queue))
+    if opts.tmpdir is None:
+        tmpdir= tempfile.mkdtemp(suffix= '_genomeGraphs_serve')
+        remove_tmpdir= True
+    else:
+        tmpdir= opts.tmpdir
+        remove_tmpdir= False
+        if not os.path.exists(tmpdir):
+            os.makedirs(tmpdir)
+    if opts.cache_dir is None:
+        cache_dir= regioncache.user_cache_dir()
+    else:
+        cache_dir= opts.cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+    pool= multiprocessing.Pool(processes= opts.jobs, initializer= init_server_worker,
+        initargs= (tmpdir, cache_dir, opts.cache_size))
+    server= make_server(opts, pool)
+    ## Clean up on kill as on Ctrl-C. Set after starting the workers so that
+    ## they keep the default handler
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if opts.socket is not None:
+        print('genomeGraphs %s serving on %s' %(genomeGraphs.VERSION, opts.socket))
+    else:
+        print('genomeGraphs %s serving on http://%s:%s' %(genomeGraphs.VERSION, opts.host, opts.port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        pool.terminate()
+        pool.join()
+        if opts.socket is not None and os.path.exists(opts.socket):
+            os.remove(opts.socket)
+        if remove_tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors= True)
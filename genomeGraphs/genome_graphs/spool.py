@@ -0,0 +1,89 @@
+"""In-memory files for the intermediate data of a region (--in_memory).
+
+A Spool holds what would otherwise go to one of the per-region files in
+--tmpdir (*.seq.txt, *.grp.bin, *.nonbam.bed.txt, the plot for --onefile). It
+is kept in memory up to a maximum size and moved to an anonymous temporary
+file, deleted on close, if it grows larger (see tempfile.SpooledTemporaryFile).
+
+The functions writing and reading the per-region files take either a file name
+or a Spool and open it with open_write() and open_read().
+"""
+
+import shutil
+import tempfile
+
+class _Handle(object):
+    """File handle on the data of a Spool. close() leaves the data in place,
+    so code written for files can close it as usual.
+    """
+    def __init__(self, fh):
+        self.fh= fh
+
+    def __getattr__(self, name):
+        return(getattr(self.fh, name))
+
+    def __iter__(self):
+        return(iter(self.fh.readline, ''))
+
+    def close(self):
+        pass
+
+class Spool(object):
+    """Data of one intermediate file, in memory until larger than max_size
+    bytes (--spill_mb). Temporary files for the spilled data go to the
+    directory of the tempfile module.
+    """
+    def __init__(self, max_size):
+        self.data= tempfile.SpooledTemporaryFile(max_size= max_size)
+
+    def writer(self):
+        """Handle to write the spool from scratch
+        """
+        self.data.seek(0)
+        self.data.truncate()
+        return(_Handle(self.data))
+
+    def reader(self):
+        """Handle to read the spool from the start
+        """
+        self.data.seek(0)
+        return(_Handle(self.data))
+
+    def getvalue(self):
+        return(self.reader().read())
+
+    def spilled(self):
+        """True if the data has been moved to disk
+        """
+        return(self.data._rolled)
+
+    def close(self):
+        """Discard the data
+        """
+        self.data.close()
+
+def open_write(x, mode= 'w'):
+    """Open x, a file name or a Spool, for writing
+    """
+    if isinstance(x, Spool):
+        return(x.writer())
+    return(open(x, mode))
+
+def open_read(x, mode= 'r'):
+    """Open x, a file name or a Spool, for reading
+    """
+    if isinstance(x, Spool):
+        return(x.reader())
+    return(open(x, mode))
+
+def copy(src, dest):
+    """Copy src to dest, each a file name or a Spool
+    """
+    if not isinstance(src, Spool) and not isinstance(dest, Spool):
+        shutil.copyfile(src, dest)
+        return
+    fin= open_read(src, 'rb')
+    fout= open_write(dest, 'wb')
+    shutil.copyfileobj(fin, fout)
+    fin.close()
+    fout.close()
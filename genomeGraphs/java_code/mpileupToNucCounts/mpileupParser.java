@@ -1,9 +1,10 @@
 
 import java.io.BufferedReader;
+import java.io.BufferedWriter;
 import java.io.IOException;
 import java.io.InputStreamReader;
+import java.io.OutputStreamWriter;
 import java.lang.String;
-import java.util.*;
 
 /*
 *  _MEMO_
@@ -12,7 +13,7 @@ import java.util.*;
 * cd /to/mpileupParser.java
 * javac mpileupParser.java
 *
-* 
+*
 * Create jar executable with
 * --------------------------
 * cd /dir/to/with-all-*.class-files
@@ -24,165 +25,201 @@ import java.util.*;
 *
 * ------
 * mpileupParser is the class with function `public static void main`
+*
+* Output format
+* -------------
+* Default: One line per position formatted as python dict (see countsToPydict).
+* With option -tsv: One line per position with tab separated integers:
+*
+*   pos A.1 A.2 ... A.n a.1 ... a.n C.1 ... z.n
+*
+* I.e. position followed by the counts of A, a, C, c, G, g, T, t, N, n, Z, z
+* each repeated for the n bam files (same order as pympileup.COUNT_HEADER). This
+* is what pympileup.parse_nuc_counts() reads in bulk.
 */
 
 
 class Pile {
 
+	/* Output order of the counts, same as pympileup.COUNT_HEADER */
+	public static final String[] COUNT_HEADER= {"A", "a", "C", "c", "G", "g", "T", "t", "N", "n", "Z", "z"};
+
+	/* Bases counted from mpileup, at the same index as in COUNT_HEADER */
+	private static final String NUCS= "AaCcGgTtNn";
+
 	public String extractLineCoords(String[] pileupLine){
-		
+
 		/*
-		*   Connvert coordinates and refbase to String formatted as (partial) 
+		*   Connvert coordinates and refbase to String formatted as (partial)
 		*   python dict
 		*/
-		
+
 		String pydict= "{'chrom': '" + pileupLine[0] + "', 'pos': " + pileupLine[1] + ", 'base': '" + pileupLine[2] + "', ";
 		return(pydict);
 	}
 
-	public Map<String, Integer> condenseBasesToHashMapCount(String bases, String[] nucs, String refbase){
+	public int[] condenseBasesToCounts(String bases, String refbase){
 		/*
 		*   Condense one string of bases from mpileup (not the whole line) to base
 		*   counts.
-		*   
+		*
 		*   bases:
 		*   	String of bases from mpileup line
-		*   nucs:
-		*   	List of nucleotides to call
 		*   refbase:
-		*   	Reference base extracted from 3rd column of mpileup
+		*   	Reference base extracted from 3rd column of mpileup. Matches (. and ,)
+		*   	are counted as this base, as N if it is not one of ACGTN.
 		*
 		*	Return:
-		*		HashMap of base calls:
-		*		{T=0, g=0, t=0, G=0, c=0, A=0, C=0, a=0, n=0, N=0, .=0, ,=0}
+		*		Array of counts in the order of COUNT_HEADER. Z and z are the
+		*		sums of the forward and reverse counts.
 		*
 		*   MEMO: mpileip line looks like this:
-		*  
+		*
 		*   chr7	3282070	N	0	*	*	0	*	*	2	^~G^~G	AA
 		*	chr7	3282071	N	0	*	*	0	*	*	2	GG	BA
 		*
 		*/
 
-		Map<String, Integer>  callDict = new HashMap<String, Integer>();
-
-		for(String k : nucs){
-			callDict.put(k, 0);
-		}
+		int[] counts= new int[COUNT_HEADER.length];
+		int matchFwd= 0;             // Count of . to add to refbase
+		int matchRev= 0;             // Count of , to add to lower case refbase
 
 		boolean skip= false;         // Skip after ^
 		boolean getIndel= false;     // Switch to start accumulating ints following +/-
-		StringBuilder indel = new StringBuilder();  // String of ints following +/-. Converted to int() will give indel length
-		Integer nskip= 0;            
+		int indel= 0;                // Indel length from the digits following +/-
+		int nskip= 0;
 
 		for (int i = 0, n = bases.length(); i < n; i++) {
-			Character c = bases.charAt(i);
-			String b = Character.toString(c);
+			char c = bases.charAt(i);
 			if (nskip > 0){
 				nskip -= 1;
-			} else if (b.equals("^")){
+			} else if (c == '^'){
 				skip= true;
 			} else if(skip){
 				skip= false;
-			} else if (b.equals("+") || b.equals("-")){
+			} else if (c == '+' || c == '-'){
 				getIndel= true;
 			} else if (getIndel){
 				if (Character.isDigit(c)) {
-					indel.append(b);
+					indel= indel * 10 + (c - '0');
 				} else {
-					nskip = Integer.parseInt(indel.toString()) - 1;
-					indel.setLength(0);  // Empty stringBuilder of ints
+					nskip = indel - 1;
+					indel= 0;
 					getIndel= false;
 				}
-			} else if (callDict.containsKey(b)){
-				callDict.put(b, callDict.get(b) + 1);
-			}
-			else {
-				continue;
+			} else if (c == '.'){
+				matchFwd += 1;
+			} else if (c == ','){
+				matchRev += 1;
+			} else {
+				int k= NUCS.indexOf(c);
+				if (k >= 0){
+					counts[k] += 1;
+				}
 			}
 		}
 
-		callDict.put(refbase,               callDict.get(refbase) +               callDict.get("."));
-		callDict.put(refbase.toLowerCase(), callDict.get(refbase.toLowerCase()) + callDict.get(","));
+		int ref= NUCS.indexOf(refbase.toUpperCase());
+		if (ref < 0){
+			ref= NUCS.indexOf('N');
+		}
+		counts[ref]     += matchFwd;
+		counts[ref + 1] += matchRev;
 
-		return(callDict);
+		int Z= COUNT_HEADER.length - 2;
+		for (int k = 0; k < Z; k += 2){
+			counts[Z]     += counts[k];
+			counts[Z + 1] += counts[k + 1];
+		}
+		return(counts);
 	}
 
-    public List<Map> extractNucCountsFromPileupLine (String[] pileupLine) {
+    public int[][] extractNucCountsFromPileupLine (String[] pileupLine) {
 
 		/*
-		*   Get a whole line of input from samtools mpileup and return a list of
-		*   hashes, one hash for each bam file
+		*   Get a whole line of input from samtools mpileup and return an array
+		*   of counts for each bam file
 		*/
-	
-		String[] nucs= {"A", "a", "C", "c", "G", "g", "T", "t", "N", "n", ".", ","};
-		
+
 		String refbase= pileupLine[2];
-		
-		String bases= "";
-		Pile d = new Pile();
-		List<Map> listOfNucCounts = new ArrayList<Map>(); // List with one hashmap per bamfile
-		for(int i = 4; i < pileupLine.length; i = i+3) {
-			bases= pileupLine[i];
-			Map <String, Integer> dict = d.condenseBasesToHashMapCount(bases, nucs, refbase);
-			listOfNucCounts.add(dict);
+
+		int[][] nucCounts= new int[(pileupLine.length - 2) / 3][];
+		for(int i = 4, j = 0; i < pileupLine.length; i = i+3, j++) {
+			nucCounts[j]= condenseBasesToCounts(pileupLine[i], refbase);
 		}
-		return(listOfNucCounts);
+		return(nucCounts);
     }
-	
-	public String countMapToPydict(List<Map> listOfNucCounts){
-		
+
+	public String countsToPydict(int[][] nucCounts){
+
 		/*
-		*  Convert list of MapHashes containing nuc counts to String formatted
+		*  Convert the array of nuc counts of each bam to String formatted
 		*  as (partial) python dict
 		*/
-		
-		String[] forwardNucs= {"A", "C", "G", "T", "N"};
-		String[] revNucs=     {"a", "c", "g", "t", "n"};
-		String[] outnucs=     {"A", "a", "C", "c", "G", "g", "T", "t", "N", "n"}; // MEMO: Add "Z" and "z" 
-
-		String pydict = "";
-		int i= 0;
-		for(Map nucCountMap : listOfNucCounts){
-			int Z= 0;
-			for(String k : forwardNucs){
-				int x = (Integer) nucCountMap.get(k);
-				Z += x;
-			}
-			int z= 0;
-			for(String k : revNucs){
-				int x = (Integer) nucCountMap.get(k);
-				z += x;
+
+		StringBuilder pydict = new StringBuilder();
+		for(int i = 0; i < nucCounts.length; i++){
+			pydict.append(i).append(": {");
+			for(int k = 0; k < COUNT_HEADER.length; k++){
+				if (k > 0){
+					pydict.append(", ");
+				}
+				pydict.append('\'').append(COUNT_HEADER[k]).append("': ").append(nucCounts[i][k]);
 			}
-			String innerDict= i + ": {";
-			for(String x : outnucs){
-				innerDict += "'" + x + "': " + nucCountMap.get(x) + ", "; // Memo: No need to strip last comma {1:0, }
+			pydict.append("}, ");
+		}
+		pydict.append('}');
+		return(pydict.toString());
+	}
+
+	public void appendTsv(StringBuilder tsv, String pos, int[][] nucCounts){
+
+		/*
+		*  Append to tsv the tab separated line of the nuc counts: pos followed
+		*  by each count for each bam file
+		*/
+
+		tsv.append(pos);
+		for(int k = 0; k < COUNT_HEADER.length; k++){
+			for(int i = 0; i < nucCounts.length; i++){
+				tsv.append('\t').append(nucCounts[i][k]);
 			}
-			innerDict += "'Z': " + Z + ", 'z': " + z + "}, ";
-			i += 1;
-			pydict += innerDict;
 		}
-		pydict += "}";
-		return(pydict);
+		tsv.append('\n');
 	}
 }
 
 public class mpileupParser{
- 
+
 	public static void main (String args[]) {
- 
+
+		boolean tsv= false;
+		for(int i = 0; i < args.length; i++){
+			if(args[i].equals("-tsv")){
+				tsv= true;
+			}
+		}
 		try{
-			BufferedReader br = 
+			BufferedReader br =
 						  new BufferedReader(new InputStreamReader(System.in));
-			
-			String input;	
-			Pile d = new Pile();			
+			BufferedWriter bw =
+						  new BufferedWriter(new OutputStreamWriter(System.out), 1 << 16);
+
+			String input;
+			Pile d = new Pile();
+			StringBuilder line = new StringBuilder();
 			while((input=br.readLine())!=null){
 				String[] pileupLine= input.split("\t");
-				String coords= d.extractLineCoords(pileupLine);
-				List<Map> listOfNucCounts = d.extractNucCountsFromPileupLine(pileupLine);
-				String counts = d.countMapToPydict(listOfNucCounts);
-				System.out.println(coords + counts);
-			}		
+				int[][] nucCounts = d.extractNucCountsFromPileupLine(pileupLine);
+				line.setLength(0);
+				if(tsv){
+					d.appendTsv(line, pileupLine[1], nucCounts);
+				} else {
+					line.append(d.extractLineCoords(pileupLine)).append(d.countsToPydict(nucCounts)).append('\n');
+				}
+				bw.append(line);
+			}
+			bw.flush();
 		}
 		catch(IOException io) {
 			io.printStackTrace();
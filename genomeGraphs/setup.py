@@ -29,12 +29,23 @@ setup(
       'Programming Language :: Python'
    ],
 
-   requires = [ 'pybedtools', 'python (>=2.6, <3.0)' ],
+   requires = [ 'pybedtools', 'numpy', 'python (>=2.6, <3.0)' ],
    
    py_modules = [
       'genome_graphs.genomeGraphs',
+      'genome_graphs.catalog',
+      'genome_graphs.bigwig',
+      'genome_graphs.fasta',
+      'genome_graphs.regioncache',
+      'genome_graphs.columnar',
+      'genome_graphs.pyrender',
+      'genome_graphs.pdfstream',
+      'genome_graphs.server',
+      'genome_graphs.profiler',
+      'genome_graphs.spool',
       'genome_graphs.pycoverage',
       'genome_graphs.pympileup',
+      'genome_graphs.rsession',
       'genome_graphs.validate_args'
    ],
 
@@ -44,6 +55,6 @@ setup(
    ],
     packages=['genome_graphs'],
     package_data = {
-        'genome_graphs': ['R_template.R', 'mpileupToNucCounts.jar', 'demo/*'],
+        'genome_graphs': ['R_template.R', 'R_functions.R', 'R_session.R', 'mpileupToNucCounts.jar', 'demo/*'],
     },
 )
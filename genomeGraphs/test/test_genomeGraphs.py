@@ -13,9 +13,27 @@ import sys
 import subprocess as sp
 import pybedtools
 from genome_graphs import pycoverage
+from genome_graphs import pympileup
+from genome_graphs import catalog
+from genome_graphs import bigwig
+from genome_graphs import fasta
+from genome_graphs import regioncache
+from genome_graphs import columnar
+from genome_graphs import pdfstream
+from genome_graphs import server
+from genome_graphs import profiler
+from genome_graphs import spool
 #import pycoverage
 import inspect
 import tempfile
+import numpy as np
+import json
+import collections
+import time
+import urllib2
+sys.path.insert(0, '../benchmark')
+import synthetic
+import benchmark
 
 # genomeGraphs='~/svn_checkout/bioinformatics-misc/branches/genomeGraphs/genomeGraphs.py'
 genomeGraphs= 'genomeGraphs'
@@ -87,15 +105,13 @@ def test_file_headers():
     stdout, stderr= p.communicate()
     assert stderr == '' 
     header= open(os.path.join(tmpdir, 'chr7_5566757_5566829.seq.txt')).readline().strip().split('\t')
-    assert header == ['chrom', 'start', 'end', 'base']
+    assert header == ['chrom', 'start', 'end', 'sequence']
 
-    header= open(os.path.join(tmpdir, 'chr7_5566757_5566829.grp.bed.txt')).readline().strip().split('\t')
-
-    expected_header= ['chrom', 'start', 'end']
-    for x in ['A', 'a', 'C', 'c', 'G', 'g', 'T', 't', 'N', 'n', 'Z', 'z']:
-        for bam in ['%s/bam/ds051.actb.bam' %(example_dir), '%s/bam/ds052.actb.bam' %(example_dir), '%s/bam/ds053.actb.bam' %(example_dir)]:
-            expected_header.append(bam + '.' + x)
-    assert header == expected_header
+    pileup= columnar.read_columns(os.path.join(tmpdir, 'chr7_5566757_5566829.grp.bin'))
+    expected_header= ['chrom', 'start', 'end', 'file_name', 'A', 'a', 'C', 'c', 'G', 'g', 'T', 't', 'N', 'n', 'Z', 'z', 'feature', 'name', 'strand']
+    assert list(pileup.keys()) == expected_header
+    bams= ['%s/bam/ds051.actb.bam' %(example_dir), '%s/bam/ds052.actb.bam' %(example_dir), '%s/bam/ds053.actb.bam' %(example_dir)]
+    assert sorted(set(pileup['file_name'])) == bams
 
 def test_mpileupToNucCounts():
     """Test jar against chosen mpileup lines 
@@ -142,62 +158,797 @@ def test_mpileupToNucCounts():
     assert outDict[0]['T'] == 10
     assert (outDict[0]['Z'] + outDict[0]['z']) == 468
 
+def test_mpileupToNucCounts_tsv():
+    """With -tsv the jar prints one tab separated line per position: pos then
+    the counts of test_mpileupToNucCounts in COUNT_HEADER order, each repeated
+    for the bam files. ex1 is given as first and second bam, the third has no
+    reads.
+    """
+    ex1= open('ex1.mpileup').read().rstrip('\n').split('\t')
+    mpileup= '\t'.join(ex1 + ['*'] + ex1[3:5] + ['*', '0', '*', '*']) + '\n'
+    cmd= 'java -jar ../genome_graphs/mpileupToNucCounts.jar -tsv'
+    p= sp.Popen(cmd, shell= True, stdin= sp.PIPE, stdout= sp.PIPE, stderr= sp.PIPE)
+    stdout, stderr= p.communicate(mpileup)
+    assert stderr == ''
+    lines= stdout.split('\n')
+    assert lines[1:] == ['']
+    fields= lines[0].split('\t')
+    assert len(fields) == 1 + len(pympileup.COUNT_HEADER) * 3
+    assert [int(x) for x in fields] == [5567254,
+        0, 0, 0,  42, 42, 0,  336, 336, 0,  80, 80, 0,
+        0, 0, 0,  0, 0, 0,  0, 0, 0,  0, 0, 0,
+        0, 0, 0,  0, 0, 0,  336, 336, 0,  122, 122, 0]
+    pos, counts= pympileup.parse_nuc_counts([stdout], 3)
+    assert list(pos) == [5567254]
+    assert list(counts[0][0::3]) == [0, 42, 336, 80, 0, 0, 0, 0, 0, 0, 336, 122]
+
+    cmd= 'cat ex2.mpileup | java -jar ../genome_graphs/mpileupToNucCounts.jar -tsv'
+    p= sp.Popen(cmd, shell= True, stdout= sp.PIPE, stderr= sp.PIPE)
+    stdout, stderr= p.communicate()
+    assert stderr == ''
+    assert stdout == '\t'.join(['5567254', '0', '42', '336', '80', '0', '0', '10', '0', '0', '0', '346', '122']) + '\n'
+
+def test_parse_nuc_counts():
+    """Columns ordered as COUNT_HEADER then bam.
+    """
+    counts= [1, 101, 2, 102, 3, 103, 4, 104, 5, 105, 6, 106, 7, 107, 8, 108, 9, 109, 10, 110, 11, 111, 12, 112]
+    tsv= ''.join(['\t'.join([str(x) for x in [p] + counts]) + '\n' for p in [10, 11]])
+    pos, x= pympileup.parse_nuc_counts([tsv[:7], tsv[7:]], 2)
+    assert list(pos) == [10, 11]
+    assert list(x[1]) == counts
+
+def test_pileup_native():
+    """pysam counts same as in test_bam_coverage_eq_igv
+    """
+    region= pybedtools.Interval('chr7', 5566755, 5567571)
+    bamlist= ['%s/bam/ds051.actb.bam' %(example_dir), '%s/bam/ds052.actb.bam' %(example_dir), '%s/bam/ds053.actb.bam' %(example_dir)]
+    pos, counts= pympileup.pileup_native(bamlist, region)
+    ## First bam
+    i= list(pos).index(5567376)
+    assert list(counts[i][0::3]) == [0, 0, 510, 411, 0, 0, 0, 1, 0, 0, 510, 412]
+    ## Second bam
+    i= list(pos).index(5567333)
+    assert list(counts[i][1::3]) == [0, 0, 0, 1, 0, 0, 227, 234, 0, 0, 227, 235]
     
+def test_group_by_window():
+    region= pybedtools.Interval('chr1', 100, 110) ## 3 windows: 100-104, 104-108, 108-110
+    assert pympileup.window_size(region, 3) == 4
+    assert pympileup.window_size(region, 20) == 1
+    starts= np.array([100, 101, 103, 108, 109])
+    values= np.array([[1, 10], [2, 20], [6, 30], [4, 40], [5, 50]])
+    ws, we, agg= pympileup.group_by_window(starts, values, region, 3, 'sum')
+    assert list(ws) == [100, 108]
+    assert list(we) == [104, 110]
+    assert agg.tolist() == [[9, 60], [9, 90]]
+    assert pympileup.group_by_window(starts, values, region, 3, 'mean')[2].tolist() == [[3, 20], [4.5, 45]]
+    assert pympileup.group_by_window(starts, values, region, 3, 'max')[2].tolist() == [[6, 30], [5, 50]]
+    assert pympileup.group_by_window(starts, values, region, 3, 'min')[2].tolist() == [[1, 10], [4, 40]]
+    assert pympileup.group_by_window(starts, values, region, 3, 'median')[2].tolist() == [[2, 20], [4.5, 45]]
+
+def test_window_accumulator():
+    """Chunks folded into windows as they come give the same as grouping all
+    the rows at once, also when a window spans several chunks
+    """
+    region= pybedtools.Interval('chr1', 1000, 1500)
+    rs= np.random.RandomState(1)
+    starts= np.sort(rs.choice(np.arange(1000, 1500), 300, replace= False))
+    values= rs.randint(0, 100, size= (300, 4))
+    for fun in pympileup.GROUP_FUNS:
+        expected= pympileup.group_by_window(starts, values, region, 7, fun)
+        acc= pympileup.WindowAccumulator(region, 7, fun)
+        for i, j in [(0, 1), (1, 2), (2, 150), (150, 151), (151, 300)]:
+            acc.add(starts[i:j], values[i:j])
+        ws, we, agg= acc.result()
+        assert ws.tolist() == expected[0].tolist()
+        assert we.tolist() == expected[1].tolist()
+        assert np.allclose(agg, expected[2])
+
+def test_bamlist_to_mpileup_windows():
+    """Pileup in slices folded into windows, per-base file only if asked
+    """
+    region= pybedtools.Interval('chr7', 5566755, 5567571)
+    bamlist= ['%s/bam/ds051.actb.bam' %(example_dir), '%s/bam/ds052.actb.bam' %(example_dir)]
+    pos, counts= pympileup.pileup_native(bamlist, region)
+    ws, we, agg= pympileup.group_by_window(pos - 1, counts, region, 100, 'mean')
+    mpileup_name= os.path.join(tmpdir, 'windows.mpileup.bed.txt')
+    grp_name= os.path.join(tmpdir, 'windows.grp.bin')
+    cells= pympileup.NATIVE_CHUNK_CELLS
+    pympileup.NATIVE_CHUNK_CELLS= 12 * 2 * 50 ## 50 bp slices
+    try:
+        pympileup.bamlist_to_mpileup(mpileup_name, grp_name, bamlist, region, 100, None, False, '', engine= 'native')
+        assert not os.path.exists(mpileup_name)
+        grp= columnar.read_columns(grp_name)
+        assert grp['start'][0:len(ws)].tolist() == ws.tolist()
+        assert np.allclose(grp['C'][0:len(ws)], agg[:, 2 * len(bamlist)])
+        pympileup.bamlist_to_mpileup(mpileup_name, grp_name, bamlist, region, 100, None, False, '', engine= 'native', keep_pileup= True)
+        per_base= [x.split('\t') for x in open(mpileup_name)]
+        assert [int(x[2]) for x in per_base] == pos.tolist()
+        ## Few positions: no windows and per-base file written
+        os.remove(mpileup_name)
+        pympileup.bamlist_to_mpileup(mpileup_name, grp_name, bamlist, region, 5000, None, False, '', engine= 'native')
+        assert len(open(mpileup_name).readlines()) == len(pos)
+        assert columnar.read_columns(grp_name)['end'][0:len(pos)].tolist() == pos.tolist()
+    finally:
+        pympileup.NATIVE_CHUNK_CELLS= cells
+
+def test_max_depth_sample():
+    region= pybedtools.Interval('chr7', 5567300, 5567360)
+    bamlist= ['%s/bam/ds051.actb.bam' %(example_dir), '%s/bam/ds052.actb.bam' %(example_dir)]
+    pos, counts= pympileup.pileup_native(bamlist, region)
+    depth= counts[:, -4:-2] + counts[:, -2:] ## Z + z of each bam
+    fractions= pympileup.sample_fractions(bamlist, region, 100)
+    assert sorted(fractions) == sorted(bamlist)
+    assert np.allclose(fractions[bamlist[0]], 100.0 / pympileup.span_depth(bamlist[0], region))
+    assert pympileup.sample_fractions(bamlist, region, 100000) == {}
+    grp_name= os.path.join(tmpdir, 'sampled.grp.bin')
+    ret= pympileup.bamlist_to_mpileup(os.path.join(tmpdir, 'sampled.mpileup.bed.txt'), grp_name, bamlist, region, 1000, None, False, '',
+        engine= 'native', max_depth_sample= 100, sample_seed= 1)
+    assert ret == fractions
+    grp= columnar.read_columns(grp_name)
+    assert grp['name'][0] is not None
+    assert pympileup.read_sample_fractions(grp_name).keys() == fractions.keys()
+    ## Rescaled counts are about the full depth
+    sampled_depth= (grp['Z'] + grp['z'])[0:len(pos)]
+    assert abs(sampled_depth.mean() / depth[:, 0].mean() - 1) < 0.2
+    ## Same reads with the same seed
+    first= open(grp_name, 'rb').read()
+    pympileup.bamlist_to_mpileup(os.path.join(tmpdir, 'sampled.mpileup.bed.txt'), grp_name, bamlist, region, 1000, None, False, '',
+        engine= 'native', max_depth_sample= 100, sample_seed= 1)
+    assert open(grp_name, 'rb').read() == first
+    assert pympileup.samtools_sample_arg(42, 0.0123) == '42.012300'
+    from genome_graphs import genomeGraphs as gg
+    names= gg.downsampled_names(['a', 'b', 'c'], bamlist + ['x.bw'], {bamlist[1]: 0.025})
+    assert names == ['a', 'b (downsampled to 2.5%)', 'c']
+    assert gg.downsampled_names([None], bamlist, {bamlist[0]: 0.5})[0] == 'ds051.actb.bam (downsampled to 50%)'
+
+def test_group_bedgraph_by_window():
+    """Values are weighted by the number of bases in each window
+    """
+    region= pybedtools.Interval('chr1', 100, 120) ## 2 windows: 100-110, 110-120
+    starts= np.array([100, 101, 115])
+    ends= np.array([101, 112, 120])
+    values= np.array([10, 1, 4], dtype= float)
+    ws, we, agg= pycoverage.group_bedgraph_by_window(starts, ends, values, region, 2, 'mean')
+    assert list(ws) == [100, 110]
+    assert list(we) == [110, 120]
+    assert agg.tolist() == [(10 + 1*9)/10.0, (1*2 + 4*5)/7.0]
+    assert pycoverage.group_bedgraph_by_window(starts, ends, values, region, 2, 'sum')[2].tolist() == [19, 22]
+    assert pycoverage.group_bedgraph_by_window(starts, ends, values, region, 2, 'max')[2].tolist() == [10, 4]
+    assert pycoverage.group_bedgraph_by_window(starts, ends, values, region, 2, 'median')[2].tolist() == [1, 4]
+
+def test_sample_catalog():
+    """Library sizes are computed once and reused until the bam changes
+    """
+    bams= ['%s/bam/ds051.actb.bam' %(example_dir), '%s/bam/ds052.actb.bam' %(example_dir)]
+    cat= catalog.SampleCatalog(os.path.join(tmpdir, 'test_catalog.sqlite'))
+    assert os.stat(os.path.join(tmpdir, 'test_catalog.sqlite')).st_mode & 0777 == 0600
+    libsizes= cat.library_sizes(bams, jobs= 2)
+    assert libsizes == pympileup.getLibrarySizes(bams)
+    assert cat.refreshed == bams
+    assert cat.library_sizes(bams) == libsizes
+    assert cat.refreshed == []
+    assert cat.get(bams[0])['chroms'] == ['chr7']
+    cat.close()
+
+def test_prefilter_tabix():
+    """Records overlapping more than one region are returned once
+    """
+    import pysam
+    import gzip
+    bdg= os.path.join(tmpdir, 'tabix_test.bedGraph')
+    fout= open(bdg, 'w')
+    fout.write(gzip.open('%s/bedgraph/profile.bedGraph.gz' %(example_dir)).read())
+    fout.close()
+    bdg= pysam.tabix_index(bdg, preset= 'bed')
+    assert pycoverage.tabix_file(bdg, tmpdir) == bdg
+    inbed= [pybedtools.Interval('chr7', 5566000, 5566010), pybedtools.Interval('chr7', 5566010, 5566020),
+            pybedtools.Interval('chr7', 5566030, 5566032), pybedtools.Interval('chrNone', 1, 100)]
+    fout= open(os.path.join(tmpdir, 'tabix_test.out'), 'w')
+    pycoverage.prefilter_tabix(inbed, bdg, fout)
+    fout.close()
+    starts= [int(x.split('\t')[1]) for x in open(os.path.join(tmpdir, 'tabix_test.out'))]
+    assert starts == range(5566000, 5566020) + [5566030, 5566031]
+
+def test_evict_tabix_copies():
+    """Least recently used copies are removed with their index, but not the
+    one to keep
+    """
+    cache= tempfile.mkdtemp(prefix= 'cache_', dir= 'test_out')
+    ## Index mtime is the last use: c, a, b, d
+    for name, used in [('a', 100), ('b', 200), ('c', 50), ('d', 300)]:
+        tabix= os.path.join(cache, 'tabix_%s.bed.gz' %(name))
+        open(tabix, 'w').write('x' * 90)
+        open(tabix + '.tbi', 'w').write('x' * 10)
+        os.utime(tabix + '.tbi', (used, used))
+    open(os.path.join(cache, 'other.txt'), 'w').write('x' * 1000)
+    pycoverage.evict_tabix_copies(cache, 250, keep= os.path.join(cache, 'tabix_c.bed.gz'))
+    assert sorted(os.listdir(cache)) == ['other.txt', 'tabix_c.bed.gz', 'tabix_c.bed.gz.tbi', 'tabix_d.bed.gz', 'tabix_d.bed.gz.tbi']
+    pycoverage.evict_tabix_copies(cache, 250)
+    assert len(os.listdir(cache)) == 5
+
+def test_prefilter_sweep():
+    """Each overlapping record once, in input order. Record spanning two
+    regions and a chrom not in regions
+    """
+    bdg= os.path.join(tmpdir, 'sweep_test.bedGraph')
+    fout= open(bdg, 'w')
+    fout.write('track type=bedGraph\nchr1\t0\t10\t1\nchr1\t15\t50\t2\nchr1\t50\t55\t3\nchr1\t58\t60\t4\nchr2\t0\t10\t5\nchr3\t0\t10\t6\n')
+    fout.close()
+    inbed= [pybedtools.Interval('chr1', 5, 20), pybedtools.Interval('chr1', 30, 40),
+            pybedtools.Interval('chr1', 55, 58), pybedtools.Interval('chr3', 9, 10)]
+    fout= open(os.path.join(tmpdir, 'sweep_test.out'), 'w')
+    n= pycoverage.prefilter_sweep(inbed, bdg, fout)
+    fout.close()
+    scores= [x.strip().split('\t')[3] for x in open(os.path.join(tmpdir, 'sweep_test.out'))]
+    assert scores == ['1', '2', '6']
+    assert n == 3
+
+def test_indexed_fasta():
+    """Sequence sliced via the .fai index, with and without line wrapping
+    """
+    seqs= [('chrA', 'ACGTACGTAAcccGGGTTTNNacgt'), ('chrB', 'TTGCA')]
+    fa= os.path.join('test_out', 'wrapped.fa')
+    fout= open(fa, 'w')
+    for chrom, seq in seqs:
+        fout.write('>%s description\n' %(chrom))
+        for i in range(0, len(seq), 7):
+            fout.write(seq[i:i+7] + '\n')
+    fout.close()
+    ref= fasta.IndexedFasta(fa) ## No .fai: index built in memory
+    assert ref.index['chrA'] == (25, 18, 7, 8)
+    for chrom, seq in seqs:
+        for start in range(0, len(seq)):
+            for end in range(start, len(seq) + 3):
+                assert ref.fetch(chrom, start, end).tostring() == seq[start:end]
+    ref.close()
+    ## Single-line sequences and existing .fai
+    ref= fasta.IndexedFasta(os.path.join(example_dir, 'annotation', 'bsseq_synthetic4.fa'))
+    assert ref.index == fasta.build_fai(ref.mm)
+    assert ref.fetch('SY006_2x2_hmc_Q38B_indexed', 0, 10).tostring() == 'CTCACCCACA'
+    ref.close()
+
+def test_prepare_reference_fasta():
+    region= pybedtools.Interval('SY005_2x2_hmc_Q38_indexed', 2, 8)
+    seqfile= os.path.join('test_out', 'ref.seq.txt')
+    fa= os.path.join(example_dir, 'annotation', 'bsseq_synthetic4.fa')
+    pycoverage.prepare_reference_fasta(seqfile, 100, region, fa)
+    assert open(seqfile).read() == 'chrom\tstart\tend\tsequence\nSY005_2x2_hmc_Q38_indexed\t2\t8\tCACCCA\n'
+    pycoverage.prepare_reference_fasta(seqfile, 5, region, fa)
+    assert open(seqfile).read() == 'chrom\tstart\tend\tsequence\n'
+
+def test_region_cache():
+    cache_dir= tempfile.mkdtemp(prefix= 'cache_', dir= 'test_out')
+    cache= regioncache.RegionCache(cache_dir, 250)
+    src= os.path.join(cache_dir, 'src.txt')
+    dest= os.path.join(cache_dir, 'dest.txt')
+    keys= [regioncache.cache_key('bam', 'chr7', x) for x in range(3)]
+    assert len(set(keys)) == 3
+    assert not cache.get(keys[0], '.grp.bed.txt', dest)
+    for i, key in enumerate(keys[0:2]):
+        open(src, 'w').write(str(i) * 100)
+        cache.put(key, '.grp.bed.txt', src)
+    assert cache.get(keys[0], '.grp.bed.txt', dest)
+    assert open(dest).read() == '0' * 100
+    ## keys[0] used more recently than keys[1], so keys[1] is evicted
+    os.utime(cache._entry(keys[1], '.grp.bed.txt'), (0, 0))
+    open(src, 'w').write('2' * 100)
+    cache.put(keys[2], '.grp.bed.txt', src)
+    assert cache.contains(keys[0], '.grp.bed.txt')
+    assert not cache.contains(keys[1], '.grp.bed.txt')
+    assert cache.contains(keys[2], '.grp.bed.txt')
+    assert cache.size == 200
+    ## Replacing an entry does not count its old size
+    open(src, 'w').write('3' * 50)
+    cache.put(keys[2], '.grp.bed.txt', src)
+    assert cache.size == 150
+    assert cache.size == sum([x[1] for x in cache.entries()])
+
+def test_user_cache_dir():
+    """Default --cache_dir is private to the user, not the parent of --tmpdir
+    """
+    home= tempfile.mkdtemp(prefix= 'home_', dir= 'test_out')
+    old= os.environ.get('XDG_CACHE_HOME')
+    os.environ['XDG_CACHE_HOME']= home
+    try:
+        cache_dir= regioncache.user_cache_dir()
+    finally:
+        if old is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME']= old
+    assert cache_dir == os.path.join(home, 'genomeGraphs')
+    assert os.stat(cache_dir).st_mode & 0777 == 0700
+
+def test_columnar():
+    fn= os.path.join('test_out', 'columns.bin')
+    columnar.write_columns(fn, [('chrom', columnar.constant('chr7', 3)),
+        ('start', np.array([1, 5, 9])),
+        ('score', np.array([0.5, np.nan, 2])),
+        ('name', columnar.factor(['x', 'y'], [1, -1, 0]))])
+    cols= columnar.read_columns(fn)
+    assert list(cols.keys()) == ['chrom', 'start', 'score', 'name']
+    assert cols['chrom'] == ['chr7', 'chr7', 'chr7']
+    assert cols['start'].tolist() == [1, 5, 9]
+    assert cols['score'][0] == 0.5 and np.isnan(cols['score'][1])
+    assert cols['name'] == ['y', None, 'x']
+
+def test_spool():
+    """Spools are read and written like files and moved to disk only above max_size
+    """
+    columns= [('start', np.arange(100)), ('name', columnar.factor(['x'], [0] * 100))]
+    small= spool.Spool(1024 * 1024)
+    columnar.write_columns(small, columns)
+    assert not small.spilled()
+    assert columnar.read_columns(small)['start'].tolist() == range(100)
+    big= spool.Spool(100)
+    columnar.write_columns(big, columns)
+    assert big.spilled()
+    assert big.getvalue() == small.getvalue()
+    fn= os.path.join('test_out', 'spool.bin')
+    spool.copy(big, fn)
+    assert open(fn, 'rb').read() == small.getvalue()
+    txt= spool.Spool(1024)
+    fh= spool.open_write(txt)
+    fh.write('a\nb\n')
+    fh.close()
+    assert [x for x in spool.open_read(txt)] == ['a\n', 'b\n']
+    ## Writing again starts from scratch
+    spool.open_write(txt).write('c\n')
+    assert txt.getvalue() == 'c\n'
+    for x in [small, big, txt]:
+        x.close()
+
+def test_interval_file():
+    """Same overlaps as bedtools intersect, see also test_annotation_gtf
+    """
+    gtf= pycoverage.IntervalFile('%s/annotation/genes.gtf.gz' %(example_dir))
+    region= pybedtools.Interval('chr7', 5566755, 5567571)
+    out= os.path.join(tmpdir, 'interval_file.nonbam.bed.txt')
+    fout= open(out, 'w')
+    assert pycoverage.prepare_nonbam_file(gtf, fout, region, use_file_name= 'genes.gtf.gz') == 3
+    fout.close()
+    annbed= [x.strip().split('\t') for x in open(out)]
+    assert [x[1] for x in annbed] == ['5566777', '5567377', '5567380']
+    assert [x[2] for x in annbed] == ['5567522', '5567381', '5567522']
+    assert [x[-3] for x in annbed] == ['exon', 'stop_codon', 'CDS']
+    ## Intervals are clipped to the region, bookended intervals don't overlap
+    bed= os.path.join(tmpdir, 'interval_file.bed')
+    open(bed, 'w').write('# comment\nchr1\t200\t210\tc\nchr1\t0\t1000\tlong\nchr1\t90\t100\tbookended\nchr1\t95\t105\ta\nchr2\t100\t110\tb\n')
+    starts, ends, lines= pycoverage.IntervalFile(bed).overlaps(pybedtools.Interval('chr1', 100, 205))
+    assert starts.tolist() == [100, 100, 200]
+    assert ends.tolist() == [205, 105, 205]
+    assert [x.split('\t')[3].strip() for x in lines] == ['long', 'a', 'c']
+    assert pycoverage.IntervalFile(bed).overlaps(pybedtools.Interval('chr3', 100, 205))[2] == []
+    ## bedGraph
+    bdg= '%s/bedgraph/profile.bedGraph.gz' %(example_dir)
+    (starts, ends, values), scores= pycoverage.read_bedgraph(pycoverage.get_interval_file(bdg), region)
+    assert starts[0] == region.start and ends[-1] == region.end
+    assert len(scores) == region.end - region.start
+    assert pycoverage.get_interval_file(bdg) is pycoverage.get_interval_file(bdg)
+
+def test_write_long_counts():
+    """Wide counts (columns by count then by bam) to long format, one bam after the other
+    """
+    fn= os.path.join('test_out', 'long.bin')
+    counts= np.array([[10, 20, 1, 2], [11, 21, 3, 4]]) ## Z.bam1 Z.bam2 z.bam1 z.bam2
+    pympileup.write_long_counts(fn, 'chr1', np.array([0, 1]), np.array([1, 2]), counts, ['b1', 'b2'], pympileup.DEPTH_HEADER)
+    cols= columnar.read_columns(fn)
+    assert cols['file_name'] == ['b1', 'b1', 'b2', 'b2']
+    assert cols['start'].tolist() == [0, 1, 0, 1]
+    assert cols['Z'].tolist() == [10, 11, 20, 21]
+    assert cols['z'].tolist() == [1, 3, 2, 4]
+    assert cols['N'].tolist() == cols['Z'].tolist()
+    assert cols['A'].tolist() == [0, 0, 0, 0]
+    assert cols['feature'] == ['coverage'] * 4
+    assert cols['name'] == [None] * 4
+
+def test_pyrender():
+    """Python renderer draws bam, bedGraph and annotation tracks from the intermediate files
+    """
+    try:
+        import matplotlib
+    except ImportError:
+        return
+    from genome_graphs import genomeGraphs as gg
+    from genome_graphs import pyrender
+    wdir= tempfile.mkdtemp(prefix= 'pyrender_', dir= 'test_out')
+    region= pybedtools.Interval('chr1', 100, 130)
+    mcov= os.path.join(wdir, 'region.grp.bin')
+    counts= np.tile(np.arange(12), (30, 1))
+    pympileup.write_long_counts(mcov, 'chr1', np.arange(100, 130), np.arange(101, 131), counts, ['a.bam'])
+    nonbam= os.path.join(wdir, 'region.nonbam.bed.txt')
+    fout= open(nonbam, 'w')
+    fout.write('\t'.join(['chr1', '100', '120', 'b.bedGraph'] + ['0'] * 11 + ['5', 'coverage', 'NA', '.']) + '\n')
+    fout.write('\t'.join(['chr1', '105', '115', 'c.gtf'] + ['NA'] * 12 + ['CDS', 'gene1', '+']) + '\n')
+    fout.write('\t'.join(['chr1', '115', '125', 'c.gtf'] + ['NA'] * 12 + ['exon', 'gene1', '+']) + '\n')
+    fout.close()
+    refbases= os.path.join(wdir, 'region.seq.txt')
+    open(refbases, 'w').write('chrom\tstart\tend\tsequence\nchr1\t100\t130\t' + 'ACGTACGTAC' * 3 + '\n')
+    inputlist= ['a.bam', 'b.bedGraph', 'c.gtf']
+    args= gg.parser.parse_args(['-i'] + inputlist + ['-b', 'x.bed', '--renderer', 'python', '--overplot', '1', '1', '2'])
+    assert [p['overplot'] for p in pyrender.track_params(args, inputlist, inputlist)] == [1, 1, 2]
+    for fmt in ['pdf', 'png', 'svg']:
+        plotfile= os.path.join(wdir, 'region.' + fmt)
+        pyrender.plot_region(plotfile, args, inputlist, inputlist, mcov, nonbam, refbases, 100, 130, region)
+        assert os.path.getsize(plotfile) > 0
+
+def test_r_colour():
+    from genome_graphs import pyrender
+    assert pyrender.r_colour('grey85') == '#d9d9d9'
+    assert pyrender.r_colour('firebrick4') == '#8B1A1A'
+    assert pyrender.r_colour('#0000FF50') == '#0000FF50'
+    assert pyrender.r_colour('NA') == 'none'
+    assert pyrender.set_overplotting([10, 3, 3], 4) == [2, 1, 1, 3]
+
+def write_test_pdf(filename, text, width):
+    """Write a one page pdf laid out like the ones of the R pdf device: MediaBox
+    in the page tree and content length in its own object
+    """
+    content= 'BT /F1 12 Tf 10 10 Td (%s) Tj ET' %(text)
+    objects= ['<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [3 0 R] /Count 1 /MediaBox [0 0 %s 100] >>' %(width),
+        '<< /Type /Page /Parent 2 0 R /Contents 4 0 R /Resources << /Font << /F1 6 0 R >> >> >>',
+        '<< /Length 5 0 R >>\nstream\n%s\nendstream' %(content),
+        str(len(content)),
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    pdf= '%PDF-1.4\n% comment\n'
+    offsets= []
+    for i, obj in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += '%s 0 obj\n%s\nendobj\n' %(i + 1, obj)
+    xref= len(pdf)
+    pdf += 'xref\n0 %s\n0000000000 65535 f \n' %(len(objects) + 1)
+    pdf += ''.join(['%010d 00000 n \n' %(x) for x in offsets])
+    pdf += 'trailer\n<< /Size %s /Root 1 0 R >>\nstartxref\n%s\n%%%%EOF\n' %(len(objects) + 1, xref)
+    open(filename, 'w').write(pdf)
+
+def test_pdfstream():
+    in_pdf= []
+    for i in range(3):
+        in_pdf.append(os.path.join(tmpdir, 'pdfstream_%s.pdf' %(i)))
+        write_test_pdf(in_pdf[-1], 'Region (%s)' %(i), 100 + i)
+    out_pdf= os.path.join(tmpdir, 'pdfstream_cat.pdf')
+    pycoverage.catPdf(in_pdf, out_pdf)
+    reader= pdfstream.PdfReader(out_pdf)
+    pages, nodes= reader.pages()
+    assert len(pages) == 3
+    assert nodes == [pdfstream.PAGES_ID]
+    for i, (num, inherited) in enumerate(pages):
+        page, stream= reader.get(num)
+        assert page['/MediaBox'] == ['0', '0', str(100 + i), '100']
+        assert page['/Parent'].num == pdfstream.PAGES_ID
+        contents, stream= reader.get(page['/Contents'].num)
+        assert stream == 'BT /F1 12 Tf 10 10 Td (Region (%s)) Tj ET' %(i)
+        font= reader.resolve(page['/Resources']['/Font']['/F1'])
+        assert font['/BaseFont'] == '/Helvetica'
+
+def test_serve_parse_request():
+    fields, args, slop, nwinds= server.parse_request({'region': ['chr7', 5566778, 5567522, 'ACTB'],
+        'args': ['-i', 'a.bam', '--format', 'png', '--renderer', 'python', '--slop', '10']})
+    assert fields == ['chr7', '5566778', '5567522', 'ACTB']
+    assert args.ibam == ['a.bam']
+    assert args.format == 'png'
+    assert slop == [10, 10]
+    for request in [{'args': []},
+                    {'region': ['chr7', 10, 5]},
+                    {'region': ['chr7', 1, 5], 'args': ['--nope']},
+                    {'region': ['chr7', 1, 5], 'args': ['-i', '-']},
+                    {'region': ['chr7', 1, 5], 'args': ['-o', 'x.pdf']}]:
+        try:
+            server.parse_request(request)
+            assert False
+        except server.RequestError:
+            pass
+    ## Only plotting options, also when abbreviated
+    for opt in [['--rcode', 'q()'], ['--rco', 'q()'], ['--samtools', '/tmp;touch x'], ['--parfile', 'x.txt'],
+                ['--cache_dir', '/tmp'], ['-t', '/tmp'], ['--replot'], ['--in_memory']]:
+        try:
+            server.parse_request({'region': ['chr7', 1, 5], 'args': ['-i', 'a.bam'] + opt})
+            assert False
+        except server.RequestError as e:
+            assert 'cannot be used in a request' in str(e)
+
+def test_serve_timeout_keeps_slot():
+    """A plot answered with 504 holds its slot until the worker is done with it
+    """
+    import threading
+    import multiprocessing.pool
+    finish= threading.Event()
+    def slow_render(request):
+        finish.wait()
+        return((200, 'text/plain', 'done'))
+    render= server.render
+    server.render= slow_render
+    pool= multiprocessing.pool.ThreadPool(1)
+    opts= server.parser.parse_args(['--port', '0', '--jobs', '1', '--max_queue', '0', '--timeout', '0.2'])
+    httpd= server.make_server(opts, pool)
+    thread= threading.Thread(target= httpd.serve_forever)
+    thread.daemon= True
+    thread.start()
+    url= 'http://127.0.0.1:%s' %(httpd.server_address[1])
+    try:
+        for code in [504, 503]:
+            try:
+                urllib2.urlopen(url + '/plot', json.dumps({'region': ['chr7', 1, 5]}))
+                assert False
+            except urllib2.HTTPError as e:
+                assert e.code == code
+        assert json.loads(urllib2.urlopen(url + '/status').read())['active'] == 1
+        finish.set()
+        pool.close()
+        pool.join()
+        assert json.loads(urllib2.urlopen(url + '/status').read())['active'] == 0
+    finally:
+        finish.set()
+        server.render= render
+        httpd.shutdown()
+        httpd.server_close()
+
+def test_serve_tabix_only_on_request():
+    """Annotation files are copied and indexed in the cache dir only for
+    requests with --tabix
+    """
+    calls= []
+    def tabix_file(nonbam, cache_dir, build= False):
+        calls.append((nonbam, build))
+        return(None)
+    bdg= os.path.join(tmpdir, 'request.bedGraph')
+    open(bdg, 'w').write('chr7\t10\t20\t1\n')
+    orig_tabix_file= server.pycoverage.tabix_file
+    server.pycoverage.tabix_file= tabix_file
+    ## The worker moves the tmp dirs of the process
+    old_tempdir= tempfile.tempdir
+    old_bedtools_tempdir= pybedtools.get_tempdir()
+    try:
+        server.init_server_worker(tmpdir, tmpdir, 0)
+        for opts in [[], ['--tabix']]:
+            server.render({'region': ['chr7', 1, 50], 'args': ['-i', bdg, '--renderer', 'python'] + opts})
+    finally:
+        server.pycoverage.tabix_file= orig_tabix_file
+        tempfile.tempdir= old_tempdir
+        pybedtools.set_tempdir(old_bedtools_tempdir)
+    assert calls == [(bdg, False), (bdg, True)]
+
+def test_shell_and_r_quoting():
+    """File names and option values cannot escape from shell commands and R strings
+    """
+    region= pybedtools.Interval("chr7'; touch x; '", 10, 20)
+    cmd= pympileup.mpileup_java_cmd(["a b.bam", "$(touch x).bam"], region, fasta= 'g;rm x.fa', mpileup= 'samtools mpileup')
+    assert "'a b.bam' '$(touch x).bam'" in cmd
+    assert "-f 'g;rm x.fa'" in cmd
+    assert "-r 'chr7'\"'\"'; touch x; '\"'\"':11-20'" in cmd
+    assert pycoverage.quoteStringList(['a"); q("', 'b\\', None]) == '"a\\"); q(\\"", "b\\\\", "NA"'
+
+def test_profiler():
+    report= os.path.join(tmpdir, 'profile.jsonl')
+    with profiler.stage('nothing'):
+        pass
+    assert not os.path.exists(report)
+    profiler.enable(report, truncate= True)
+    try:
+        profiler.set_region('chr7_1_10')
+        with profiler.stage('outer'):
+            with profiler.stage('inner', region= 'other'):
+                sp.check_call(['true'])
+        try:
+            with profiler.stage('outer'):
+                raise ValueError
+        except ValueError:
+            pass
+    finally:
+        profiler.disable()
+    records= profiler.read_report(report)
+    assert [x['stage'] for x in records] == ['inner', 'outer', 'outer']
+    assert [x['region'] for x in records] == ['other', 'chr7_1_10', 'chr7_1_10']
+    assert [x['failed'] for x in records] == [False, False, True]
+    assert records[1]['wall'] >= records[0]['wall']
+    assert records[0]['child_maxrss_mb'] > 0
+    table= profiler.summary(records).split('\n')
+    assert table[0].split()[0:2] == ['stage', 'calls']
+    assert table[1].split()[0:2] == ['inner', '1']
+    assert table[2].split()[0:2] == ['outer', '2']
+
+def test_benchmark_synthetic_inputs():
+    genome= synthetic.make_genome(2, 20000)
+    fa, inputs= synthetic.input_files(os.path.join(tmpdir, 'synthetic'), genome, nsamples= 2, depth= 10)
+    assert [os.path.basename(x).split('_')[0] for x in inputs] == ['sample1', 'sample2', 'signal', 'genes']
+    assert len(fasta.get_fasta(fa).fetch('chr2', 0, 20000)) == 20000
+    import pysam
+    bam= pysam.AlignmentFile(inputs[0])
+    assert abs(bam.mapped - 2 * 20000 * 10 / 100) < 200
+    bam.close()
+    ## bedGraph covers the genome without gaps
+    import gzip
+    bdg= [x.strip().split('\t') for x in gzip.open(inputs[2])]
+    chr1= [x for x in bdg if x[0] == 'chr1']
+    assert chr1[0][1] == '0' and chr1[-1][2] == '20000'
+    assert all([chr1[i][2] == chr1[i + 1][1] for i in range(len(chr1) - 1)])
+    gtf= [x.split('\t') for x in gzip.open(inputs[3])]
+    assert set([x[2] for x in gtf]) == set(['transcript', 'exon', 'CDS'])
+    ## Same seed, same files
+    synthetic.write_bedgraph(os.path.join(tmpdir, 'again.bedGraph.gz'), genome)
+    assert gzip.open(inputs[2]).read() == gzip.open(os.path.join(tmpdir, 'again.bedGraph.gz')).read()
+    bed= synthetic.write_regions(os.path.join(tmpdir, 'regions.bed'), genome, 5, 1000)
+    assert [int(x.split('\t')[2]) - int(x.split('\t')[1]) for x in open(bed)] == [1000] * 5
+
+def test_benchmark_compare():
+    args= benchmark.parser.parse_args(['--nregions', '1', '10', '--nwinds', '1000', '--nsamples', '1', '4', '8', '--width', '5000'])
+    configs= benchmark.configurations(args)
+    assert [benchmark.config_key(x) for x in configs] == [
+        'nregions=10 width=5000 nwinds=1000 nsamples=4',
+        'nregions=1 width=5000 nwinds=1000 nsamples=4',
+        'nregions=10 width=5000 nwinds=1000 nsamples=1',
+        'nregions=10 width=5000 nwinds=1000 nsamples=8']
+    baseline= {'results': [{'config': configs[0], 'wall': 10.0, 'stages': collections.OrderedDict([('bam', 5.0), ('plot', 1.0)])}]}
+    results= {'results': [{'config': configs[0], 'wall': 10.5, 'stages': collections.OrderedDict([('bam', 7.0), ('plot', 0.5)])},
+                          {'config': configs[1], 'wall': 1.0, 'stages': {}}]}
+    lines, nregress= benchmark.compare(results, baseline, tolerance= 0.2, min_seconds= 0.1)
+    assert nregress == 1
+    assert [x.split('\t')[1:] for x in lines[0:3]] == [
+        ['total', '10.000', '10.500', '1.05', ''],
+        ['bam', '5.000', '7.000', '1.40', 'REGRESSION'],
+        ['plot', '1.000', '0.500', '0.50', 'improved']]
+    assert lines[3].endswith('not in baseline')
+
+def test_bigwig_fetch():
+    """bigwig/profile.bw has the same data as bedgraph/profile.bedGraph.gz
+    """
+    import gzip
+    bw= bigwig.BigWigFile('%s/bigwig/profile.bw' %(example_dir))
+    assert bw.chroms == {'chr7': 159138663}
+    starts, ends, values= bw.fetch('chr7', 5566755, 5567571)
+    bdg= [x.strip().split('\t') for x in gzip.open('%s/bedgraph/profile.bedGraph.gz' %(example_dir))]
+    bdg= [x for x in bdg if int(x[1]) >= 5566755 and int(x[2]) <= 5567571]
+    assert list(starts) == [int(x[1]) for x in bdg]
+    assert list(ends) == [int(x[2]) for x in bdg]
+    assert np.allclose(values, [float(x[3]) for x in bdg])
+    ## Clipped to region
+    starts, ends, values= bw.fetch('chr7', 5566755, 5566755 + 1)
+    assert list(starts) == [5566755]
+    assert len(bw.fetch('chrNone', 1, 100)[0]) == 0
+    bw.close()
+
+def test_compressBigWig():
+    import StringIO
+    region= pybedtools.Interval('chr7', 5566755, 5567571)
+    fout= StringIO.StringIO()
+    nlines= pycoverage.compressBigWig(region, 100, '%s/bigwig/profile.bw' %(example_dir), 'profile.bw', fout)
+    assert nlines == 816
+    out= [x.split('\t') for x in fout.getvalue().strip().split('\n')]
+    assert len(out) == 91 ## Windows of 9 bp
+    assert out[0][0:4] == ['chr7', '5566755', '5566764', 'profile.bw']
+    assert out[0][-3:] == ['coverage', 'NA', '.']
+
+def test_compressBigWig_zoom():
+    """Large windows are filled from the zoom level (16 bp summaries), close
+    to the base-level data
+    """
+    import StringIO
+    region= pybedtools.Interval('chr7', 5566755, 5567571)
+    bw= bigwig.BigWigFile('%s/bigwig/profile.bw' %(example_dir))
+    assert bw.zooms[0][0] == 16
+    assert bw.zoom_level(41) == 0
+    assert bw.zoom_level(15) is None
+    starts, ends, coverage, mins, maxs, means= bw.fetch_zoom(0, 'chr7', 5566755, 5567571)
+    base= pycoverage.group_bedgraph_by_window(*bw.fetch('chr7', 5566755, 5567571), region= region, n= 20)
+    bw.close()
+    fout= StringIO.StringIO()
+    nlines= pycoverage.compressBigWig(region, 20, '%s/bigwig/profile.bw' %(example_dir), 'profile.bw', fout)
+    assert nlines == len(starts)
+    assert nlines < 816 / 10
+    out= [x.split('\t') for x in fout.getvalue().strip().split('\n')]
+    assert len(out) == 20
+    assert np.allclose([float(x[15]) for x in out], base[2], rtol= 0.1)
+
 def test_bam_coverage_eq_igv():
     """Confirm that the counts obtained from the BAM files is consistent with
     IGV.
-    This test is very important: It means the counts in *.grp.bed.txt are correct.
+    This test is very important: It means the counts in *.grp.bin are correct.
     """
     n= 3 ## No. BAMs you have in input
-    cmd= '%(genomeGraphs)s -i %(example_dir)s/annotation/genes.gtf.gz %(example_dir)s/bam/ds051.actb.bam %(example_dir)s/bam/ds052.actb.bam %(example_dir)s/bam/ds053.actb.bam -b %(example_dir)s/actb.bed --nwinds 5000 --tmpdir %(tmpdir)s -d %(outdir)s' %{'example_dir': example_dir, 'genomeGraphs': genomeGraphs, 'tmpdir': tmpdir, 'outdir':outdir}
+    cmd= '%(genomeGraphs)s --full_counts -i %(example_dir)s/annotation/genes.gtf.gz %(example_dir)s/bam/ds051.actb.bam %(example_dir)s/bam/ds052.actb.bam %(example_dir)s/bam/ds053.actb.bam -b %(example_dir)s/actb.bed --nwinds 5000 --tmpdir %(tmpdir)s -d %(outdir)s' %{'example_dir': example_dir, 'genomeGraphs': genomeGraphs, 'tmpdir': tmpdir, 'outdir':outdir}
     print(cmd)
     p= sp.Popen(cmd, shell= True, stdout= sp.PIPE, stderr= sp.PIPE)
     stdout, stderr= p.communicate()
     assert stderr == ''
-    pileup= open(os.path.join(tmpdir, 'chr7_5566755_5567571_ACTB.grp.bed.txt')).readlines()
-    pileup= [x.strip().split('\t') for x in pileup]
-    line= pileup[599]
-    print(line)
-    assert line[2] == '5567376' ## Make sure you are at this position
+    pileup= columnar.read_columns(os.path.join(tmpdir, 'chr7_5566755_5567571_ACTB.grp.bin'))
+    nrow= len(pileup['end']) / n ## Rows of each bam, in the order given to -i
+    i= 598
+    assert pileup['end'][i] == 5567376 ## Make sure you are at this position
+    assert pileup['file_name'][i] == '%s/bam/ds051.actb.bam' %(example_dir)
     """These counts cross-checked in IGV.
-    Multiply by the number of bam files you have in `-i` to get the counts
-    """
-#    assert line[n*1] == '922'      ## Depth
-    assert line[n*1] == '0'       ## A
-    assert line[n*2] == '0'       ## a
-    assert line[n*3] == '510'       ## C
-    assert line[n*4] == '411'       ## c
-    assert line[n*5] == '0'       ## G
-    assert line[n*6] == '0'       ## g
-    assert line[n*7] == '0'      ## T
-    assert line[n*8] == '1'       ## t
-    assert line[n*9] == '0'       ## N
-    assert line[n*10] == '0'       ## n
-    assert line[n*11] == '510'      ## Z: Sum ACGTN.
-    assert line[n*12] == '412'      ## z: Sum actgn.
-
-    line= pileup[556]
-    print(line)
-    assert line[2] == '5567333' ## Make sure you are at this position
+    """
+    assert pileup['A'][i] == 0
+    assert pileup['a'][i] == 0
+    assert pileup['C'][i] == 510
+    assert pileup['c'][i] == 411
+    assert pileup['G'][i] == 0
+    assert pileup['g'][i] == 0
+    assert pileup['T'][i] == 0
+    assert pileup['t'][i] == 1
+    assert pileup['N'][i] == 0
+    assert pileup['n'][i] == 0
+    assert pileup['Z'][i] == 510 ## Z: Sum ACGTN.
+    assert pileup['z'][i] == 412 ## z: Sum actgn.
 
     ## Second bam
-#    assert line[(n*1)+1] == '462'      ## Depth
-    assert line[(n*1)+1] == '0'       ## A
-    assert line[(n*2)+1] == '0'       ## a
-    assert line[(n*3)+1] == '0'       ## C
-    assert line[(n*4)+1] == '1'       ## c
-    assert line[(n*5)+1] == '0'       ## G
-    assert line[(n*6)+1] == '0'       ## g
-    assert line[(n*7)+1] == '227'      ## T
-    assert line[(n*8)+1] == '234'       ## t
-    assert line[(n*9)+1] == '0'       ## N
-    assert line[(n*10)+1] == '0'       ## n
-    assert line[(n*11)+1] == '227'      ## Z: Sum ACGTN.
-    assert line[(n*12)+1] == '235'      ## z: Sum actgn.
+    i= nrow + 555
+    assert pileup['end'][i] == 5567333 ## Make sure you are at this position
+    assert pileup['file_name'][i] == '%s/bam/ds052.actb.bam' %(example_dir)
+    assert pileup['A'][i] == 0
+    assert pileup['a'][i] == 0
+    assert pileup['C'][i] == 0
+    assert pileup['c'][i] == 1
+    assert pileup['G'][i] == 0
+    assert pileup['g'][i] == 0
+    assert pileup['T'][i] == 227
+    assert pileup['t'][i] == 234
+    assert pileup['N'][i] == 0
+    assert pileup['n'][i] == 0
+    assert pileup['Z'][i] == 227 ## Z: Sum ACGTN.
+    assert pileup['z'][i] == 235 ## z: Sum actgn.
 
     if stderr == '':
         shutil.rmtree(tmpdir)
 
+def test_depth_only():
+    """Regions larger than --maxseq have only Z and z, same as in test_bam_coverage_eq_igv
+    """
+    n= 3
+    wdir= tempfile.mkdtemp(prefix= 'wdir_', dir= 'test_out')
+    cmd= '%(genomeGraphs)s -i %(example_dir)s/bam/ds051.actb.bam %(example_dir)s/bam/ds052.actb.bam %(example_dir)s/bam/ds053.actb.bam -b %(example_dir)s/actb.bed --nwinds 5000 --tmpdir %(tmpdir)s -d %(outdir)s' %{'example_dir': example_dir, 'genomeGraphs': genomeGraphs, 'tmpdir': wdir, 'outdir':outdir}
+    p= sp.Popen(cmd, shell= True, stdout= sp.PIPE, stderr= sp.PIPE)
+    stdout, stderr= p.communicate()
+    assert stderr == ''
+    pileup= columnar.read_columns(os.path.join(wdir, 'chr7_5566755_5567571_ACTB.grp.bin'))
+    i= 598
+    assert pileup['end'][i] == 5567376
+    assert pileup['Z'][i] == 510
+    assert pileup['z'][i] == 412
+    ## Nucleotides not counted: N and n are the depth
+    assert pileup['C'][i] == 0
+    assert pileup['N'][i] == 510
+    assert pileup['n'][i] == 412
+
+def test_pileup_depth():
+    region= pybedtools.Interval('chr7', 5566755, 5567571)
+    bamlist= ['%s/bam/ds051.actb.bam' %(example_dir), '%s/bam/ds052.actb.bam' %(example_dir), '%s/bam/ds053.actb.bam' %(example_dir)]
+    pos, counts= pympileup.pileup_native(bamlist, region)
+    dpos, depth= pympileup.pileup_depth(bamlist, region)
+    assert list(dpos) == list(pos)
+    assert depth.tolist() == counts[:, -6:].tolist() ## Z and z of each bam
+
+def test_slice_pileup():
+    """A region sliced from the pileup of a larger cluster is the same as its own pileup
+    """
+    cluster= pybedtools.Interval('chr7', 5566755, 5567571)
+    region= pybedtools.Interval('chr7', 5567000, 5567200)
+    bamlist= ['%s/bam/ds051.actb.bam' %(example_dir), '%s/bam/ds052.actb.bam' %(example_dir)]
+    pileup= pympileup.pileup_region(bamlist, cluster, None, '', engine= 'native')
+    pos, counts= pympileup.pileup_native(bamlist, region)
+    spos, scounts= pympileup.slice_pileup(pileup, region, len(bamlist))
+    assert list(spos) == list(pos)
+    assert scounts.tolist() == counts.tolist()
+    dpos, depth= pympileup.pileup_depth(bamlist, region)
+    spos, scounts= pympileup.slice_pileup(pileup, region, len(bamlist), depth_only= True)
+    assert list(spos) == list(dpos)
+    assert scounts.tolist() == depth.tolist()
+
+def test_cluster_regions():
+    from genome_graphs import genomeGraphs as gg
+    regions= [['chr1', '100', '200'], ['chr1', '150', '300'], ['chr1', '300', '400'], ['chr2', '150', '300']]
+    clusters= gg.cluster_regions(regions, [0, 0])
+    assert [[i for i, fields in x] for x in clusters] == [[0, 1], [2], [3]]
+    clusters= gg.cluster_regions(regions, [10, 10])
+    assert [[i for i, fields in x] for x in clusters] == [[0, 1, 2], [3]]
+    assert clusters[1] == [(3, ['chr2', '150', '300'])]
+    ## Many bam files shrink the clusters so their pileup fits in memory
+    assert gg.max_cluster_width(1) == gg.MAX_CLUSTER_WIDTH
+    nbams= gg.MAX_CLUSTER_BYTES // (12 * 8 * 200)
+    assert gg.max_cluster_width(nbams) == 200
+    clusters= gg.cluster_regions(regions, [10, 10], nbams)
+    assert [[i for i, fields in x] for x in clusters] == [[0], [1], [2], [3]]
+
 def test_annotation_bed():
     """Confirms a bed file intersect at the right positions
     """
@@ -301,8 +1052,8 @@ def test_sequence_and_pipe():
     assert stderr == ''
     seqbed= open(os.path.join(tmpdir, 'chr7_5567130_5567189.seq.txt')).readlines()
     seqbed= [x.strip().split('\t') for x in seqbed]
-    assert seqbed[0] == ['chrom', 'start', 'end', 'base'] ## Check first line is this header
-    nucseq= ''.join([x[3] for x in seqbed[1:]]) ## Get column 'base', skipping header.
+    assert seqbed[0] == ['chrom', 'start', 'end', 'sequence'] ## Check first line is this header
+    nucseq= ''.join([x[3] for x in seqbed[1:]]) ## Get column 'sequence', skipping header.
     print(nucseq)
     assert nucseq == 'GACTATTAAAAAAACAACAATGTGCAATCAAAGTCCTCGGCCACATTGTGAACTTTGGG' ## This sequence manually checked.
 
@@ -313,8 +1064,8 @@ def test_sequence_and_pipe2():
     assert stderr == ''
     seqbed= open(os.path.join(tmpdir, 'chr7_5567130_5567189.seq.txt')).readlines()
     seqbed= [x.strip().split('\t') for x in seqbed]
-    assert seqbed[0] == ['chrom', 'start', 'end', 'base'] ## Check first line is this header
-    nucseq= ''.join([x[3] for x in seqbed[1:]]) ## Get column 'base', skipping header.
+    assert seqbed[0] == ['chrom', 'start', 'end', 'sequence'] ## Check first line is this header
+    nucseq= ''.join([x[3] for x in seqbed[1:]]) ## Get column 'sequence', skipping header.
     assert nucseq == 'TGACTATTAAAAAAACAACAATGTGCAATCAAAGTCCTCGGCCACATTGTGAACTTTGGGG' ## This sequence manually checked.
 
 
@@ -528,4 +1279,131 @@ def test_mar_height_01top_03bottom_cex_resized():
         -b %(example_dir)s/actb.bed --tmpdir %(tmpdir)s -o %(outfile)s"""  %{'example_dir': example_dir, 'genomeGraphs': genomeGraphs, 'tmpdir': tmpdir, 'outfile': os.path.join(outdir, outfile)}
     p= sp.Popen(cmd, shell= True, stdout= sp.PIPE, stderr= sp.PIPE)
     stdout, stderr= p.communicate()
-    assert p.returncode == 0
\ No newline at end of file
+    assert p.returncode == 0
+def test_jobs_onefile():
+    """Regions processed in parallel are concatenated in input order
+    """
+    outfile= inspect.stack()[0][3] + '.pdf'
+    cmd= """%(genomeGraphs)s --jobs 3 \
+        -i %(example_dir)s/bam/ds051.actb.bam %(example_dir)s/annotation/genes.gtf.gz \
+        -b %(example_dir)s/actb.bed --tmpdir %(tmpdir)s -o %(outfile)s"""  %{'example_dir': example_dir, 'genomeGraphs': genomeGraphs, 'tmpdir': tmpdir, 'outfile': os.path.join(outdir, outfile)}
+    p= sp.Popen(cmd, shell= True, stdout= sp.PIPE, stderr= sp.PIPE)
+    stdout, stderr= p.communicate()
+    assert p.returncode == 0
+    processed= [x for x in stdout.split('\n') if x.startswith('Processing: ')]
+    assert len(processed) == 5
+    assert os.path.isfile(os.path.join(outdir, outfile))
+    pages, nodes= pdfstream.PdfReader(os.path.join(outdir, outfile)).pages()
+    assert len(pages) == 5
+
+def test_r_session():
+    """Plots rendered by the persistent R session
+    """
+    outfile= inspect.stack()[0][3] + '.pdf'
+    cmd= """%(genomeGraphs)s --r_session \
+        -i %(example_dir)s/bam/ds051.actb.bam %(example_dir)s/bedgraph/profile.bedGraph.gz %(example_dir)s/annotation/genes.gtf.gz \
+        -b %(example_dir)s/actb.bed --tmpdir %(tmpdir)s -o %(outfile)s"""  %{'example_dir': example_dir, 'genomeGraphs': genomeGraphs, 'tmpdir': tmpdir, 'outfile': os.path.join(outdir, outfile)}
+    p= sp.Popen(cmd, shell= True, stdout= sp.PIPE, stderr= sp.PIPE)
+    stdout, stderr= p.communicate()
+    assert p.returncode == 0
+    assert os.path.isfile(os.path.join(outdir, outfile))
+
+def test_engine_native():
+    outfile= inspect.stack()[0][3] + '.pdf'
+    cmd= """%(genomeGraphs)s --engine native \
+        -i %(example_dir)s/bam/ds051.actb.bam %(example_dir)s/bam/ds052.actb.bam %(example_dir)s/annotation/genes.gtf.gz \
+        -b %(example_dir)s/actb.bed --tmpdir %(tmpdir)s -o %(outfile)s"""  %{'example_dir': example_dir, 'genomeGraphs': genomeGraphs, 'tmpdir': tmpdir, 'outfile': os.path.join(outdir, outfile)}
+    p= sp.Popen(cmd, shell= True, stdout= sp.PIPE, stderr= sp.PIPE)
+    stdout, stderr= p.communicate()
+    assert p.returncode == 0
+    assert os.path.isfile(os.path.join(outdir, outfile))
+
+def test_bigwig():
+    outfile= inspect.stack()[0][3] + '.pdf'
+    cmd= """%(genomeGraphs)s \
+        -i %(example_dir)s/bigwig/profile.bw %(example_dir)s/bedgraph/profile.bedGraph.gz \
+        -b %(example_dir)s/actb.bed --tmpdir %(tmpdir)s -o %(outfile)s"""  %{'example_dir': example_dir, 'genomeGraphs': genomeGraphs, 'tmpdir': tmpdir, 'outfile': os.path.join(outdir, outfile)}
+    p= sp.Popen(cmd, shell= True, stdout= sp.PIPE, stderr= sp.PIPE)
+    stdout, stderr= p.communicate()
+    assert p.returncode == 0
+    assert os.path.isfile(os.path.join(outdir, outfile))
+
+def test_renderer_python():
+    wdir= tempfile.mkdtemp(prefix= 'pdf_', dir= 'test_out')
+    cmd= """%(genomeGraphs)s \
+        -i %(example_dir)s/bam/ds051.actb.bam %(example_dir)s/bedgraph/profile.bedGraph.gz %(example_dir)s/annotation/genes.gtf.gz \
+        -b %(example_dir)s/actb.bed --renderer python --format png --tmpdir %(tmpdir)s -d %(outdir)s"""  %{'example_dir': example_dir, 'genomeGraphs': genomeGraphs, 'tmpdir': tmpdir, 'outdir': wdir}
+    p= sp.Popen(cmd, shell= True, stdout= sp.PIPE, stderr= sp.PIPE)
+    stdout, stderr= p.communicate()
+    assert p.returncode == 0
+    assert os.path.isfile(os.path.join(wdir, 'chr7_5566755_5567571_ACTB.png'))
+
+def test_in_memory():
+    """Same plots as with the intermediate files and only the plots are written
+    """
+    wdir= tempfile.mkdtemp(prefix= 'in_memory_', dir= 'test_out')
+    cmd= """%(genomeGraphs)s \
+        -i %(example_dir)s/bam/ds051.actb.bam %(example_dir)s/bedgraph/profile.bedGraph.gz %(example_dir)s/annotation/genes.gtf.gz \
+        -b %(example_dir)s/actb.bed --renderer python --cache_size 0 --tmpdir %(wdir)s/tmp_%(run)s %(output)s"""
+    runs= [('files', '--format png -d %s/files' %(wdir)),
+           ('memory', '--format png -d %s/memory --in_memory' %(wdir)),
+           ('onefile', '-o %s/all.pdf --in_memory' %(wdir))]
+    for run, output in runs:
+        p= sp.Popen(cmd %{'example_dir': example_dir, 'genomeGraphs': genomeGraphs, 'wdir': wdir, 'run': run, 'output': output},
+            shell= True, stdout= sp.PIPE, stderr= sp.PIPE)
+        stdout, stderr= p.communicate()
+        assert p.returncode == 0
+    png= 'chr7_5566755_5567571_ACTB.png'
+    assert open(os.path.join(wdir, 'files', png), 'rb').read() == open(os.path.join(wdir, 'memory', png), 'rb').read()
+    for run in ['memory', 'onefile']:
+        assert [x for x in os.listdir(os.path.join(wdir, 'tmp_' + run)) if x.startswith('chr7_')] == []
+    assert len(pdfstream.PdfReader(os.path.join(wdir, 'all.pdf')).pages()[0]) == 1
+
+def test_in_memory_failed_region():
+    """Spools of a region are closed also when the region fails
+    """
+    from genome_graphs import genomeGraphs as gg
+    opened= []
+    Spool= spool.Spool
+    class TrackedSpool(Spool):
+        def __init__(self, max_size):
+            Spool.__init__(self, max_size)
+            opened.append(self)
+    args= gg.parser.parse_args(['-i', 'x', '-b', 'x', '--renderer', 'python', '--in_memory'])
+    bigwig= os.path.join(tmpdir, 'missing.bw')
+    gg.init_worker({'args': args, 'slop': [0, 0], 'nwinds': 100, 'tmpdir': tmpdir, 'outdir': outdir, 'onefile': True,
+        'bamlist': [], 'nonbamlist': [bigwig], 'nonbam_dict': {}, 'libsizes': None, 'region_cache': None,
+        'bam_ids': [], 'fasta_id': None, 'inputlist_all': [bigwig], 'names': [None]})
+    gg.spool.Spool= TrackedSpool
+    try:
+        regname, pdf, error= gg.process_region_safe(['chr7', '5566755', '5567571'])
+    finally:
+        gg.spool.Spool= Spool
+    assert pdf is None and error is not None
+    assert len(opened) == 3
+    assert all([x.data.closed for x in opened])
+
+def test_serve():
+    """Two requests to the same server, the second one from the warm worker
+    """
+    port= 18090
+    p= sp.Popen([genomeGraphs, 'serve', '--port', str(port), '--jobs', '1', '--tmpdir', tmpdir], stdout= sp.PIPE, stderr= sp.PIPE)
+    try:
+        time.sleep(3)
+        request= json.dumps({'region': ['chr7', 5566778, 5567522, 'ACTB'],
+            'args': ['-i', os.path.join(example_dir, 'bam/ds051.actb.bam'), os.path.join(example_dir, 'bigwig/profile.bw')]})
+        for i in range(2):
+            reply= urllib2.urlopen('http://127.0.0.1:%s/plot' %(port), request)
+            assert reply.getcode() == 200
+            assert reply.info()['Content-Type'] == 'application/pdf'
+            assert reply.read().startswith('%PDF')
+        try:
+            urllib2.urlopen('http://127.0.0.1:%s/plot' %(port), json.dumps({'region': ['chr7', 10, 5]}))
+            assert False
+        except urllib2.HTTPError as e:
+            assert e.code == 400
+        status= json.loads(urllib2.urlopen('http://127.0.0.1:%s/status' %(port)).read())
+        assert status['jobs'] == 1
+    finally:
+        p.terminate()
+        p.wait()